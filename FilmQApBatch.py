@@ -0,0 +1,251 @@
+# Module FilmQApBatch
+# File FilmQApBatch.py
+# Version 0.1
+
+"""
+A command line tool to process radiochromic film scans without the Streamlit app.
+
+Every scan goes through the same steps as the app: segmentation, base determination, calibration, dose calculation and
+export to dxf. Several scans are processed concurrently. Streamlit is never imported.
+
+Example:
+
+    python FilmQApBatch.py -c config/filmQAp.config -b tmp/bb.csv -o export/ img_dir/Film1.tif img_dir/Film2.tif
+
+A bounding box file named as the scan with the csv extension (img_dir/Film1.csv) takes precedence over --bbfile. With
+--detect the regions of the other scans are detected automatically, with --layout they are placed from a layout
+template saved from a previous scan with the same film placement.
+"""
+
+# Module dependencies
+
+# - Config file
+import configparser
+# - Command line
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+# - Film processing
+import pyfilmqa as fqa
+
+def readConfig(configfile=None, jobs=1):
+    """
+    A function to read the configuration for a batch worker
+
+    ...
+
+    Attributes
+    ----------
+    configfile : str or Path
+        The configuration file
+
+    jobs : int
+        The number of films processed concurrently. When the [Processing] workers value is 0 the CPUs are shared between them
+
+    Returns
+    -------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+    """
+
+    config = configparser.ConfigParser()
+    if not config.read(configfile):
+        raise FileNotFoundError('Configuration file not found: ' + str(configfile))
+    if int(config['Processing']['workers']) == 0:
+        config['Processing']['workers'] = str(max(1, (os.cpu_count() or 1) // jobs))
+    return config
+
+def processFilm(imfile=None, bbfile=None, configfile=None, outdir=None, orientations=['original'], Dmax=None,
+                PatientId=None, LastName='', FirstName='', jobs=1, progress=None, saveRegions=False, layout=None, reportPrecision=False):
+    """
+    A function to process a film scan end to end and export its dose distribution in dxf format
+
+    ...
+
+    Attributes
+    ----------
+    imfile : str or Path
+        The scanned image in TIFF format, with the dose distribution, the calibration strip and the base strip
+
+    bbfile : str or Path or None
+        The bounding box file of the scan regions (Film, Calibration, Background and Center), as written by the app. If
+        None the regions are placed from the layout, or detected automatically without it, and written to
+        <outdir>/<scan>.csv for review
+
+    configfile : str or Path
+        The configuration file
+
+    outdir : str or Path or None
+        The export directory. If None the dxf file is written next to the scan
+
+    orientations : list
+        The orientations of the exported dose plane, keys of pyfilmqa ORIENTATIONS. With several orientations every
+        file is named <scan>.<orientation>.dxf
+
+    Dmax : float or None
+        The maximum dose. If None the [DosePlane] Dmax is used
+
+    PatientId : str or None
+        The patient identification. If None the scan file name is used
+
+    LastName : str
+        The patient family name
+
+    FirstName : str
+        The patient given name
+
+    jobs : int
+        The number of films processed concurrently
+
+    progress : Progress or None
+        The progress reporter of the denoising and dose calculation loops. If None no progress is reported
+
+    saveRegions : bool
+        If True the regions are also written next to the scan (<scan>.Film.tif, ...), as the app does
+
+    layout : str or None
+        The name of a layout template, see pyfilmqa saveLayout. Used when bbfile is None
+
+    reportPrecision : bool
+        If True the accuracy of the float32 precision against float64 is measured and printed, see pyfilmqa
+        precisionReport
+
+    Returns
+    -------
+    dxffilePaths : list
+        The exported dxf files
+
+    elapsed : float
+        The processing time in seconds
+    """
+
+    t0 = time.perf_counter()
+    config = readConfig(configfile=configfile, jobs=jobs)
+    imfile = Path(imfile)
+
+    PatientId = imfile.stem if PatientId is None else PatientId
+    outdir = imfile.parent if outdir is None else Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    # Segmentation, the scan is read once and every stage takes its region from it
+    bbdf = None
+    if bbfile is None and layout is not None:
+        bbdf, _offset = fqa.applyLayout(layout=fqa.loadLayout(layout, config=config), imfile=imfile, config=config, bbfile=outdir / (imfile.stem + '.csv'))
+    elif bbfile is None:
+        bbdf = fqa.detectRegions(imfile=imfile, bbfile=outdir / (imfile.stem + '.csv'), config=config)
+        if 'Center' not in bbdf.label.values:
+            raise ValueError('Center mark not found on the scanner ruler. The other regions are written to %s, add the Center region and process the scan with that bounding box file'
+                             % (outdir / (imfile.stem + '.csv')))
+    scan = fqa.segRegs(imfile=imfile, bbfile=bbfile, save=saveRegions, bbdf=bbdf)
+    # Coordinates for the lateral correction
+    cdf = fqa.coordOAC(imfile=scan)
+    # Base
+    abase = fqa.baseDetermination(imfile=scan, config=config)
+    # Calibration
+    calmodel, _cddf, _fps = fqa.PDDCalibration(config=config, imfile=scan, base=abase)
+    # Dose, strip by strip into a memory mapped file with the streaming pipeline
+    streaming = config['Processing']['pipeline'] == 'streaming'
+    dosefile = outdir / (imfile.stem + '.dose.npy')
+    if streaming:
+        fDim = fqa.mphspcnlmprocf_streaming(imfile=scan, config=config, caldf=calmodel, ccdf=cdf, progress=progress, Dmax=Dmax, outfile=dosefile)
+    else:
+        Dim = fqa.mphspcnlmprocf_multiprocessing(imfile=scan, config=config, caldf=calmodel, ccdf=cdf, progress=progress)
+        fDim = fqa.postmphspcnlmprocf(Dim, config=config, Dmax=Dmax)
+
+    # Accuracy of the float32 precision
+    if reportPrecision:
+        report = fqa.precisionReport(imfile=scan, config=config, caldf=calmodel, ccdf=cdf, Dmax=Dmax, progress=progress)
+        print('%s: float32 against float64, max %.4f Gy, mean %.5f Gy, p99 %.4f Gy, dxf values changed %.3f%%, dose %.1f s -> %.1f s, %d MB -> %d MB'
+              % (imfile, report['maxerr'], report['meanerr'], report['p99err'], 100 * report['dxffraction'],
+                 report['time64'], report['time32'], report['nbytes64'] // 2**20, report['nbytes32'] // 2**20))
+
+    # Export, every orientation in the same call
+    dxffilePaths = {orientation : outdir / (imfile.stem + ('' if len(orientations) == 1 else '.' + orientation) + '.dxf') for orientation in orientations}
+    fqa.dxfWriter(Data=fDim, orientations=dxffilePaths,
+                  AcqType='Acquired Portal', PatientId1=PatientId,
+                  PatientId2=PatientId, LastName=LastName,
+                  FirstName=FirstName, pxsp=fqa.TIFFPixelSpacing(scan), imsz=fqa.DoseImageSize(fDim))
+    if streaming:
+        del fDim
+        dosefile.unlink()
+    return list(dxffilePaths.values()), time.perf_counter() - t0
+
+def filmBBFile(imfile=None, bbfile=None):
+    """
+    A function to get the bounding box file of a scan: the csv file named as the scan if it exists, bbfile otherwise.
+    None when there is no file, the regions are then detected
+    """
+
+    own = Path(imfile).with_suffix('.csv')
+    return own if own.exists() else None if bbfile is None else Path(bbfile)
+
+def parseArgs(argv=None):
+    """
+    A function to parse the command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description='Process radiochromic film scans and export the dose distributions in dxf format.')
+    parser.add_argument('films', nargs='+', help='scanned images in TIFF format')
+    parser.add_argument('-c', '--config', default='config/filmQAp.config', help='configuration file (default: %(default)s)')
+    parser.add_argument('-b', '--bbfile', default='tmp/bb.csv', help='bounding box file, used for the scans without their own <scan>.csv (default: %(default)s)')
+    parser.add_argument('-d', '--detect', action='store_true', help='detect the regions of the scans without their own <scan>.csv instead of using --bbfile, the boxes are written to the export directory')
+    parser.add_argument('-l', '--layout', default=None, help='place the regions of the scans without their own <scan>.csv from this layout template, the boxes are written to the export directory')
+    parser.add_argument('--save-layout', default=None, metavar='NAME', help='save the regions of the first scan as a layout template before processing')
+    parser.add_argument('-o', '--outdir', default=None, help='export directory (default: next to every scan)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of films processed concurrently (default: %(default)s)')
+    parser.add_argument('--orientation', action='append', choices=list(fqa.ORIENTATIONS), default=None, help='orientation of the exported dose plane, repeat it to export several as <scan>.<orientation>.dxf (default: original)')
+    parser.add_argument('--dmax', type=float, default=None, help='maximum dose in Gy (default: [DosePlane] dmax)')
+    parser.add_argument('--save-regions', action='store_true', help='also write the regions of every scan next to it, as the app does')
+    parser.add_argument('--precision-report', action='store_true', help='measure and print the accuracy of the float32 precision against float64 for every scan')
+    parser.add_argument('--progress', action='store_true', help='report the progress of every film on the standard error')
+    parser.add_argument('--patient-id', default=None, help='patient identification (default: the scan file name)')
+    parser.add_argument('--last-name', default='', help='patient family name')
+    parser.add_argument('--first-name', default='', help='patient given name')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """
+    The command line entry point. It returns the number of films that could not be processed
+    """
+
+    args = parseArgs(argv)
+    jobs = max(1, min(args.jobs, len(args.films)))
+    kwargs = {'configfile' : args.config, 'outdir' : args.outdir, 'orientations' : args.orientation or ['original'], 'Dmax' : args.dmax,
+              'PatientId' : args.patient_id, 'LastName' : args.last_name, 'FirstName' : args.first_name, 'jobs' : jobs,
+              'saveRegions' : args.save_regions, 'layout' : args.layout, 'reportPrecision' : args.precision_report,
+              'progress' : fqa.ConsoleProgress() if args.progress else fqa.NullProgress()}
+
+    if args.save_layout is not None:
+        imfile = args.films[0]
+        config = readConfig(args.config)
+        fqa.saveLayout(args.save_layout, imfile=imfile, bbfile=filmBBFile(imfile, args.bbfile), config=config)
+        print('%s -> %s' % (imfile, fqa.layoutPath(config=config, name=args.save_layout)))
+
+    bbfile = None if args.detect or args.layout is not None else args.bbfile
+    failed = 0
+    if jobs == 1:
+        for imfile in args.films:
+            try:
+                dxffilePaths, elapsed = processFilm(imfile=imfile, bbfile=filmBBFile(imfile, bbfile), **kwargs)
+                print('%s -> %s (%.1f s)' % (imfile, ', '.join(map(str, dxffilePaths)), elapsed))
+            except Exception as e:
+                failed += 1
+                print('%s: %s' % (imfile, e), file=sys.stderr)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as ex:
+            futures = {ex.submit(processFilm, imfile=imfile, bbfile=filmBBFile(imfile, bbfile), **kwargs) : imfile for imfile in args.films}
+            for future in as_completed(futures):
+                imfile = futures[future]
+                try:
+                    dxffilePaths, elapsed = future.result()
+                    print('%s -> %s (%.1f s)' % (imfile, ', '.join(map(str, dxffilePaths)), elapsed))
+                except Exception as e:
+                    failed += 1
+                    print('%s: %s' % (imfile, e), file=sys.stderr)
+    return failed
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,5 @@
 import os
+import re
 import pydicom as dicom
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -7,19 +8,21 @@ import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 import seaborn as sns
 import pyfilmqa as fqa
-from skimage.io import imread, imsave
+from skimage.io import imsave
 from skimage import img_as_ubyte
 from skimage.exposure import rescale_intensity
 from streamlit_img_label.manage import ImageManager, ImageDirManager
 from streamlit_img_label import st_img_label
+from streamlit_img_label.annotation import output_xml
 # - Config file
 import configparser
 import streamlit as st
 st.set_page_config(page_title='FilmQAp')
 
 
-def run(img_dir, labels):
+def run(ws, labels):
     st.set_option("deprecation.showfileUploaderEncoding", False)
+    img_dir = str(ws.path)
     idm = ImageDirManager(img_dir)
 
     if "files" not in st.session_state:
@@ -91,54 +94,74 @@ def run(img_dir, labels):
     img = im.get_img()
     resized_img = im.resizing_img()
     resized_rects = im.get_resized_rects()
-    rects = st_img_label(resized_img, box_color="red", rects=resized_rects)
+    rects = st_img_label(resized_img, box_color="red", rects=resized_rects, image_uri=im.encoded_img())
 
     def process():
-        imfile = 'img_dir/' + scim.name
         im.save_annotation()
         image_annotate_file_name = img_file_name.split(".")[0] + ".xml"
         if image_annotate_file_name not in st.session_state["annotation_files"]:
             st.session_state["annotation_files"].append(image_annotate_file_name)
         next_annotate_file()
 
+        # Coordenadas de las regiones en píxeles de la digitalización
         lbdf = pd.DataFrame(im._current_rects)
-        lbdf.to_csv('tmp/bb.csv')
-
-        # Segmentar la imagen
-        fqa.segRegs(imfile=imfile)
+        lbdf[['left', 'top', 'width', 'height']] *= st.session_state.get('FilmPreviewStep', 1)
+        lbdf.to_csv(ws.file('bb.csv'))
 
         # Leer la configuración
         config = configparser.ConfigParser()
         configfile='config/filmQAp.config'
         config.read(configfile)
 
-        # Determinar las coordenadas para la corrección lateral
-        cdf = fqa.coordOAC(imfile=imfile)
-        # Determinación del fondo
-        abase = fqa.baseDetermination(imfile=imfile, config=config)
-        # Calibración de la digitalización
-        caldf, cddf, fps = fqa.PDDCalibration(config=config, imfile=imfile, base=abase)
-        # Incorporar al estado de la aplicación
-        if caldf not in st.session_state:
-            st.session_state.caldf = caldf
-        if cddf not in st.session_state:
-            st.session_state.cddf = cddf
-        if fps not in st.session_state:
-            st.session_state.fps = fps
-        # Determinación de la dosis en cada canal
-        Dim = fqa.mphspcnlmprocf_multiprocessing(imfile=imfile, config=config, caldf=caldf, ccdf=cdf)
-        if 'Dmax' in st.session_state:
-            st.session_state.fDim = fqa.postmphspcnlmprocf(Dim, config=config)
-            if 'fDim' in st.session_state:
-                fcols, frows, fchannels = Dim.shape
-                st.session_state.fcols = fcols
-                st.session_state.frows = frows
-                st.success('Convertida a dosis la información de la película.')
-        else:
-            st.error('Error: Plano de dosis calculado en el planificador no introducido, no es posible completar el postprocesado de la dosis medida por la película.')
+        # Procesar en segundo plano, la página queda libre para etiquetar la siguiente digitalización. El procesamiento
+        # lee su propia copia de la digitalización y de las regiones, una nueva con el mismo nombre no las cambia
+        jobid = fqa.submitJob(fqa.filmJob, config=config, name=scim.name, priority=st.session_state.get('priority', 1),
+                              imfile=fqa.workspaceSnapshot(ws, ws.file(scim.name)), bbdf=lbdf.copy(), workspace=ws,
+                              Dmax=st.session_state.get('Dmax'))
+        st.session_state.setdefault('jobs', []).append(jobid)
+        st.query_params['job'] = jobid
+
+    def detect():
+        # Proponer las regiones automáticamente, en píxeles de la vista previa
+        bbdf = fqa.detectRegions(imfile=ws.file(scim.name), bbfile=ws.file('bb.csv'), config=config)
+        if 'Center' not in bbdf.label.values:
+            st.warning('No se ha encontrado la marca del centro en la regla del escáner. Es necesario marcar la región Center.')
+        step = st.session_state.get('FilmPreviewStep', 1)
+        output_xml(img_path, img, [{'left' : int(bb.left/step), 'top' : int(bb.top/step), 'width' : int(bb.width/step), 'height' : int(bb.height/step), 'label' : bb.label} for bb in bbdf.itertuples()])
+
+    # Plantillas de colocación de las películas
+    config = configparser.ConfigParser()
+    config.read('config/filmQAp.config')
+
+    def apply_layout():
+        # Colocar las regiones de la plantilla, desplazadas con la digitalización
+        try:
+            bbdf, offset = fqa.applyLayout(layout=st.session_state.layout_name, imfile=ws.file(scim.name), config=config, bbfile=ws.file('bb.csv'))
+        except (FileNotFoundError, ValueError) as e:
+            st.sidebar.error(str(e))
+            return
+        step = st.session_state.get('FilmPreviewStep', 1)
+        output_xml(img_path, img, [{'left' : int(bb.left/step), 'top' : int(bb.top/step), 'width' : int(bb.width/step), 'height' : int(bb.height/step), 'label' : bb.label} for bb in bbdf.itertuples()])
+        st.sidebar.info('Desplazamiento respecto a la plantilla: %.1f, %.1f mm' % tuple(offset))
+
+    def save_layout():
+        # Guardar las regiones actuales, en píxeles de la digitalización
+        lbdf = pd.DataFrame(im._current_rects)
+        lbdf[['left', 'top', 'width', 'height']] *= st.session_state.get('FilmPreviewStep', 1)
+        fqa.saveLayout(st.session_state.new_layout_name, imfile=ws.file(scim.name), bbdf=lbdf, config=config)
+
+    with st.sidebar:
+        st.button(label="Detectar regiones", on_click=detect, help='Proponer las regiones Film, Calibration, Background y Center para confirmarlas')
+        with st.expander('Plantillas'):
+            layouts = fqa.listLayouts(config)
+            st.selectbox('Plantilla', layouts, key='layout_name')
+            st.button(label='Aplicar plantilla', on_click=apply_layout, disabled=not layouts, help='Colocar las regiones de una digitalización anterior con la misma disposición de las películas')
+            st.text_input('Nombre', key='new_layout_name')
+            st.button(label='Guardar plantilla', on_click=save_layout, disabled=not (rects and st.session_state.get('new_layout_name')), help='Guardar las regiones actuales como plantilla')
 
     if rects:
         with st.sidebar:
+            st.selectbox('Prioridad', [1, 0], format_func=lambda p: 'Urgente' if p == 0 else 'Normal', key='priority')
             st.button(label="Process", on_click=process)
 
         preview_imgs = im.init_annotation(rects)
@@ -158,25 +181,96 @@ def run(img_dir, labels):
                 )
                 im.set_annotation(i, select_label)
 
+def jobs_status():
+    # Estado de los procesamientos en segundo plano de la sesión
+    active = False
+    for jobid in st.session_state.jobs:
+        job = fqa.getJob(jobid)
+        if job is None:
+            # Los procesamientos terminados se olvidan pasado un tiempo, los ya incorporados no se necesitan
+            if jobid not in st.session_state.get('jobs_loaded', []):
+                st.warning('Procesamiento no encontrado, es necesario repetirlo.')
+        elif job.state == 'queued':
+            active = True
+            st.info('%s: en cola, posición %d. ' % (job.name, job.position) + ('Inicio estimado en %.0f s.' % job.eta if job.eta is not None else ''))
+        elif job.state == 'running':
+            active = True
+            p = job.progress
+            st.progress(min(p.done / max(p.total, 1), 1.), text='%s: %s. %s %d/%d' % (job.name, job.stage, p.desc, p.done, p.total))
+        elif job.state == 'failed':
+            st.error('%s: %s' % (job.name, job.error))
+        elif 'fDim' not in job.results:
+            st.error('Error: Plano de dosis calculado en el planificador no introducido, no es posible completar el postprocesado de la dosis medida por la película.')
+        else:
+            # Incorporar al estado de la aplicación, una sola vez por procesamiento
+            if jobid not in st.session_state.setdefault('jobs_loaded', []):
+                st.session_state.calmodel = job.results['calmodel']
+                st.session_state.caldf = job.results['calmodel'].caldf
+                st.session_state.cddf = job.results['cddf']
+                st.session_state.fps = job.results['fps']
+                st.session_state.FilmPixelSpacing = job.results['pxsp']
+                st.session_state.fDim = job.results['fDim']
+                fcols, frows = job.results['fDim'].shape
+                st.session_state.fcols = fcols
+                st.session_state.frows = frows
+                st.session_state.jobs_loaded.append(jobid)
+            st.success('%s: convertida a dosis la información de la película.' % job.name)
+    return active
+
+@st.fragment(run_every=1)
+def jobs_poll():
+    # Consultar el estado cada segundo mientras quede algún procesamiento pendiente
+    if not jobs_status():
+        st.rerun()
+
 if __name__ == "__main__":
     st.header('2. Procesar el plano de dosis medido mediante la película')
 
+    config = configparser.ConfigParser()
+    config.read('config/filmQAp.config')
+
+    # Recuperar el espacio de trabajo y el último procesamiento tras recargar el navegador
+    if 'workspace' not in st.session_state and re.fullmatch('[0-9a-f]{32}', st.query_params.get('ws', '')):
+        st.session_state.workspace = fqa.Workspace(config, name=st.query_params['ws'])
+    if 'jobs' not in st.session_state and fqa.getJob(st.query_params.get('job')) is not None:
+        st.session_state.jobs = [st.query_params['job']]
+
     scim = st.file_uploader('Digitalización de la película:', help='Seleccionar el archivo TIFF adquirido en el escáner.')
 
     if scim is not None:
-        # Guardar una copia local de la imagen
-        lcscim = os.path.join("img_dir",scim.name)
-        with open(lcscim,"wb") as f:
-            f.write(scim.getbuffer())
+        # Espacio de trabajo de la sesión, las sesiones simultáneas no comparten archivos intermedios
+        if 'workspace' not in st.session_state:
+            fqa.workspaceClean(config)
+            st.session_state.workspace = fqa.Workspace(config)
+        ws = st.session_state.workspace
+        st.query_params['ws'] = ws.name
+
+        # Guardar una copia local de la imagen y su vista previa, una sola vez por archivo. La copia se sustituye
+        # de una vez, un procesamiento en curso sigue leyendo la anterior
+        lcscim = ws.file(scim.name)
+        newscan = st.session_state.get('FilmPreviewKey') != (scim.name, scim.size)
+        if newscan:
+            with open(lcscim.with_suffix('.part'),"wb") as f:
+                f.write(scim.getbuffer())
+            os.replace(lcscim.with_suffix('.part'), lcscim)
         # Crear un registro en el estado de la alicación con el nombre del archivo de imagen
         if 'FilmFileName' not in st.session_state:
             st.session_state.FilmFileName = scim.name
 
-        # Guardar una copia local en formato png
-        aim = imread(lcscim)
-        imsave(os.path.join("img_dir",'Film.png'), img_as_ubyte(rescale_intensity(aim, out_range='uint8')))
+        # Guardar una vista previa reducida en formato png, sin cargar la digitalización completa en memoria
+        if newscan:
+            aim, step = fqa.scanPreview(lcscim)
+            st.session_state.FilmPreviewStep = step
+            imsave(ws.file('Film.png'), img_as_ubyte(rescale_intensity(aim, out_range='uint8')))
+            st.session_state.FilmPreviewKey = (scim.name, scim.size)
 
         # Etiquetar la imagen
         custom_labels = ["", "Film", "Calibration", "Background", "Center"]
 
-        run("img_dir", custom_labels)
+        run(ws, custom_labels)
+
+    if st.session_state.get('jobs'):
+        if any(getattr(fqa.getJob(jobid), 'state', None) in ('queued', 'running') for jobid in st.session_state.jobs):
+            jobs_poll()
+        else:
+            jobs_status()
@@ -53,8 +53,24 @@ def vrot270():
     fDim = np.rot90(np.fliplr(fDim), k=3)
     tif2dxf(fDim=fDim)
 
+def film_pixel_spacing():
+    # Espaciado de píxel de la película: el registrado al procesarla, el de su digitalización en el espacio de trabajo
+    # o el del archivo dxf cargado en la página de análisis
+    if 'FilmPixelSpacing' in st.session_state:
+        return st.session_state.FilmPixelSpacing
+    if 'workspace' in st.session_state and 'FilmFileName' in st.session_state:
+        scan = st.session_state.workspace.file(st.session_state.FilmFileName)
+        if scan.exists():
+            return fqa.TIFFPixelSpacing(scan)
+    if 'FilmDxfPixelSpacing' in st.session_state:
+        return list(st.session_state.FilmDxfPixelSpacing)
+    return None
+
 def tif2dxf(fDim=None):
-    pxsp = fqa.TIFFPixelSpacing(os.path.join("img_dir", st.session_state.FilmFileName))
+    pxsp = film_pixel_spacing()
+    if pxsp is None:
+        st.error('Error: Espaciado de píxel de la película desconocido, es necesario volver a procesar la digitalización.')
+        return
     imsz = fqa.DoseImageSize(fDim)
 
     if 'fDdf' not in st.session_state:
@@ -5,6 +5,7 @@ import matplotlib.ticker as ticker
 import seaborn as sns
 import pandas as pd
 import numpy as np
+from io import BytesIO
 from scipy.interpolate import RectBivariateSpline as RBSp
 from skimage.transform import resize
 from math import ceil, floor
@@ -37,6 +38,26 @@ with st.sidebar:
         'Desplazamiento y [mm]',
         -dmax, dmax, 0)
 
+    # Distribuciones de dosis archivadas en formato dxf, sin volver a procesar los escaneos
+    with st.expander('Archivos dxf'):
+        pdxf = st.file_uploader('Plano de dosis del planificador', type=['dxf', 'gz'], key='pdxf', help='Archivo dxf exportado por la página del planificador')
+        fdxf = st.file_uploader('Plano de dosis de la película', type=['dxf', 'gz'], key='fdxf', help='Archivo dxf exportado por la página de la película')
+
+@st.cache_data
+def dxfDoseFrame(dxfdata):
+    return fqa.dxfDoseFrame(*fqa.dxfReader(BytesIO(dxfdata)))
+
+if pdxf is not None:
+    st.session_state.pDdf, st.session_state.pps = dxfDoseFrame(pdxf.getvalue())
+
+if fdxf is not None:
+    # Espaciado de píxel del archivo dxf, distinto del espaciado de la calibración (fps) de la página de la película
+    st.session_state.fDdf, st.session_state.FilmDxfPixelSpacing = dxfDoseFrame(fdxf.getvalue())
+
+if 'pDdf' not in st.session_state or 'fDdf' not in st.session_state:
+    st.info('Cargar los planos de dosis del planificador y de la película o sus archivos dxf')
+    st.stop()
+
 pDdf = st.session_state.pDdf
 px, py = pDdf.columns.values, pDdf.index.values
 pps = st.session_state.pps
@@ -53,7 +74,7 @@ with st.sidebar:
 
 fDdf = st.session_state.fDdf
 fx, fy = fDdf.columns.values, fDdf.index.values
-fps = st.session_state.fps
+fps = st.session_state.get('FilmDxfPixelSpacing', st.session_state.get('fps'))
 fDim = fDdf.values
 
 fDo = RBSp(fy, fx, fDim)
@@ -11,13 +11,15 @@ config = configparser.ConfigParser()
 configfile='config/filmQAp.config'
 config.read(configfile)
 
-caldf = st.session_state.caldf
+calmodel = st.session_state.calmodel
+
+caldf = calmodel.caldf
 
 cddf = st.session_state.cddf
 
 cda = cddf[['dR', 'dG', 'dB']].to_numpy()
 
-vDa = fqa.validatecalibf(cda=cda, config=config, caldf=caldf)
+vDa = fqa.validatecalibf(cda=cda, config=config, caldf=calmodel)
 
 cddf['vD'] = vDa
 cddf['uD'] = cddf.vD - cddf.D
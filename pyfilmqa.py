@@ -22,42 +22,251 @@ from pathlib import Path
 import numpy as np
 # - Data mamaging
 import pandas as pd
-# - DICOM files editing
-import pydicom as dicom
 # - TIFF files
 from tifffile import TiffFile
-from tifffile import imread as timread, imwrite as timwrite
+from tifffile import imread as timread, imwrite as timwrite, memmap as tmemmap
 # - Image processing
-from skimage.io import imread, imsave
-from skimage import img_as_float, img_as_uint
+from skimage.io import imread
+from skimage import img_as_float, img_as_float32, img_as_uint
 from skimage.measure import profile_line
 # - Non-local means
 from skimage.restoration import denoise_nl_means
 # - JSON Files
+import json
 from json import dumps
-# - Non-local means
-from skimage.restoration import denoise_nl_means
 # - Interpolation
 from scipy.interpolate import interp1d
-# - Numerical non linear fits
-from scipy.optimize import curve_fit
-from scipy.optimize import minimize
+from scipy.interpolate import BSpline, make_interp_spline
+from scipy import ndimage as ndi
+# - Image registration
+from skimage.registration import phase_cross_correlation
 # - Non linear function inversion
 from scipy.optimize import fsolve
 # - Calibration models fits
-from lmfit import Parameters, Model
-# - Progress bar
-from stqdm import stqdm
-# - To pass additional parameters to map function
-from itertools import repeat
+from lmfit import Model
 # - Multiprocessing
 from multiprocessing import Pool
-# - streamlit
-import streamlit as st
-
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+# - Files, directories and unique names (workspaces, cache entries and checkpoints)
+import os
+import shutil
+import tempfile
+from uuid import uuid4
+# - Persistent worker pool management
+import atexit
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+# - Job scheduling
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import count
+# - Workspaces of the live sessions
+import weakref
+# - On-disk cache
+import hashlib
+import pickle
+# - dxf input and output
+import gzip
+from io import BytesIO
+import mmap
+import re
+# - streamlit (only when running inside the app, see streamlitSession) and the standard error
+import sys
 
 # Funcion definitions
 
+class Progress:
+    """
+    A class to report the progress of the processing functions
+
+    Every processing function accepts a progress object. The loops call update once per iteration, which only counts
+    and compares with a precomputed threshold; the display is refreshed by show when the progress has advanced at
+    least step (fraction of the total) and at least interval seconds have passed since the last refresh, and always at
+    the end. Subclasses override show, and start and finish if needed.
+
+    ...
+
+    Attributes
+    ----------
+    interval : float
+        The minimum time between refreshes in seconds
+
+    step : float
+        The minimum progress fraction between refreshes
+    """
+
+    def __init__(self, interval=0.2, step=0.01):
+        self.interval = interval
+        self.step = step
+        self.total, self.done, self.desc = 0, 0, ''
+        self._next, self._last = 0, 0.
+
+    def start(self, total=None, desc=''):
+        """
+        A method to start reporting a loop of total iterations
+        """
+
+        self.total, self.done, self.desc = int(total or 0), 0, desc
+        self._next = max(1, int(self.step * self.total))
+        self._last = time.perf_counter()
+
+    def update(self, n=1):
+        """
+        A method to count n iterations. It is cheap enough to be called in the hot loops
+        """
+
+        self.done += n
+        if self.done >= self._next:
+            now = time.perf_counter()
+            if now - self._last >= self.interval or self.done >= self.total:
+                self._last = now
+                self.show(self.done, self.total, self.desc)
+            self._next = self.done + max(1, int(self.step * self.total))
+
+    def finish(self):
+        """
+        A method to end reporting the current loop
+        """
+
+        if self.done < self.total:
+            self.done = self.total
+            self.show(self.done, self.total, self.desc)
+
+    def show(self, done=0, total=0, desc=''):
+        """
+        A method to display the progress, overridden by the subclasses
+        """
+
+        pass
+
+    def iterate(self, iterable=None, total=None, desc=''):
+        """
+        A method to report the progress of a loop over iterable
+
+        ...
+
+        Attributes
+        ----------
+        iterable : iterable
+            The loop iterable
+
+        total : int or None
+            The number of iterations, if iterable has no length
+
+        desc : str
+            The progress description
+
+        Returns
+        -------
+        iterator : generator
+            The items of iterable
+        """
+
+        self.start(total=len(iterable) if total is None else total, desc=desc)
+        for item in iterable:
+            yield item
+            self.update()
+        self.finish()
+
+class NullProgress(Progress):
+    """
+    A class to report no progress, at no cost: iterate returns the iterable itself
+    """
+
+    def update(self, n=1):
+        pass
+
+    def iterate(self, iterable=None, total=None, desc=''):
+        return iterable
+
+class ConsoleProgress(Progress):
+    """
+    A class to report the progress on a text stream, the standard error by default, for headless callers
+
+    ...
+
+    Attributes
+    ----------
+    stream : file object or None
+        The text stream. If None sys.stderr is used when showing
+    """
+
+    def __init__(self, interval=1., step=0.05, stream=None):
+        super().__init__(interval=interval, step=step)
+        self.stream = stream
+
+    def show(self, done=0, total=0, desc=''):
+        stream = sys.stderr if self.stream is None else self.stream
+        stream.write('%s %3d%% (%d/%d)%s' % (desc, 100 * done // max(total, 1), done, total, '\n' if done >= total else '\r'))
+        stream.flush()
+
+class StreamlitProgress(Progress):
+    """
+    A class to report the progress with a progress bar in the Streamlit app sidebar
+    """
+
+    def __init__(self, interval=0.2, step=0.01):
+        super().__init__(interval=interval, step=step)
+        self._bar = None
+
+    def start(self, total=None, desc=''):
+        super().start(total=total, desc=desc)
+        st = sys.modules['streamlit']
+        self._bar = st.sidebar.progress(0., text=desc)
+
+    def show(self, done=0, total=0, desc=''):
+        if self._bar is not None:
+            self._bar.progress(min(done / max(total, 1), 1.), text='%s %d/%d' % (desc, done, total))
+
+def streamlitSession():
+    """
+    A function to get the streamlit module when the caller runs in a Streamlit script thread, None otherwise
+
+    Inside the app streamlit is always imported, but the threads of the background jobs and their executors have no
+    ScriptRunContext: st.sidebar and st.session_state cannot be used there. The module never imports streamlit
+
+    ...
+
+    Returns
+    -------
+    st : module or None
+        The streamlit module, or None outside the app or off its script threads
+    """
+
+    st = sys.modules.get('streamlit')
+    if st is None:
+        return None
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+    except ImportError:
+        return st if threading.current_thread() is threading.main_thread() else None
+    return st if get_script_run_ctx(suppress_warning=True) is not None else None
+
+def progressReporter(progress=None):
+    """
+    A function to get the progress reporter of a processing function
+
+    ...
+
+    Attributes
+    ----------
+    progress : Progress or None
+        The progress reporter passed by the caller. If None a StreamlitProgress is used when the call comes from a
+        script thread of the app (see streamlitSession), and a NullProgress otherwise, also in the background jobs
+
+    Returns
+    -------
+    progress : Progress
+        The progress reporter
+    """
+
+    if progress is not None:
+        return progress
+    return StreamlitProgress() if streamlitSession() is not None else NullProgress()
+
 def HeaderCreator(DataOriginDateTime='', AcqType='Acquired Portal', PatientId1='', PatientId2='', LastName='', FirstName='', pxsp=[], imsz=[]):
     """
     A function to create the header of the dxf file
@@ -173,7 +382,87 @@ def HeaderCreator(DataOriginDateTime='', AcqType='Acquired Portal', PatientId1='
     return header
 
 
-def dxfWriter(Data=None, dxfFileName='Film.dxf', AcqType='Acquired Portal', PatientId1='', PatientId2='', LastName='', FirstName='', pxsp=[], imsz=[], DataOriginDateTime=''):
+# Orientations of an exported dose plane: name -> (function, whether it swaps the axes)
+ORIENTATIONS = {
+    'original' : (lambda Data: Data, False),
+    'rot90' : (lambda Data: np.rot90(Data), True),
+    'rot180' : (lambda Data: np.rot90(Data, k=2), False),
+    'rot270' : (lambda Data: np.rot90(Data, k=3), True),
+    'flip' : (lambda Data: np.fliplr(Data), False),
+    'fliprot90' : (lambda Data: np.rot90(np.fliplr(Data)), True),
+    'fliprot180' : (lambda Data: np.rot90(np.fliplr(Data), k=2), False),
+    'fliprot270' : (lambda Data: np.rot90(np.fliplr(Data), k=3), True),
+}
+
+_dxfNaN = re.compile(rb'(?<![^\t\n])nan(?=[\t\n])')
+
+def dxfDataBlocks(Data=None, blockbytes=2**16):
+    """
+    A function to format the data of a dxf file in blocks of rows
+
+    Every block is formatted by a single printf style operation with a preformatted row template, tab separated with
+    two decimals, the same text pandas to_csv writes with float_format='%.2f': NaN as an empty field, or as "" in single
+    column data, where csv quotes an empty row.
+
+    ...
+
+    Attributes
+    ----------
+    Data : 2D numpy array
+        The data to be exported
+
+    blockbytes : int
+        The approximate size of every block in bytes
+
+    Returns
+    -------
+    blocks : generator
+        The encoded blocks of rows
+    """
+
+    Data = np.asarray(Data, dtype=float)
+    nrows, ncols = Data.shape
+    rowtemplate = '\t'.join(['%.2f'] * ncols) + '\n'
+    # Approximate formatted row length, a typical dose value takes 5 characters with its separator
+    blockrows = max(1, blockbytes // max(1, 5 * ncols))
+    for r0 in range(0, nrows, blockrows):
+        block = Data[r0:r0+blockrows]
+        text = ((rowtemplate * block.shape[0]) % tuple(block.ravel().tolist())).encode('ascii')
+        if np.isnan(block).any():
+            text = _dxfNaN.sub(b'""' if ncols == 1 else b'', text)
+        yield text
+
+def dxfStreamWriter(stream=None, Data=None, header='', blockbytes=2**16):
+    """
+    A function to write a dxf file to a binary stream
+
+    ...
+
+    Attributes
+    ----------
+    stream : binary file object
+        The stream to be written in
+
+    Data : 2D numpy array
+        The data to be exported
+
+    header : str
+        The header of the dxf file, as returned by HeaderCreator
+
+    blockbytes : int
+        The approximate size of every data block in bytes
+
+    Returns
+    -------
+    No value returned
+    """
+
+    stream.write(header.encode('utf-8'))
+    for block in dxfDataBlocks(Data=Data, blockbytes=blockbytes):
+        stream.write(block)
+
+def dxfWriter(Data=None, dxfFileName='Film.dxf', AcqType='Acquired Portal', PatientId1='', PatientId2='', LastName='', FirstName='', pxsp=[], imsz=[], DataOriginDateTime='',
+              compress=None, spool=False, orientations=None, blockbytes=2**16):
     """
     A function to write the dxf file
 
@@ -184,8 +473,8 @@ def dxfWriter(Data=None, dxfFileName='Film.dxf', AcqType='Acquired Portal', Pati
     Data : 2D numpy array
         The data to be exported
 
-    dxfFileName : str or Path
-        The path file to be written in
+    dxfFileName : str, Path or binary file object
+        The path file or the stream to be written in
 
     AcqType : str
         The type of the orgin data: acquired or predicted
@@ -211,20 +500,216 @@ def dxfWriter(Data=None, dxfFileName='Film.dxf', AcqType='Acquired Portal', Pati
     DataOriginDateTime: str
         The date and time creation of the data origin
 
+    compress : str or None
+        'gzip' to write a gzip compressed file, None to write plain text
+
+    spool : bool
+        If True every file is assembled in a spooled temporary file (in memory up to 16 blocks, 1 MB by default) and then copied to its
+        destination in a single sequential write, which suits slow network shares
+
+    orientations : dict or None
+        The orientations to be exported in the same call, name (a key of ORIENTATIONS) -> path file or stream. The pixel
+        spacing and image size are swapped for the orientations that swap the axes. If None only Data is written to dxfFileName
+
+    blockbytes : int
+        The approximate size of every formatted data block in bytes
+
      Returns
     -------
         No data returned on exit
     """
 
-    with open(dxfFileName, 'w') as dxf:
-        # Write the header
-        header = HeaderCreator(DataOriginDateTime=DataOriginDateTime, AcqType=AcqType, PatientId1=PatientId1, PatientId2=PatientId2, LastName=LastName, FirstName=FirstName, pxsp=pxsp, imsz=imsz)
-        for line in header:
-            dxf.write(line)
+    targets = {'original' : dxfFileName} if orientations is None else orientations
+    for orientation, target in targets.items():
+        orient, swap = ORIENTATIONS[orientation]
+        opxsp, oimsz = (list(pxsp)[::-1], list(imsz)[::-1]) if swap else (pxsp, imsz)
+        header = HeaderCreator(DataOriginDateTime=DataOriginDateTime, AcqType=AcqType, PatientId1=PatientId1, PatientId2=PatientId2, LastName=LastName, FirstName=FirstName, pxsp=opxsp, imsz=oimsz)
+
+        tostream = hasattr(target, 'write')
+        with ExitStack() as stack:
+            out = target if tostream else stack.enter_context(open(target, 'wb'))
+            dest = stack.enter_context(tempfile.SpooledTemporaryFile(max_size=16*blockbytes)) if spool else out
+            sink = stack.enter_context(gzip.GzipFile(fileobj=dest, mode='wb')) if compress == 'gzip' else dest
+            dxfStreamWriter(stream=sink, Data=orient(Data), header=header, blockbytes=blockbytes)
+            if sink is not dest:
+                sink.close()
+            if spool:
+                dest.seek(0)
+                shutil.copyfileobj(dest, out, blockbytes)
+
+_dxfEmpty = re.compile(rb'(?<![^\t\n])(?=[\t\r\n])')
+
+def dxfHeaderParser(text=''):
+    """
+    A function to parse the header of a dxf file
+
+    ...
+
+    Attributes
+    ----------
+    text : str
+        The header of the dxf file, up to the [Data] line
+
+    Returns
+    -------
+    header : dict
+        The header values by section and key, as strings: header['Geometry']['Res1']
+    """
+
+    header = {}
+    section = header.setdefault('', {})
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('[') and line.endswith(']'):
+            section = header.setdefault(line[1:-1], {})
+        elif '=' in line:
+            key, value = line.split('=', 1)
+            section[key.strip()] = value.strip()
+    if not header['']:
+        del header['']
+    return header
+
+def dxfDataBlock(block=b''):
+    """
+    A function to parse a block of whole rows of the data of a dxf file, the empty fields (and the quoted empty rows of
+    single column data) are read as NaN
+
+    ...
+
+    Attributes
+    ----------
+    block : bytes
+        Tab separated rows
+
+    Returns
+    -------
+    Data : 2D numpy array
+        The parsed rows
+    """
+
+    try:
+        return np.loadtxt(BytesIO(block), delimiter='\t', dtype=float, ndmin=2)
+    except ValueError:
+        block = block if block.endswith(b'\n') else block + b'\n'
+        return np.loadtxt(BytesIO(_dxfEmpty.sub(b'nan', block.replace(b'""', b''))), delimiter='\t', dtype=float, ndmin=2)
+
+def dxfReader(dxfFileName='Film.dxf', chunkbytes=2**24, progress=None):
+    """
+    A function to read a dxf file
+
+    Plain files are memory mapped and parsed in chunks of whole rows into a preallocated array, so the memory needed is
+    the one of the array plus a chunk. The shape is taken from the data itself, gzip compressed files are also accepted.
+
+    ...
+
+    Attributes
+    ----------
+    dxfFileName : str, Path or binary file object
+        The path file or the stream to be read
+
+    chunkbytes : int
+        The approximate size in bytes of every parsed chunk
+
+    progress : Progress or None
+        The progress reporter of the chunk loop. If None no progress is reported
+
+    Returns
+    -------
+    header : dict
+        The header values by section and key, as returned by dxfHeaderParser
+
+    Data : 2D numpy array
+        The data, a row for every line of the file
+    """
+
+    progress = progressReporter(progress)
+    with ExitStack() as stack:
+        if hasattr(dxfFileName, 'read'):
+            buf = dxfFileName.read()
+        else:
+            f = stack.enter_context(open(dxfFileName, 'rb'))
+            buf = f.read(2) if os.fstat(f.fileno()).st_size else b''
+            if buf == b'\x1f\x8b':
+                f.seek(0)
+                buf = gzip.GzipFile(fileobj=f, mode='rb').read()
+            elif buf:
+                buf = stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        if buf[:2] == b'\x1f\x8b':
+            buf = gzip.decompress(buf)
+
+        marker = buf.find(b'[Data]')
+        if marker < 0:
+            raise ValueError('No [Data] section in the dxf file')
+        start = buf.find(b'\n', marker) + 1 or len(buf)
+        header = dxfHeaderParser(bytes(buf[:marker]).decode('utf-8'))
+
+        # Data extent without the trailing line ends
+        end = len(buf)
+        while end > start and buf[end-1:end] in (b'\n', b'\r'):
+            end -= 1
+        if end == start:
+            return header, np.empty((0, 0))
+
+        # Shape: fields of the first line by number of lines
+        first = buf.find(b'\n', start, end)
+        first = end if first < 0 else first
+        ncols = bytes(buf[start:first]).count(b'\t') + 1
+        nrows = 1
+        for c0 in range(start, end, chunkbytes):
+            view = np.frombuffer(buf, dtype=np.uint8, count=min(chunkbytes, end - c0), offset=c0)
+            nrows += int(np.count_nonzero(view == 10))
+            del view
+
+        Data = np.empty((nrows, ncols))
+        row, c0 = 0, start
+        progress.start(end - start)
+        while c0 < end:
+            c1 = end if end - c0 <= chunkbytes else buf.rfind(b'\n', c0, c0 + chunkbytes) + 1
+            if c1 <= c0:
+                c1 = buf.find(b'\n', c0 + chunkbytes, end) + 1 or end
+            block = dxfDataBlock(bytes(buf[c0:c1]))
+            if block.shape[1] != ncols or row + block.shape[0] > nrows:
+                raise ValueError('Inconsistent number of fields in the dxf data from row %d' % row)
+            Data[row:row+block.shape[0]] = block
+            row += block.shape[0]
+            progress.update(c1 - c0)
+            c0 = c1
+        progress.finish()
+        del buf
+    return header, Data[:row]
+
+def dxfDoseFrame(header=None, Data=None):
+    """
+    A function to get the dose distribution of a dxf file as the analysis page uses it
+
+    The planner dose planes (Predicted Portal) are written by dcm2dxf with a row of the DataFrame for every line, the
+    film dose planes (Acquired Portal) are written transposed. Res1 is the spacing of the DataFrame index in both cases.
+
+    ...
+
+    Attributes
+    ----------
+    header : dict
+        The header values by section and key, as returned by dxfReader
+
+    Data : 2D numpy array
+        The data, as returned by dxfReader
+
+    Returns
+    -------
+    Ddf : DataFrame
+        The dose distribution with y [mm] as index and x [mm] as columns
+
+    pxsp : list
+        The pixel spacing in mm
+    """
 
-        df = pd.DataFrame(Data)
-        # Write the data
-        df.to_csv(dxf, sep='\t', header=False, index=False, float_format='%.2f')
+    pxsp = [float(header['Geometry']['Res1']), float(header['Geometry']['Res2'])]
+    if header.get('Interpretation', {}).get('Type') == 'Acquired Portal':
+        Data = np.transpose(Data)
+    ya = np.linspace(0, (Data.shape[0]-1)*pxsp[0], Data.shape[0])
+    xa = np.linspace(0, (Data.shape[1]-1)*pxsp[1], Data.shape[1])
+    return pd.DataFrame(data=Data, index=ya, columns=xa), pxsp
 
 def dcm2dxf(dcmf=None, config=None):
     """
@@ -328,7 +813,7 @@ def iratf(d, a, b, c):
 
     return (a - c * 10**-d)/(10**-d - b)
 
-def coordOAC(imfile=None, bbfile='./tmp/bb.csv'):
+def coordOAC(imfile=None, bbfile=None, workspace=None):
     """
     A function to calculate the relavant coordiantes for the off-axis spatial correction
 
@@ -336,10 +821,12 @@ def coordOAC(imfile=None, bbfile='./tmp/bb.csv'):
 
     Attributes
     ----------
-    imfile : str
-        The name of the image file, the file containing the scanned image of the dose distribution, the calibration strip and the base strip in TIFF format.
-    bbfile : str
-        the name of the bounding box file, the file containing the position and size of the bounding boxes of the image file. It should be a csv file.
+    imfile : str or ScanImage
+        The name of the image file, the file containing the scanned image of the dose distribution, the calibration strip and the base strip in TIFF format, or the scan returned by segRegs.
+    bbfile : str or None
+        the name of the bounding box file, the file containing the position and size of the bounding boxes of the image file. It should be a csv file. If None the bb.csv file of the workspace, ./tmp/bb.csv without a workspace.
+    workspace : Workspace or None
+        The workspace of the session or job
 
     Returns
     -------
@@ -347,7 +834,8 @@ def coordOAC(imfile=None, bbfile='./tmp/bb.csv'):
         A pandas DataFrame containing the relavant coordiantes for the off-axis spatial correction
 
     """
-    bbdf = pd.read_csv(bbfile)
+    bbfile = workspaceFile(workspace, 'bb.csv', './tmp/bb.csv') if bbfile is None else bbfile
+    bbdf = imfile.bbdf if isinstance(imfile, ScanImage) else pd.read_csv(bbfile)
 
     creg = bbdf.loc[bbdf.label == 'Center'] # Image center
     o = creg.left.values[0] + int(creg.width.values[0]/2)
@@ -363,6 +851,34 @@ def coordOAC(imfile=None, bbfile='./tmp/bb.csv'):
 
     return lcdf
 
+def colsDistances(ccdf=None, ncols=None):
+    """
+    A function to calculate the distances to the scanner axis of the film columns and of the calibration strip
+
+    ...
+
+    Attributes
+    ----------
+    ccdf : pandas DataFrame
+        A data structure containing the relevant geometric parameters for the spatial correction, as returned by coordOAC
+
+    ncols : int
+        The number of columns of the film dose region
+
+    Returns
+    -------
+    xl : 1D numpy array
+        The distance of every column to the scanner axis in inches
+
+    xc : float
+        The distance of the calibration strip to the scanner axis in inches
+    """
+
+    o, c, p0, s = [float(ccdf[k].values[0]) for k in ('o', 'c', 'p0', 's')]
+    xl = np.abs(o - (p0 + np.arange(ncols))) * s / 25.4
+    xc = np.abs(o - c) * s / 25.4
+    return xl, xc
+
 def TIFFPixelSpacing(imfile=None):
     """
     A function to get the pixel spacing from the TIFF file
@@ -371,8 +887,8 @@ def TIFFPixelSpacing(imfile=None):
 
     Attributes
     ----------
-    imfile : str
-        The name of the scan image with the measured dose distribution, the calibration strip and the background patch
+    imfile : str or ScanImage
+        The name of the scan image with the measured dose distribution, the calibration strip and the background patch, or the scan already read
 
      Returns
     -------
@@ -380,6 +896,8 @@ def TIFFPixelSpacing(imfile=None):
         A list with the X and Y pixel spacing in mm
     """
 
+    if isinstance(imfile, ScanImage):
+        return list(imfile.pxsp)
     with TiffFile(imfile) as tif:
         page_tags = tif.pages[0].tags
     xres = page_tags['XResolution'].value
@@ -409,327 +927,570 @@ def DoseImageSize(im=None):
     return imsz
 
 
-def segRegs(imfile=None, bbfile='tmp/bb.csv'):
+def scanArray(imfile=None):
     """
-    A function to segment the film image
+    A function to open a scanned image without reading it
+
+    Uncompressed scans, as the scanner software writes them, are memory mapped. Other scans are accessed through zarr
+    when it is installed, so only the strips or tiles that are sliced are decoded, and read whole otherwise.
 
     ...
 
     Attributes
     ----------
-    imfile : str
-        The name of the image file, the file containing the scanned image of the dose distribution, the calibration strip and the base strip in TIFF format.
-    bbfile : str
-        The name of the bounding box file, the file containing the position and size of the bounding boxes of the image file. It should be a csv file.
+    imfile : str or Path
+        The name of the image file
 
     Returns
     -------
-    No value returned
-
+    im : numpy memmap, zarr array or numpy array
+        The scanned image, shape (rows, columns, channels). Slicing it reads only the sliced part, except when it is
+        a plain numpy array
     """
-    # Leer el archivo de regiones de interes y generar un dataframe con las coordenas y dimensiones de las regiones
-    bbdf = pd.read_csv(bbfile)
-    # Nombre del archivo de imagen
-    filename = Path(imfile)
-    # Segmentar el archivo de imagen
-    im = imread(imfile)
-    for r in ['Film', 'Calibration', 'Background', 'Center']:
-        reg = bbdf.loc[bbdf.label == r]
-        rim = im[reg.top.values[0]:reg.top.values[0]+reg.height.values[0], reg.left.values[0]:reg.left.values[0]+reg.width.values[0], :]
-        # Leer los metadatos del archivo de imagen
-        with TiffFile(imfile) as tif:
-            page_tags = tif.pages[0].tags
-            # Guardar cada regiÃ³n un archivo
-            # Extratags
-            metadata_tag = dumps({"PatientId": '001PATFILM', "PatientName": 'Prueba', 'PatientFamilyName' : 'PelÃ­culas', 'Sex' : 'Male'})
-            extra_tags = [("MicroManagerMetadata", 's', 0, metadata_tag, True),
-                          ('Make', 's', 0, page_tags['Make'].value, True),
-                          ('Model', 's', 0, page_tags['Model'].value, True),
-                          ('DateTime', 's', 0, page_tags['DateTime'].value, True),
-                          ("ProcessingSoftware", 's', 0, "pyFilmQAModule", True)]
-            timwrite(filename.with_suffix('.' + str(r) + '.tif'), rim, extratags=extra_tags)
-
-def baseDetermination(imfile=None, config=None):
+
+    with TiffFile(imfile) as tif:
+        memmappable = len(tif.series[0].pages) == 1 and tif.pages[0].is_memmappable
+    if memmappable:
+        return tmemmap(imfile, mode='r')
+    try:
+        import zarr
+    except ImportError:
+        return timread(imfile)
+    return zarr.open(timread(imfile, aszarr=True), mode='r')
+
+def scanPreview(imfile=None, maxsize=2048, method='mean', bandrows=64, step=None):
     """
-    A function to calculate the base value in every color channel
+    A function to get a reduced preview of a scanned image without loading the whole scan
+
+    The scan is reduced by an integer step so that its largest side does not exceed maxsize. Every preview pixel is
+    the mean of a step x step block of the scan, read in bands of rows, or a single pixel with method='stride'.
 
     ...
 
     Attributes
-    ---------
-    imfile : str
-        The name of the image file, the file containing the scanned image of the dose distribution, the calibration strip and the base strip in TIFF format.
-
-    config : ConfigParser
-        An object with the functionalities of the configparser module
-
-    Returns
-    -------
-    imbase : float64 numpy array
-        An array containing the value of the base digital signal in every color channel.
+    ----------
+    imfile : str or Path
+        The name of the image file
 
-    """
-    # Derivar el nombre del archivo de fondo
-    bkgfilename = Path(imfile)
-    bkgfilename = bkgfilename.with_suffix('.Background.tif')
-    # Leer la imagen de fondo
-    fim = imread(bkgfilename)
-    # Tomar el valor del margen del arhivo de configuraciÃ³n
-    mrg = int(config['Base']['margin'])
-    # Tomar la parte central
-    fim = fim[mrg:-mrg, mrg:-mrg, :]
-    # Devolver el valor del fondo en cada canal
-    return np.log10(2**16/fim.mean(axis=(0,1)))
+    maxsize : int
+        The maximum size of the preview in pixels
 
-def nlmf(imfile=None, config=None):
-    """
-    A function to denoise a multichannel image using a non-local means procedure.
+    method : str
+        'mean' for block means, 'stride' for strided reads
 
-    imfile : str
-        The name of the image file, the file containing the image to be denoised.
+    bandrows : int
+        The number of preview rows computed from every band of the scan
 
-    config : ConfigParser
-        An object with the functionalities of the configparser module
+    step : int or None
+        The reduction step. If None it is chosen from maxsize
 
     Returns
     -------
-    udim = unsigned int numpy array
-        A numpy array of unsigned ints with shape (xpixels, ypixels, channels)
-    """
-    im = imread(imfile)
-    fim=img_as_float(im)
-    dim=denoise_nl_means(fim,
-                         patch_size = int(config['NonLocalMeans']['PatchSize']),
-                         patch_distance = int(config['NonLocalMeans']['PatchDistance']),
-                         h=float(config['NonLocalMeans']['h']),
-                         channel_axis=int(config['NonLocalMeans']['ChannelAxis']))
-    udim=img_as_uint(dim)
+    preview : 3D numpy array
+        The preview, with the scan dtype
 
-    return udim
+    step : int
+        The reduction step, a preview pixel (i, j) covers the scan pixels from (i*step, j*step)
+    """
 
-def iratf(d, a, b, c):
+    im = scanArray(imfile)
+    nrows, ncols = im.shape[:2]
+    step = max(1, -(-max(nrows, ncols) // maxsize)) if step is None else int(step)
+    if method == 'stride' or step == 1:
+        return np.asarray(im[::step, ::step]), step
+
+    cols = np.arange(0, ncols, step)
+    colcounts = np.diff(np.append(cols, ncols))
+    preview = np.empty((-(-nrows // step), len(cols)) + tuple(im.shape[2:]), dtype=im.dtype)
+    for p0 in range(0, preview.shape[0], bandrows):
+        band = np.asarray(im[p0*step:(p0+bandrows)*step])
+        rows = np.arange(0, band.shape[0], step)
+        rowcounts = np.diff(np.append(rows, band.shape[0]))
+        sums = np.add.reduceat(np.add.reduceat(band, rows, axis=0, dtype=np.float64), cols, axis=1)
+        counts = np.multiply.outer(rowcounts, colcounts).reshape(sums.shape[:2] + (1,) * (sums.ndim - 2))
+        preview[p0:p0+len(rows)] = np.rint(sums/counts)
+    return preview, step
+
+class ScanImage:
     """
-    The calibration function following a sensitometric model bases in rational functions
+    A class to represent a scanned film image and its labelled regions
+
+    The scan is opened once. The regions are views of it, not copies, and the resolution and the tags are read with the
+    image, so every processing stage takes its region from here instead of reading a region file.
 
     ...
 
     Attributes
     ----------
-    d : float64
-        Optical density as measured by the scanner
+    imfile : Path
+        The name of the image file
 
-    a : float64
-        First rational function parameter
+    bbdf : pandas DataFrame
+        The bounding boxes of the regions (label, left, top, width, height)
 
-    b : float64
-        Second rational function parameter
+    im : 3D numpy memmap or array
+        The scanned image, opened by scanArray: only the regions are read from disk
 
-    c : float64
-        Third rational function parameter
+    tags : dict
+        The TIFF tags of the scan needed downstream (Make, Model, DateTime, XResolution, YResolution)
 
-    Returns
-    -------
-    D : float64
-        The abosrbed dose D corresponding to the optical density d in each channel following the sensitometry model based on rational functions
+    dpi : list
+        The X and Y resolution in dots per inch
 
+    pxsp : list
+        The X and Y pixel spacing in mm
+
+    regions : dict
+        The labelled regions, label -> view of im (a decoded copy of the region for compressed scans)
+
+    workspace : Workspace or None
+        The workspace of the bounding box file and the region files. If None they are next to the scan and in tmp
     """
 
-    return (a - c * 10**-d)/(10**-d - b)
+    LABELS = ['Film', 'Calibration', 'Background', 'Center']
+    TAGS = ['Make', 'Model', 'DateTime', 'XResolution', 'YResolution']
 
-def readCalParms(config=None):
+    def __init__(self, imfile=None, bbfile=None, bbdf=None, workspace=None):
+        self.imfile = Path(imfile)
+        self.workspace = workspace
+        bbfile = workspaceFile(workspace, 'bb.csv', 'tmp/bb.csv') if bbfile is None else bbfile
+        self.bbdf = pd.read_csv(bbfile) if bbdf is None else bbdf
+        with TiffFile(imfile) as tif:
+            page_tags = tif.pages[0].tags
+            self.tags = {name : page_tags[name].value for name in self.TAGS if name in page_tags}
+        self.im = scanArray(imfile)
+        self.dpi = [res[0]/res[1] for res in (self.tags['XResolution'], self.tags['YResolution'])]
+        inch = 25.4 # mm
+        self.pxsp = [inch/dpi for dpi in self.dpi]
+        self.regions = {}
+        for r in self.LABELS:
+            reg = self.bbdf.loc[self.bbdf.label == r]
+            if len(reg):
+                top, left = reg.top.values[0], reg.left.values[0]
+                self.regions[r] = np.asarray(self.im[top:top+reg.height.values[0], left:left+reg.width.values[0], :])
+
+    def region(self, label=None):
+        """
+        A method to get a labelled region
+
+        ...
+
+        Attributes
+        ----------
+        label : str
+            The region label: Film, Calibration, Background or Center
+
+        Returns
+        -------
+        rim : 3D numpy array
+            The region, a view of the scan
+        """
+
+        return self.regions[label]
+
+    def save(self, labels=None):
+        """
+        A method to write the regions in TIFF files named after the scan and the label (Film.Calibration.tif), in the
+        workspace if any
+
+        ...
+
+        Attributes
+        ----------
+        labels : list or None
+            The regions to be written. If None every labelled region is written
+
+        Returns
+        -------
+        regfilenames : list
+            The written files
+        """
+
+        # Extratags
+        metadata_tag = dumps({"PatientId": '001PATFILM', "PatientName": 'Prueba', 'PatientFamilyName' : 'PelÃ­culas', 'Sex' : 'Male'})
+        extra_tags = [("MicroManagerMetadata", 's', 0, metadata_tag, True),
+                      ('Make', 's', 0, self.tags.get('Make', ''), True),
+                      ('Model', 's', 0, self.tags.get('Model', ''), True),
+                      ('DateTime', 's', 0, self.tags.get('DateTime', ''), True),
+                      ("ProcessingSoftware", 's', 0, "pyFilmQAModule", True)]
+        regfilenames = []
+        for r in (self.regions if labels is None else labels):
+            regfilename = regionFile(self.imfile, r, workspace=self.workspace)
+            timwrite(regfilename, self.regions[r], extratags=extra_tags)
+            regfilenames.append(regfilename)
+        return regfilenames
+
+def regionFile(imfile=None, label=None, workspace=None):
     """
-    A function to read the established standard calibration parameters for the EBT3 film measured by the Microtek 1000 XL scanner
+    A function to get the region file of a scan
 
     ...
 
     Attributes
     ----------
-    config : ConfigParser
-        An object with the functionalities of the configparser module
+    imfile : str or Path
+        The name of the image file
+
+    label : str
+        The region label: Film, Calibration, Background or Center
+
+    workspace : Workspace or None
+        The workspace of the region files. If None the file is next to the scan
 
     Returns
     -------
-    caldf : DataFrame
-        A pandas DataFrame with the calibration parameters for every color channel (multiphase model)
-
+    regfilename : Path
+        The region file, <scan>.<label>.tif
     """
 
-    configpath = config['DEFAULT']['configpath']
-    modelsfile = config['Models']['File']
-    modelsheet = config['Models']['mphSheet']
-
-    caldf = pd.read_excel(configpath + modelsfile, sheet_name=modelsheet)
-    caldf.set_index('Unnamed: 0', inplace=True)
-    caldf.index.names = ['ch']
-    return caldf
+    return workspaceFile(workspace, Path(imfile).stem + '.' + label + '.tif', Path(imfile).with_suffix('.' + label + '.tif'))
 
-def readRatParms(config=None):
+def scanRegion(imfile=None, label=None, workspace=None):
     """
-    A function to read a standard calibration set of parameters following the rational model for the EBT3 film measured by the Microtek 1000 XL scanner
+    A function to get a labelled region of a scan, from the scan itself or from its region file
 
     ...
 
     Attributes
     ----------
-    config : ConfigParser
-        An object with the functionalities of the configparser module
+    imfile : str or ScanImage
+        The name of the image file, whose region files were written by segRegs, or the scan already read
+
+    label : str
+        The region label: Film, Calibration, Background or Center
+
+    workspace : Workspace or None
+        The workspace of the region files when imfile is a file name. If None they are read next to the scan
 
     Returns
     -------
-    ratdf : DataFrame
-        A pandas DataFrame with the calibration parameters for every color channel (rational model)
-
+    rim : 3D numpy array
+        The region
     """
 
-    configpath = config['DEFAULT']['configpath']
-    modelsfile = config['Models']['File']
-    modelsheet = config['Models']['racSheet']
-    ratdf = pd.read_excel(configpath + modelsfile, sheet_name=modelsheet)
-    ratdf.set_index('Unnamed: 0', inplace=True)
-    ratdf.index.names = ['ch']
-    return ratdf
+    if isinstance(imfile, ScanImage):
+        return imfile.region(label)
+    return imread(regionFile(imfile, label, workspace=workspace))
 
-def rootcalf(D, d, f, phir, kr, phib, kb):
+def segRegs(imfile=None, bbfile=None, save=True, bbdf=None, workspace=None):
     """
-    An internal module use function.
-    It expresses the nonlinear equation to get the absorbed dose D from the optical density d using the multiphase model
+    A function to segment the film image
 
     ...
 
+    Attributes
+    ----------
+    imfile : str
+        The name of the image file, the file containing the scanned image of the dose distribution, the calibration strip and the base strip in TIFF format.
+    bbfile : str or None
+        The name of the bounding box file, the file containing the position and size of the bounding boxes of the image file. It should be a csv file. If None the bb.csv file of the workspace, tmp/bb.csv without a workspace.
+    save : bool
+        If True every region is also written in a TIFF file named after the scan and the label
+    bbdf : pandas DataFrame or None
+        The bounding boxes, as returned by detectRegions. If given bbfile is not read
+    workspace : Workspace or None
+        The workspace of the session or job, where the bounding box file is read and the region files are written
 
     Returns
     -------
-    rootcalf : float64
-        The difference between the measured optical density d and the optical density as calculated for the multiphase model for the absorbed dose D
+    scan : ScanImage
+        The scan with its labelled regions, to be passed to the following processing stages
 
     """
+    scan = ScanImage(imfile=imfile, bbfile=bbfile, bbdf=bbdf, workspace=workspace)
+    if save:
+        scan.save()
+    return scan
 
-    return d - calf(D, f, phir, kr, phib, kb)
-
-def icalf(d, Dsem, f, phir, kr, phib, kb):
+def regionComponents(mask=None, minarea=0):
     """
-    The calibration function following the multiphase model
+    A function to get the connected components of a binary image with their bounding box and area
 
     ...
 
     Attributes
     ----------
-    d : float64
-        The measured optical density
-    Dsem : float64
-        A seed value of the absorbed D to solve the nonlinear equation
-    f : float64
-        The base optical density
-
-    phir : float64
-        The relative abundance of the red phase polymer
+    mask : 2D bool numpy array
+        The binary image
 
-    kr : float64
-        The exponent in the saturation term of the red phase polymer
-
-    phib : float64
-        The relative abundance of the blue phase polymer
-
-    kb : float64
-        The exponent in the saturation term of the blue phase polymer
+    minarea : int
+        The minimum area of the components in pixels
 
     Returns
     -------
-    D : float64
-        The calculated absorbed dose D corresponding to the measured optical density d
+    lab : 2D int numpy array
+        The labelled image
 
+    comps : list
+        A dict for every component: label, sl (the bounding box slices), area, top, left, height and width
     """
 
-    return fsolve(rootcalf, Dsem, (d, *[f, phir,  kr, phib, kb]))[0]
-
-def Ricalf(d, rcalps, rratps):
+    lab, _n = ndi.label(mask)
+    areas = np.bincount(lab.ravel())
+    comps = []
+    for i, sl in enumerate(ndi.find_objects(lab), 1):
+        if sl is None or areas[i] < minarea:
+            continue
+        comps.append({'label' : i, 'sl' : sl, 'area' : int(areas[i]),
+                      'top' : sl[0].start, 'left' : sl[1].start,
+                      'height' : sl[0].stop - sl[0].start, 'width' : sl[1].stop - sl[1].start})
+    return lab, comps
+
+def rulerMask(g=None, level=None):
     """
-    The calibration function following the multiphase model for the red channel
+    A function to find the scanner ruler: the rows and columns dark across most of the scan
 
     ...
 
     Attributes
     ----------
-    d : float64
-        The measured optical density
+    g : 2D numpy array
+        The gray scan
 
-    rcalps : 1D numpy array
-        The current scan calibration parameters for the red channel
-
-    rratps : 1D numpy array
-        The current scan calibration rational approximation for the red channel
+    level : float
+        The gray level of the scanner lid
 
     Returns
     -------
-    D : float64
-        The calculated absorbed dose D corresponding to the measured optical density d for the red channel
+    ruler : 2D bool numpy array
+        The ruler pixels
+
+    rulerrows : 1D bool numpy array
+        The ruler rows
 
+    rulercols : 1D bool numpy array
+        The ruler columns
     """
-    return icalf(d, iratf(d, *rratps), *rcalps)
 
-Ricalfv = np.vectorize(Ricalf, excluded={1, 2})
+    black = g < 0.3*level
+    rulerrows = black.mean(axis=1) > 0.5
+    rulercols = black.mean(axis=0) > 0.5
+    ruler = np.zeros(g.shape, dtype=bool)
+    ruler[rulerrows, :] = True
+    ruler[:, rulercols] = True
+    return ruler, rulerrows, rulercols
 
-def Gicalf(d, gcalps, gratps):
+def refineEdges(im=None, box=None, step=1, thr=None, rulerrows=None, rulercols=None):
     """
-    The calibration function following the multiphase model for the green channel
+    A function to refine the edges of a film piece box found on a preview
+
+    Every edge is searched at full resolution in a band of 2*step pixels around it, across the central half of the box:
+    the edge is the first (or last) line of the band with most of its pixels below the threshold.
 
     ...
 
     Attributes
     ----------
-    d : float64
-        The measured optical density
+    im : 3D numpy memmap or array
+        The scanned image, as returned by scanArray
 
-    gcalps : 1D numpy array
-        The current scan calibration parameters for the green channel
+    box : list
+        The box in scan pixels: top, left, height and width
 
-    gratps : 1D numpy array
-        The current scan calibration rational approximation for the green channel
+    step : int
+        The reduction step of the preview
+
+    thr : float
+        The gray level threshold of the film pieces
 
+    rulerrows : 1D bool numpy array
+        The ruler rows of the scan, never part of a film piece
+
+    rulercols : 1D bool numpy array
+        The ruler columns of the scan
 
     Returns
     -------
-    D : float64
-        The calculated absorbed dose D corresponding to the measured optical density d for the green channel
-
+    box : list
+        The refined box: top, left, height and width
     """
 
-    return icalf(d, iratf(d, *gratps), *gcalps)
-
-Gicalfv = np.vectorize(Gicalf, excluded={1, 2})
-
-def Bicalf(d, bcalps, bratps):
+    top, left, height, width = box
+    bottom, right = top + height, left + width
+    nrows, ncols = im.shape[:2]
+
+    def darkLines(r0, r1, c0, c1, axis):
+        band = np.asarray(im[r0:r1, c0:c1], dtype=np.float32)
+        band = band.mean(axis=2) if band.ndim == 3 else band
+        lines = (band < thr).mean(axis=axis) > 0.5
+        return lines & ~(rulerrows[r0:r1] if axis == 1 else rulercols[c0:c1])
+
+    rq0, rq1 = top + height//4, top + (3*height)//4 + 1
+    cq0, cq1 = left + width//4, left + (3*width)//4 + 1
+    r0 = max(0, top - step)
+    lines = darkLines(r0, min(nrows, top + step), cq0, cq1, axis=1)
+    ntop = r0 + int(np.argmax(lines)) if lines.any() else top
+    r0 = max(0, bottom - step)
+    lines = darkLines(r0, min(nrows, bottom + step), cq0, cq1, axis=1)
+    nbottom = r0 + len(lines) - int(np.argmax(lines[::-1])) if lines.any() else bottom
+    c0 = max(0, left - step)
+    lines = darkLines(rq0, rq1, c0, min(ncols, left + step), axis=0)
+    nleft = c0 + int(np.argmax(lines)) if lines.any() else left
+    c0 = max(0, right - step)
+    lines = darkLines(rq0, rq1, c0, min(ncols, right + step), axis=0)
+    nright = c0 + len(lines) - int(np.argmax(lines[::-1])) if lines.any() else right
+    return [ntop, nleft, nbottom - ntop, nright - nleft]
+
+def detectRegions(imfile=None, bbfile=None, config=None, maxsize=1024, preview=None, step=None, lidfraction=0.9, aspect=3., minfraction=0.005, bkgfraction=None):
     """
-    The calibration function following the multiphase model for the blue channel
+    A function to propose the Film, Calibration, Background and Center regions of a scan
+
+    The scan is reduced to a preview, the films are separated from the scanner lid by a threshold below its level and from the
+    scanner ruler by rulerMask. The elongated film pieces are the strips: the darker one is the calibration strip and
+    the lighter one holds the background region, its central part. The largest remaining piece is the film. The center
+    is the largest compact bright mark on the ruler. Without a mark no Center is proposed: a guessed one would feed the
+    lateral correction unnoticed, so the caller must report it and have the Center labelled by hand. The film and strip
+    boxes are refined on the scan at full resolution.
 
     ...
 
     Attributes
     ----------
-    d : float64
-        The measured optical density
+    imfile : str or Path
+        The name of the image file
 
-    bcalps : 1D numpy array
-        The current scan calibration parameters for the blue channel
+    bbfile : str, Path or None
+        The bounding box file to be written, in the format of the labelling page. If None it is not written
 
-    bratps : 1D numpy array
-        The current scan calibration rational approximation for the blue channel
+    config : ConfigParser
+        An object with the functionalities of the configparser module. [Segmentation] bkgfraction is the default
+        bkgfraction
+
+    maxsize : int
+        The maximum size of the preview in pixels
+
+    preview : 3D numpy array or None
+        A preview of the scan, as returned by scanPreview. If None a strided preview is read
 
+    step : int or None
+        The reduction step of the preview. If None with a given preview, the preview is taken at full resolution (1)
+
+    lidfraction : float
+        The threshold of the film pieces, as a fraction of the scanner lid level (the 99th percentile of the scan)
+
+    aspect : float
+        The minimum length to width ratio of the strips
+
+    minfraction : float
+        The minimum area of a film piece, as a fraction of the preview area
+
+    bkgfraction : float or None
+        The fraction of the width and length of the background strip taken as background region. If None the
+        [Segmentation] bkgfraction value
 
     Returns
     -------
-    D : float64
-        The calculated absorbed dose D corresponding to the measured optical density d for the blue channel
+    bbdf : pandas DataFrame
+        The proposed bounding boxes in scan pixels, columns left, width, top, height and label. There is no Center row
+        when the ruler has no center mark
+    """
 
+    bkgfraction = float(config['Segmentation']['bkgfraction']) if bkgfraction is None else bkgfraction
+    if preview is None:
+        preview, step = scanPreview(imfile, maxsize=maxsize, method='stride')
+    step = 1 if step is None else int(step)
+    g = np.asarray(preview, dtype=float)
+    g = g.mean(axis=2) if g.ndim == 3 else g
+    nrows, ncols = g.shape
+
+    # Films and ruler against the scanner lid
+    lid = np.percentile(g, 99)
+    thr = lidfraction*lid
+    dark = g < thr
+
+    # Scanner ruler
+    ruler, rulerrows, rulercols = rulerMask(g, lid)
+
+    # Film pieces
+    pieces = ndi.binary_opening(dark & ~ruler, structure=np.ones((3, 3)))
+    lab, comps = regionComponents(pieces, minarea=minfraction*nrows*ncols)
+    for comp in comps:
+        comp['mean'] = g[comp['sl']][lab[comp['sl']] == comp['label']].mean()
+    strips = [comp for comp in comps if max(comp['height'], comp['width']) >= aspect*min(comp['height'], comp['width'])]
+    films = [comp for comp in comps if comp not in strips]
+    if not films or not strips:
+        raise ValueError('Film pieces not found in the scan: %d films and %d strips' % (len(films), len(strips)))
+    if len(strips) == 1:
+        # The background region is taken from an unirradiated strip, the calibration strip alone is not enough
+        raise ValueError('Background strip not found in the scan: a single strip')
+    film = max(films, key=lambda comp: comp['area'])
+    strips = sorted(strips, key=lambda comp: comp['mean'])
+    cal, bkg = strips[0], strips[-1]
+
+    boxes = {'Film' : film, 'Calibration' : cal, 'Background' : bkg}
+
+    # Refine the box edges at full resolution
+    im = scanArray(imfile) if imfile is not None else None
+    scanrulerrows, scanrulercols = np.repeat(rulerrows, step), np.repeat(rulercols, step)
+    rows = []
+    for r, comp in boxes.items():
+        box = [comp['top']*step, comp['left']*step, comp['height']*step, comp['width']*step]
+        if im is not None and step > 1:
+            box = refineEdges(im=im, box=box, step=step, thr=thr, rulerrows=scanrulerrows, rulercols=scanrulercols)
+        top, left, height, width = box
+        rows.append({'left' : left, 'width' : width, 'top' : top, 'height' : height, 'label' : r})
+
+    # Background: the central part of the unirradiated strip
+    bkgrow = rows[-1]
+    bw, bh = int(bkgrow['width']*bkgfraction), int(bkgrow['height']*bkgfraction)
+    bkgrow.update({'left' : bkgrow['left'] + (bkgrow['width'] - bw)//2, 'width' : bw,
+                   'top' : bkgrow['top'] + (bkgrow['height'] - bh)//2, 'height' : bh})
+
+    # Center: the largest compact bright mark on the ruler, not touching the scan border
+    center = None
+    if ruler.any() and not (rulerrows.all() or rulercols.all()):
+        _marklab, marks = regionComponents(ruler & ~dark)
+        marks = [mark for mark in marks
+                 if mark['top'] > 0 and mark['left'] > 0 and mark['top'] + mark['height'] < nrows and mark['left'] + mark['width'] < ncols
+                 and max(mark['height'], mark['width']) <= 3*min(mark['height'], mark['width'])]
+        if marks:
+            mark = max(marks, key=lambda mark: mark['area'])
+            center = {'left' : mark['left']*step, 'width' : mark['width']*step, 'top' : mark['top']*step, 'height' : mark['height']*step, 'label' : 'Center'}
+    if center is not None:
+        rows.append(center)
+
+    bbdf = pd.DataFrame(rows, columns=['left', 'width', 'top', 'height', 'label'])
+    bbdf[['left', 'width', 'top', 'height']] = bbdf[['left', 'width', 'top', 'height']].astype(int)
+    if bbfile is not None:
+        bbdf.to_csv(bbfile)
+    return bbdf
+
+def layoutPreview(imfile=None, resolution=1.):
     """
+    A function to get the low resolution image of a scan used to register the layouts
 
-    return icalf(d, iratf(d, *bratps), *bcalps)
+    ...
 
-Bicalfv = np.vectorize(Bicalf, excluded={1, 2})
+    Attributes
+    ----------
+    imfile : str or Path
+        The name of the image file
 
-def PDDCalibration(config=None, imfile=None, base=None):
+    resolution : float
+        The pixel size of the image in mm
+
+    Returns
+    -------
+    lim : 2D float32 numpy array
+        The darkness of the scan (0 for the scanner lid, 1 for black) with the given pixel size. The scanner ruler, which
+        does not move with the films, is left out as lid
     """
-    A function to get the current scan calibration parameters
+
+    pxsp = TIFFPixelSpacing(imfile=imfile)
+    preview, step = scanPreview(imfile, step=max(1, int(round(resolution/min(pxsp)))))
+    g = np.asarray(preview, dtype=float)
+    g = g.mean(axis=2) if g.ndim == 3 else g
+    lid = np.percentile(g, 99)
+    lim = 1 - g/lid
+    lim[rulerMask(g, lid)[0]] = 0
+    zoom = (pxsp[1]*step/resolution, pxsp[0]*step/resolution)
+    if not np.allclose(zoom, 1):
+        lim = ndi.zoom(lim, zoom, order=1)
+    return np.clip(lim, 0, 1).astype(np.float32)
+
+def layoutPath(config=None, name=None):
+    """
+    A function to get the file of a scan layout template
 
     ...
 
@@ -738,394 +1499,3451 @@ def PDDCalibration(config=None, imfile=None, base=None):
     config : ConfigParser
         An object with the functionalities of the configparser module
 
-    imfile : str
-        The name of the image file, the file containing the scanned image of the dose distribution, the calibration strip and the base strip in TIFF format.
-
-    base : 1D numpy array
-        Array containing the calculated base values for every color channel
+    name : str
+        The layout name
 
     Returns
     -------
-    caldf : pandas DataFrame
-        The current scan calibration parameters
-
-    cdf : pandas dataframe
-        The calibration data from which caldf is obtained
+    path : Path
+        The json file, in the [Segmentation] layoutpath directory. Its low resolution image is the npy file with the same name
+    """
 
-    sips : float
-        Scanned image pixel size [mm]
+    return Path(config['Segmentation']['layoutpath']) / (name + '.json')
 
+def listLayouts(config=None):
     """
+    A function to list the stored scan layout templates
 
-    # Read the calculated calibration absorbed dose distributiom (PDD)
-    pddcalibfile = config['Calibration']['Path'] + config['Calibration']['File']
-    cdf = pd.read_excel(pddcalibfile)
+    ...
 
-    # Read the calibration image segment data
-    calfilename = Path(imfile)
-    calfilename = calfilename.with_suffix('.Calibration.tif')
-    cim = imread(calfilename)
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
 
-    # Denoise
-    dcim = nlmf(imfile=calfilename, config=config)
+    Returns
+    -------
+    names : list
+        The layout names, sorted
+    """
 
-    # Calculate spatial coordinates
-    with TiffFile(imfile) as tif:
-        page_tags = tif.pages[0].tags
-    xres = page_tags['XResolution'].value
-    dpi = xres[0]/xres[1]
-    zres = 2.54/dpi
-    sips = zres
-    zv = np.arange(0, (cim.shape[0]+0.5)*zres, zres)
+    return sorted(path.stem for path in Path(config['Segmentation']['layoutpath']).glob('*.json'))
 
-    # Depth dose distribution in digital signal units
-    dch, dcw, _chanels = dcim.shape
-    cdd = profile_line(dcim, src=(0, dcw/2), dst=(dch, dcw/2), linewidth=20)
+def saveLayout(name=None, imfile=None, bbfile='tmp/bb.csv', bbdf=None, config=None):
+    """
+    A function to store the labelled regions of a scan as a layout template for the following scans
 
-    # Depth dose distribution in optical density units
-    ddf = pd.DataFrame({'z': zv, 'dr' : np.log10(2**16/cdd[:,0]), 'dg' : np.log10(2**16/cdd[:,1]), 'db' : np.log10(2**16/cdd[:,2])})
-    ddf.replace([np.inf, -np.inf], np.nan, inplace=True)
-    ddf.dropna(inplace=True)
+    The boxes are stored in mm with the TIFF resolution, together with a low resolution image of the scan to register
+    the following scans against it.
 
-    # Resampling to the used ratiotherapy planning system spatial resolution
-    zsh, zmin, zmax = float(config['Calibration']['shift']), float(config['Calibration']['depthmin']), float(config['Calibration']['depthmax'])
+    ...
 
-    # Interpolation functions
-    rddf = interp1d(ddf.z + zsh, ddf.dr, bounds_error=False)
-    gddf = interp1d(ddf.z + zsh, ddf.dg, bounds_error=False)
-    bddf = interp1d(ddf.z + zsh, ddf.db, bounds_error=False)
+    Attributes
+    ----------
+    name : str
+        The layout name
 
-    # Add to the calibration DataFrame the optical density corresponding to the radiotherapy planning system data points
-    cdf['dR'] = rddf(cdf.z)
-    cdf['dG'] = gddf(cdf.z)
-    cdf['dB'] = bddf(cdf.z)
+    imfile : str or Path
+        The name of the labelled image file
 
-    # Filter the calibration relevant depths
-    cdf = cdf.loc[(cdf.z > zmin) & (cdf.z < zmax)]
+    bbfile : str or Path
+        The bounding box file of the scan regions
 
-    # Drop NA values
-    cdf.dropna(inplace=True)
+    bbdf : pandas DataFrame or None
+        The bounding boxes. If given bbfile is not read
 
-    # Read the standard calibration parameters (multiphse model)
-    configpath = config['DEFAULT']['configpath']
-    modelsfile = config['Models']['File']
-    modelsheet = config['Models']['mphSheet']
-    caldf = pd.read_excel(configpath + modelsfile, sheet_name=modelsheet)
-    caldf.set_index('Unnamed: 0', inplace=True)
-    caldf.index.names = ['ch']
+    config : ConfigParser
+        An object with the functionalities of the configparser module
 
-    # Read the standard calibration parameters (rational model)
-    modelsheet = config['Models']['racSheet']
-    racdf = pd.read_excel(configpath + modelsfile, sheet_name=modelsheet)
-    racdf.set_index('Unnamed: 0', inplace=True)
-    racdf.index.names = ['ch']
+    Returns
+    -------
+    layout : dict
+        The layout: name, resolution, boxes (label, left, top, width and height in mm) and reference image
+    """
 
-    # Extract every color channel parameters
-    # Multiphase
-    rcalps = caldf.iloc[0].values
-    gcalps = caldf.iloc[1].values
-    bcalps = caldf.iloc[2].values
-    # Rational
-    rracps = racdf.iloc[0].values
-    gracps = racdf.iloc[1].values
-    bracps = racdf.iloc[2].values
+    bbdf = pd.read_csv(bbfile) if bbdf is None else bbdf
+    pxsp = TIFFPixelSpacing(imfile=imfile)
+    resolution = float(config['Segmentation']['layoutresolution'])
+    boxes = [{'label' : bb.label, 'left' : bb.left*pxsp[0], 'top' : bb.top*pxsp[1], 'width' : bb.width*pxsp[0], 'height' : bb.height*pxsp[1]}
+             for bb in bbdf.itertuples()]
+    layout = {'name' : name, 'resolution' : resolution, 'boxes' : boxes, 'scan' : Path(imfile).name,
+              'created' : datetime.now().isoformat(timespec='seconds')}
+    path = layoutPath(config=config, name=name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    reference = layoutPreview(imfile=imfile, resolution=resolution)
+    np.save(path.with_suffix('.npy'), reference)
+    path.write_text(dumps(layout, indent=1))
+    layout['reference'] = reference
+    return layout
+
+def loadLayout(name=None, config=None):
+    """
+    A function to read a stored scan layout template
 
-    # Calibration models for every channel
-    rcalfmodel = Model(calf)
-    gcalfmodel = Model(calf)
-    bcalfmodel = Model(calf)
+    ...
 
-    # Parameter initialization
-    # Red
-    rcalfparams = rcalfmodel.make_params(
-        f = base[0],
-        phir = rcalps[1],
-        kr = rcalps[2],
-        phib = rcalps[3],
-        kb = rcalps[4]
-    )
+    Attributes
+    ----------
+    name : str
+        The layout name
 
-    rcalfparams['f'].vary = False
-    rcalfparams['phir'].min = 0
-    rcalfparams['kr'].vary = False
-    rcalfparams['phib'].min = 0
-    rcalfparams['kb'].vary = False
+    config : ConfigParser
+        An object with the functionalities of the configparser module
 
-    # Green
-    gcalfparams = gcalfmodel.make_params(
-        f = base[1],
-        phir = gcalps[1],
-        kr = gcalps[2],
-        phib = gcalps[3],
-        kb = gcalps[4],
-    )
+    Returns
+    -------
+    layout : dict
+        The layout, as returned by saveLayout
+    """
 
-    gcalfparams['f'].vary = False
-    gcalfparams['phir'].min = 0
-    gcalfparams['kr'].vary = False
-    gcalfparams['phib'].min = 0
-    gcalfparams['kb'].vary = False
+    path = layoutPath(config=config, name=name)
+    if not path.exists():
+        raise FileNotFoundError('Layout not found: ' + str(path))
+    layout = json.loads(path.read_text())
+    layout['reference'] = np.load(path.with_suffix('.npy'))
+    return layout
 
-    # Blue
-    bcalfparams = bcalfmodel.make_params(
-        f = base[2],
-        phir = bcalps[1],
-        kr = bcalps[2],
-        phib = bcalps[3],
-        kb = gcalps[4],
-    )
+def applyLayout(layout=None, imfile=None, config=None, bbfile=None):
+    """
+    A function to place the regions of a layout template on a new scan
 
-    bcalfparams['f'].vary = False
-    bcalfparams['phir'].min = 0
-    bcalfparams['kr'].vary = False
-    bcalfparams['phib'].min = 0
-    bcalfparams['kb'].vary = False
+    The offset of the new scan against the layout is found by phase correlation of their low resolution images and the
+    film boxes are moved by it, the Center box stays with the scanner ruler. The boxes are converted to pixels with the
+    TIFF resolution of the new scan.
 
-    # Fit
-    rcalfresult = rcalfmodel.fit(cdf.dR, rcalfparams, D = cdf.D)
-    gcalfresult = gcalfmodel.fit(cdf.dG, gcalfparams, D = cdf.D)
-    bcalfresult = bcalfmodel.fit(cdf.dB, bcalfparams, D = cdf.D)
+    ...
 
-    # Parameter reorganization
-    caldf = pd.DataFrame({'f' : base[0], 'phir' : rcalfresult.params.get('phir').value, 'kr' : rcalps[2], 'phib' : rcalfresult.params.get('phib').value, 'kb' : rcalps[4]}, index=['R'])
-    tcaldf = pd.DataFrame({'f' : base[1], 'phir' : gcalfresult.params.get('phir').value, 'kr' : gcalps[2], 'phib' : gcalfresult.params.get('phib').value, 'kb' : gcalps[4]}, index=['G'])
-    caldf = pd.concat([caldf, tcaldf])
-    tcaldf = pd.DataFrame({'f' : base[2], 'phir' : bcalfresult.params.get('phir').value, 'kr' : bcalps[2], 'phib' : bcalfresult.params.get('phib').value, 'kb' : bcalps[4]}, index=['B'])
-    caldf = pd.concat([caldf, tcaldf])
+    Attributes
+    ----------
+    layout : str or dict
+        The layout name or the layout, as returned by loadLayout
 
+    imfile : str or Path
+        The name of the new image file
 
-    # Return the current scan calibration parameter DataFrmme, calibration dataframe and pixel size
-    return caldf, cdf, sips
+    config : ConfigParser
+        An object with the functionalities of the configparser module
 
-def validatecalibf(cda=None, config=None, caldf=None):
+    bbfile : str, Path or None
+        The bounding box file to be written, in the format of the labelling page. If None it is not written
+
+    Returns
+    -------
+    bbdf : pandas DataFrame
+        The bounding boxes in scan pixels, columns left, width, top, height and label
+
+    offset : list
+        The X and Y offset of the new scan against the layout in mm, floats
+    """
+
+    layout = loadLayout(name=layout, config=config) if isinstance(layout, str) else layout
+    resolution = layout['resolution']
+    reference = layout['reference']
+
+    # Offset by phase correlation, the new image is cropped or padded to the reference
+    lim = layoutPreview(imfile=imfile, resolution=resolution)
+    moving = np.zeros_like(reference)
+    h, w = min(reference.shape[0], lim.shape[0]), min(reference.shape[1], lim.shape[1])
+    moving[:h, :w] = lim[:h, :w]
+    shift, _error, _phasediff = phase_cross_correlation(reference, moving, upsample_factor=10)
+    # Plain floats, phase_cross_correlation returns numpy scalars of the image dtype
+    offset = [float(-shift[1]*resolution), float(-shift[0]*resolution)]
+    maxshift = float(config['Segmentation']['layoutmaxshift'])
+    if max(abs(offset[0]), abs(offset[1])) > maxshift:
+        raise ValueError('Scan offset against the layout %s beyond %g mm: %.1f, %.1f mm' % (layout['name'], maxshift, offset[0], offset[1]))
+
+    # Boxes in pixels of the new scan
+    pxsp = TIFFPixelSpacing(imfile=imfile)
+    nrows, ncols = scanArray(imfile).shape[:2]
+    rows = []
+    for box in layout['boxes']:
+        dx, dy = (0, 0) if box['label'] == 'Center' else offset
+        left = int(np.clip(round((box['left'] + dx)/pxsp[0]), 0, ncols - 1))
+        top = int(np.clip(round((box['top'] + dy)/pxsp[1]), 0, nrows - 1))
+        width = int(min(round(box['width']/pxsp[0]), ncols - left))
+        height = int(min(round(box['height']/pxsp[1]), nrows - top))
+        rows.append({'left' : left, 'width' : width, 'top' : top, 'height' : height, 'label' : box['label']})
+    bbdf = pd.DataFrame(rows, columns=['left', 'width', 'top', 'height', 'label'])
+    if bbfile is not None:
+        bbdf.to_csv(bbfile)
+    return bbdf, offset
+
+def baseDetermination(imfile=None, config=None, workspace=None):
+    """
+    A function to calculate the base value in every color channel
+
+    ...
+
+    Attributes
+    ---------
+    imfile : str or ScanImage
+        The name of the image file, the file containing the scanned image of the dose distribution, the calibration strip and the base strip in TIFF format, or the scan returned by segRegs.
+
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    workspace : Workspace or None
+        The workspace of the region files when imfile is a file name. If None they are read next to the scan
+
+    Returns
+    -------
+    imbase : float64 numpy array
+        An array containing the value of the base digital signal in every color channel.
+
+    """
+    # Leer la imagen de fondo
+    fim = scanRegion(imfile, 'Background', workspace=workspace)
+    # Tomar el valor del margen del arhivo de configuraciÃ³n
+    mrg = int(config['Base']['margin'])
+    # Tomar la parte central
+    fim = fim[mrg:-mrg, mrg:-mrg, :]
+    # Devolver el valor del fondo en cada canal
+    return np.log10(2**16/fim.mean(axis=(0,1)))
+
+def nlmf(imfile=None, config=None, im=None, progress=None):
+    """
+    A function to denoise a multichannel image using a non-local means procedure.
+
+    imfile : str
+        The name of the image file, the file containing the image to be denoised.
+
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    im : numpy array or None
+        The image to be denoised, if already read. imfile is not read then
+
+    progress : Progress or None
+        The progress reporter of the tiled denoising. If None a StreamlitProgress is used inside the app and a NullProgress otherwise
+
+    Returns
+    -------
+    udim = unsigned int numpy array
+        A numpy array of unsigned ints with shape (xpixels, ypixels, channels). The filter runs in the [Processing] precision
+    """
+    if im is None:
+        im = imread(imfile)
+
+    # Cached result for the same image, filter parameters and precision
+    key = cacheKey('nlmf', im, configValues(config, 'NonLocalMeans', ['patchsize', 'patchdistance', 'h', 'channelaxis']),
+                   configValues(config, 'Processing', ['precision']))
+    udim = cacheLoad(config=config, key=key)
+    if udim is not None:
+        return udim
+
+    fim = img_as_float32(im) if processingDtype(config) == np.float32 else img_as_float(im)
+    nlmkw = nlmParms(config=config)
+    if config['NonLocalMeans']['mode'] == 'tiled':
+        dim = nlmTiledf(fim=fim, config=config, nlmkw=nlmkw, progress=progress)
+    else:
+        dim = denoise_nl_means(fim, **nlmkw)
+    udim=img_as_uint(dim)
+
+    cacheStore(config=config, key=key, value=udim)
+    return udim
+
+def processingDtype(config=None):
+    """
+    A function to read the floating point precision of the dose pipeline from the configuration
+
+    ...
+
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    Returns
+    -------
+    dtype : numpy dtype
+        float64 or float32, the [Processing] precision value
+    """
+
+    dtype = np.dtype(config['Processing']['precision'])
+    if dtype not in (np.float32, np.float64):
+        raise ValueError('Unsupported precision: ' + config['Processing']['precision'])
+    return dtype
+
+def opticalDensity(udim=None, dtype=np.float64):
+    """
+    A function to convert the denoised digital signal to optical density
+
+    ...
+
+    Attributes
+    ----------
+    udim : numpy array
+        The denoised image, unsigned ints
+
+    dtype : numpy dtype
+        The precision of the optical density
+
+    Returns
+    -------
+    dim : numpy array
+        The optical density log10(2**16/udim), with the shape of udim
+    """
+
+    dtype = np.dtype(dtype)
+    return np.log10(dtype.type(2**16)/(udim.astype(dtype) + dtype.type(0.0000001)))
+
+def nlmParms(config=None):
+    """
+    A function to read the denoise_nl_means keyword arguments from the configuration
+
+    ...
+
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    Returns
+    -------
+    nlmkw : dict
+        patch_size, patch_distance, h and channel_axis from the [NonLocalMeans] section
+    """
+
+    return {'patch_size' : int(config['NonLocalMeans']['PatchSize']),
+            'patch_distance' : int(config['NonLocalMeans']['PatchDistance']),
+            'h' : float(config['NonLocalMeans']['h']),
+            'channel_axis' : int(config['NonLocalMeans']['ChannelAxis'])}
+
+def nlmTiles(shape=None, tilesize=256, halo=0):
+    """
+    A function to split an image in overlapping tiles for the non-local means denoising
+
+    ...
+
+    Attributes
+    ----------
+    shape : tuple
+        The image shape, only the first two (spatial) dimensions are split
+
+    tilesize : int
+        The size in pixels of the tiles without halo
+
+    halo : int
+        The number of pixels added on every side of a tile, clipped to the image borders
+
+    Returns
+    -------
+    tiles : list
+        A list of (outer, inner, local) slice tuples: outer is the tile with halo, inner the tile without halo in image coordinates and local the inner region in outer tile coordinates
+    """
+
+    tiles = []
+    for r0 in range(0, shape[0], tilesize):
+        for c0 in range(0, shape[1], tilesize):
+            r1, c1 = min(r0 + tilesize, shape[0]), min(c0 + tilesize, shape[1])
+            hr0, hc0 = max(r0 - halo, 0), max(c0 - halo, 0)
+            hr1, hc1 = min(r1 + halo, shape[0]), min(c1 + halo, shape[1])
+            tiles.append(((slice(hr0, hr1), slice(hc0, hc1)),
+                          (slice(r0, r1), slice(c0, c1)),
+                          (slice(r0 - hr0, r1 - hr0), slice(c0 - hc0, c1 - hc0))))
+    return tiles
+
+def nlmTilef(parl):
+    """
+    A function to denoise a tile. It is an accessory function for multiprocessing. It should not be call outside the nlmTiledf function.
+    """
+
+    tile, nlmkw = parl
+    return denoise_nl_means(tile, **nlmkw)
+
+def nlmTiledf(fim=None, config=None, nlmkw=None, progress=None):
+    """
+    A function to denoise an image by non-local means in overlapping tiles processed in parallel
+
+    The halo of every tile is PatchSize//2 + PatchDistance + 1 pixels, the whole neighbourhood that the non-local means
+    filter reads to denoise a pixel, so the stitched image matches the monolithic denoise_nl_means call up to the floating
+    point rounding of its integral image sums (below one uint16 step after img_as_uint).
+    With a single pool worker the monolithic call is used.
+
+    ...
+
+    Attributes
+    ----------
+    fim : numpy array
+        The float image to be denoised, with the spatial dimensions first
+
+    config : ConfigParser
+        An object with the functionalities of the configparser module. [NonLocalMeans] tilesize sets the tile size
+
+    nlmkw : dict
+        The denoise_nl_means keyword arguments
+
+    progress : Progress or None
+        The progress reporter. If None a StreamlitProgress is used inside the app and a NullProgress otherwise
+
+    Returns
+    -------
+    dim : numpy array
+        The denoised float image
+    """
+
+    halo = nlmkw['patch_size'] // 2 + nlmkw['patch_distance'] + 1
+    tiles = nlmTiles(shape=fim.shape, tilesize=int(config['NonLocalMeans']['tilesize']), halo=halo)
+    # A single tile or a single worker gains nothing from shipping the tiles to the pool
+    if len(tiles) == 1 or poolWorkers(config) == 1:
+        return denoise_nl_means(fim, **nlmkw)
+
+    progress = progressReporter(progress)
+    dim = np.empty_like(fim)
+    with usePool(config) as p:
+        dtiles = progress.iterate(p.imap(nlmTilef, [[fim[outer], nlmkw] for outer, _inner, _local in tiles]),
+                                  total=len(tiles), desc='Filtrando la imagen:')
+        for dtile, (_outer, inner, local) in zip(dtiles, tiles):
+            dim[inner] = dtile[local]
+    return dim
+
+def iratf(d, a, b, c):
+    """
+    The calibration function following a sensitometric model bases in rational functions
+
+    ...
+
+    Attributes
+    ----------
+    d : float64
+        Optical density as measured by the scanner
+
+    a : float64
+        First rational function parameter
+
+    b : float64
+        Second rational function parameter
+
+    c : float64
+        Third rational function parameter
+
+    Returns
+    -------
+    D : float64
+        The abosrbed dose D corresponding to the optical density d in each channel following the sensitometry model based on rational functions
+
+    """
+
+    return (a - c * 10**-d)/(10**-d - b)
+
+class LateralCorrection:
+    """
+    A class to represent the off-axis (lateral) correction model
+
+    The six correction functions, phase (red, blue) by channel (R, G, B), are B-splines sharing a knot vector, so the
+    whole model is three plain arrays. It is evaluated for every column of a film in a single vectorized call and is
+    cheap to pickle to worker processes.
+
+    ...
+
+    Attributes
+    ----------
+    t : 1D numpy array
+        The spline knots, distance to the scanner axis in inches
+
+    c : 3D numpy array
+        The spline coefficients, shape (len(t) - k - 1, 2, 3)
+
+    k : int
+        The spline degree
+
+    fill : float or None
+        The value outside the knot range. If None the splines are extrapolated
+    """
+
+    def __init__(self, t=None, c=None, k=3, fill=None):
+        self.t = np.ascontiguousarray(t, dtype=float)
+        self.c = np.ascontiguousarray(c, dtype=float)
+        self.k = int(k)
+        self.fill = fill
+        self._spline = BSpline(self.t, self.c, self.k, extrapolate=fill is None)
+
+    @classmethod
+    def fromSamples(cls, x=None, y=None, k=3, fill=None):
+        """
+        A method to build the model interpolating sampled correction functions, as interp1d does
+
+        ...
+
+        Attributes
+        ----------
+        x : 1D numpy array
+            The sample distances to the scanner axis in inches
+
+        y : 3D numpy array
+            The correction function samples, shape (len(x), 2, 3)
+
+        k : int
+            The spline degree, 1 for piecewise linear
+
+        fill : float or None
+            The value outside the sample range. If None the splines are extrapolated
+
+        Returns
+        -------
+        lc : LateralCorrection
+            The lateral correction model
+        """
+
+        spline = make_interp_spline(np.asarray(x, dtype=float), np.asarray(y, dtype=float), k=k, axis=0)
+        return cls(t=spline.t, c=spline.c, k=spline.k, fill=fill)
+
+    @classmethod
+    def fromOADC(cls, source=None):
+        """
+        A method to convert the pickled lateral correction interpolators of an oadc .npy file
+
+        The oadc file holds a (2, 3) array of scipy interp1d objects: phase (red, blue) by channel (R, G, B).
+
+        ...
+
+        Attributes
+        ----------
+        source : str or Path
+            The oadc .npy file
+
+        Returns
+        -------
+        lc : LateralCorrection
+            The lateral correction model
+        """
+
+        recadc = np.load(source, allow_pickle=True)
+        xs, ys, ks, fills = [], [], [], []
+        for i in range(recadc.shape[0]):
+            for j in range(recadc.shape[1]):
+                fn = recadc[i, j].item()
+                # Read the attributes directly, the pickled spline internals change between scipy versions
+                attrs = vars(fn)
+                kind = attrs['_kind']
+                if kind == 'spline':
+                    spline = vars(attrs['_spline'])
+                    kind = int(spline['k']) if 'k' in spline else int(attrs['_spline'].k)
+                fill = attrs.get('_fill_value_orig', np.nan)
+                xs.append(np.asarray(attrs['x'], dtype=float))
+                ys.append(np.asarray(attrs['y'], dtype=float))
+                ks.append({'linear' : 1, 'quadratic' : 2, 'cubic' : 3}.get(kind, kind))
+                fills.append(None if isinstance(fill, str) else float(fill))
+        if any(not np.array_equal(x, xs[0]) for x in xs) or len(set(ks)) > 1 or len(set(map(str, fills))) > 1:
+            raise ValueError('The lateral correction functions in ' + str(source) + ' do not share their samples, kind and fill value')
+        return cls.fromSamples(x=xs[0], y=np.stack(ys, axis=-1).reshape(-1, *recadc.shape[:2]), k=ks[0], fill=fills[0])
+
+    def arrays(self):
+        """
+        A method to get the model as plain arrays and metadata, as stored in the model store
+
+        ...
+
+        Returns
+        -------
+        arrays : dict
+            The knots t and coefficients c
+
+        meta : dict
+            The degree k and fill value
+        """
+
+        return {'t' : self.t, 'c' : self.c}, {'k' : self.k, 'fill' : self.fill}
+
+    def phi(self, x=None):
+        """
+        A method to evaluate the six correction functions
+
+        ...
+
+        Attributes
+        ----------
+        x : float or numpy array
+            The distances to the scanner axis in inches
+
+        Returns
+        -------
+        phi : numpy array
+            The correction functions, shape x.shape + (2, 3): phase (red, blue) by channel (R, G, B)
+        """
+
+        x = np.asarray(x, dtype=float)
+        phi = self._spline(x)
+        if self.fill is not None:
+            phi[(x < self.t[self.k]) | (x > self.t[-self.k-1])] = self.fill
+        return phi
+
+    def factors(self, x=None, xc=None):
+        """
+        A method to calculate the correction factors relative to the calibration position
+
+        ...
+
+        Attributes
+        ----------
+        x : float or numpy array
+            The distances to the scanner axis in inches
+
+        xc : float
+            The distance of the calibration strip to the scanner axis in inches
+
+        Returns
+        -------
+        factors : numpy array
+            phi(x)/phi(xc), shape x.shape + (2, 3)
+        """
+
+        return self.phi(x) / self.phi(xc)
+
+    def colsCalParms(self, calps=None, x=None, xc=None):
+        """
+        A method to calculate the multiphase calibration parameters corrected for every column of a film
+
+        ...
+
+        Attributes
+        ----------
+        calps : 2D numpy array
+            The multiphase calibration parameters (f, phir, kr, phib, kb) of the R, G and B channels, shape (3, 5)
+
+        x : 1D numpy array
+            The distances of the columns to the scanner axis in inches
+
+        xc : float
+            The distance of the calibration strip to the scanner axis in inches
+
+        Returns
+        -------
+        colscalps : 3D numpy array
+            The corrected parameters, shape (3, len(x), 5): phir and phib scaled by the correction factors
+        """
+
+        factors = self.factors(x, xc)
+        colscalps = np.repeat(np.asarray(calps, dtype=float)[:, np.newaxis, :], len(factors), axis=1)
+        colscalps[..., 1] *= factors[:, 0, :].T
+        colscalps[..., 3] *= factors[:, 1, :].T
+        return colscalps
+
+    def save(self, filename=None):
+        """
+        A method to save the model as an npz file, the converted form of an oadc .npy file
+
+        ...
+
+        Attributes
+        ----------
+        filename : str or Path
+            The npz file
+        """
+
+        np.savez(filename, t=self.t, c=self.c, k=self.k, fill=np.nan if self.fill is None else self.fill)
+
+    @classmethod
+    def load(cls, filename=None):
+        """
+        A method to load a model saved as an npz file
+
+        ...
+
+        Attributes
+        ----------
+        filename : str or Path
+            The npz file
+
+        Returns
+        -------
+        lc : LateralCorrection
+            The lateral correction model
+        """
+
+        with np.load(filename, allow_pickle=False) as npz:
+            fill = float(npz['fill'])
+            return cls(t=npz['t'], c=npz['c'], k=int(npz['k']), fill=None if np.isnan(fill) else fill)
+
+    def __getstate__(self):
+        return {'t' : self.t, 'c' : self.c, 'k' : self.k, 'fill' : self.fill}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+# Model store: calibration assets compiled once from Excel workbooks and pickled numpy arrays into versioned npz files
+MODELSTOREVERSION = 2
+_modelStore = {}
+_modelStoreLock = threading.RLock()
+
+def fileHash(filename=None):
+    """
+    A function to calculate the SHA-256 hex digest of a file contents
+
+    ...
+
+    Attributes
+    ----------
+    filename : str or Path
+        The file name
+
+    Returns
+    -------
+    digest : str
+        The SHA-256 hex digest
+    """
+
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def compileExcelSheet(source=None, sheet=0):
+    """
+    A function to compile an Excel sheet into plain arrays
+
+    ...
+
+    Attributes
+    ----------
+    source : str or Path
+        The Excel workbook
+
+    sheet : str or int
+        The sheet name or position, as in pandas read_excel
+
+    Returns
+    -------
+    arrays : dict
+        One array per column, named col0, col1, ...
+
+    meta : dict
+        The column names
+    """
+
+    df = pd.read_excel(source, sheet_name=sheet)
+    arrays = {}
+    for i, column in enumerate(df.columns):
+        values = df[column].to_numpy()
+        arrays['col%d' % i] = values.astype(str) if values.dtype == object or not np.issubdtype(values.dtype, np.number) else values
+    return arrays, {'columns' : [str(column) for column in df.columns]}
+
+def tableFromStore(arrays=None, meta=None):
+    """
+    A function to rebuild a pandas DataFrame from its compiled arrays, as pandas read_excel returns it
+
+    ...
+
+    Attributes
+    ----------
+    arrays : dict
+        The compiled arrays
+
+    meta : dict
+        The compiled metadata
+
+    Returns
+    -------
+    df : pandas DataFrame
+        The table
+    """
+
+    data = {}
+    for i, column in enumerate(meta['columns']):
+        values = arrays['col%d' % i]
+        data[column] = values.astype(object) if values.dtype.kind == 'U' else values
+    return pd.DataFrame(data)
+
+def compileOADC(source=None):
+    """
+    A function to compile the lateral correction model into plain arrays
+
+    ...
+
+    Attributes
+    ----------
+    source : str or Path
+        The oadc .npy file with the pickled interpolators, or an npz file saved by LateralCorrection.save
+
+    Returns
+    -------
+    arrays : dict
+        The spline knots t and coefficients c
+
+    meta : dict
+        The spline degree k and fill value
+    """
+
+    if Path(source).suffix == '.npz':
+        return LateralCorrection.load(source).arrays()
+    return LateralCorrection.fromOADC(source).arrays()
+
+def oadcFromStore(arrays=None, meta=None):
+    """
+    A function to rebuild the lateral correction model from its compiled arrays
+
+    ...
+
+    Attributes
+    ----------
+    arrays : dict
+        The compiled arrays
+
+    meta : dict
+        The compiled metadata
+
+    Returns
+    -------
+    lc : LateralCorrection
+        The lateral correction model
+    """
+
+    return LateralCorrection(t=arrays['t'], c=arrays['c'], k=meta['k'], fill=meta['fill'])
+
+def modelStorePath(config=None, source=None, sheet=None):
+    """
+    A function to get the compiled model store file of a source file
+
+    ...
+
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    source : str or Path
+        The source file
+
+    sheet : str, int or None
+        The Excel sheet, if any
+
+    Returns
+    -------
+    path : Path
+        The npz file, in the [Models] storepath directory
+    """
+
+    name = Path(source).name + ('' if sheet is None else '.' + str(sheet))
+    return Path(config['Models']['storepath']) / (name + '.npz')
+
+def modelStoreLoad(config=None, source=None, sheet=None, compiler=None, builder=None):
+    """
+    A function to get a model asset from the model store
+
+    The source is compiled by compiler into a versioned npz file on first use and the built object is memoized in the
+    process. Both are invalidated when the source size or modification time change and its SHA-256 digest no longer
+    matches the compiled one, or when the store version changes.
+
+    ...
+
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    source : str or Path
+        The source file
+
+    sheet : str, int or None
+        The Excel sheet, passed to compiler when not None
+
+    compiler : function
+        A function returning the (arrays, meta) compiled from the source
+
+    builder : function
+        A function building the asset from (arrays, meta)
+
+    Returns
+    -------
+    asset : object
+        The built asset. It is shared, callers must copy it before modifying it
+    """
+
+    stamp = fileStamp(source)
+    path = modelStorePath(config=config, source=source, sheet=sheet)
+    with _modelStoreLock:
+        memo = _modelStore.get(path)
+        if memo is not None and memo[0] == stamp:
+            return memo[1]
+
+        arrays, meta = None, None
+        if path.exists():
+            with np.load(path, allow_pickle=False) as npz:
+                stored = json.loads(str(npz['__meta__']))
+                if stored['version'] == MODELSTOREVERSION and (stored['stamp'] == list(stamp[1:]) or stored['sha256'] == fileHash(source)):
+                    arrays = {name : npz[name] for name in npz.files if name != '__meta__'}
+                    meta = stored
+        if arrays is None:
+            arrays, meta = compiler(source) if sheet is None else compiler(source, sheet)
+            meta.update({'version' : MODELSTOREVERSION, 'source' : str(source), 'sheet' : sheet,
+                         'stamp' : list(stamp[1:]), 'sha256' : fileHash(source)})
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmppath = path.with_suffix('.%d.tmp.npz' % os.getpid())
+            np.savez(tmppath, __meta__=np.array(json.dumps(meta)), **arrays)
+            os.replace(tmppath, path)
+        elif meta['stamp'] != list(stamp[1:]):
+            # Same contents with a new modification time, only the stamp is refreshed
+            meta['stamp'] = list(stamp[1:])
+            tmppath = path.with_suffix('.%d.tmp.npz' % os.getpid())
+            np.savez(tmppath, __meta__=np.array(json.dumps(meta)), **arrays)
+            os.replace(tmppath, path)
+
+        asset = builder(arrays, meta)
+        _modelStore[path] = (stamp, asset)
+        return asset
+
+def readTable(config=None, source=None, sheet=0):
+    """
+    A function to read an Excel sheet through the model store
+
+    ...
+
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    source : str or Path
+        The Excel workbook
+
+    sheet : str or int
+        The sheet name or position
+
+    Returns
+    -------
+    df : pandas DataFrame
+        A copy of the table, as pandas read_excel returns it
+    """
+
+    return modelStoreLoad(config=config, source=source, sheet=sheet, compiler=compileExcelSheet, builder=tableFromStore).copy()
+
+def readOADC(config=None):
+    """
+    A function to read the lateral (off-axis) correction model through the model store
+
+    ...
+
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    Returns
+    -------
+    lc : LateralCorrection
+        The lateral correction model
+    """
+
+    source = config['DEFAULT']['configpath'] + config['Models']['oadcFile']
+    return modelStoreLoad(config=config, source=source, compiler=compileOADC, builder=oadcFromStore)
+
+def readCalParms(config=None):
+    """
+    A function to read the established standard calibration parameters for the EBT3 film measured by the Microtek 1000 XL scanner
+
+    ...
+
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    Returns
+    -------
+    caldf : DataFrame
+        A pandas DataFrame with the calibration parameters for every color channel (multiphase model)
+
+    """
+
+    configpath = config['DEFAULT']['configpath']
+    modelsfile = config['Models']['File']
+    modelsheet = config['Models']['mphSheet']
+
+    caldf = readTable(config=config, source=configpath + modelsfile, sheet=modelsheet)
+    caldf.set_index('Unnamed: 0', inplace=True)
+    caldf.index.names = ['ch']
+    return caldf
+
+def readRatParms(config=None):
+    """
+    A function to read a standard calibration set of parameters following the rational model for the EBT3 film measured by the Microtek 1000 XL scanner
+
+    ...
+
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    Returns
+    -------
+    ratdf : DataFrame
+        A pandas DataFrame with the calibration parameters for every color channel (rational model)
+
+    """
+
+    configpath = config['DEFAULT']['configpath']
+    modelsfile = config['Models']['File']
+    modelsheet = config['Models']['racSheet']
+    ratdf = readTable(config=config, source=configpath + modelsfile, sheet=modelsheet)
+    ratdf.set_index('Unnamed: 0', inplace=True)
+    ratdf.index.names = ['ch']
+    return ratdf
+
+def rootcalf(D, d, f, phir, kr, phib, kb):
+    """
+    An internal module use function.
+    It expresses the nonlinear equation to get the absorbed dose D from the optical density d using the multiphase model
+
+    ...
+
+
+    Returns
+    -------
+    rootcalf : float64
+        The difference between the measured optical density d and the optical density as calculated for the multiphase model for the absorbed dose D
+
+    """
+
+    return d - calf(D, f, phir, kr, phib, kb)
+
+def icalf(d, Dsem, f, phir, kr, phib, kb):
+    """
+    The calibration function following the multiphase model
+
+    ...
+
+    Attributes
+    ----------
+    d : float64
+        The measured optical density
+    Dsem : float64
+        A seed value of the absorbed D to solve the nonlinear equation
+    f : float64
+        The base optical density
+
+    phir : float64
+        The relative abundance of the red phase polymer
+
+    kr : float64
+        The exponent in the saturation term of the red phase polymer
+
+    phib : float64
+        The relative abundance of the blue phase polymer
+
+    kb : float64
+        The exponent in the saturation term of the blue phase polymer
+
+    Returns
+    -------
+    D : float64
+        The calculated absorbed dose D corresponding to the measured optical density d
+
+    """
+
+    return fsolve(rootcalf, Dsem, (d, *[f, phir,  kr, phib, kb]))[0]
+
+def Ricalf(d, rcalps, rratps):
+    """
+    The calibration function following the multiphase model for the red channel
+
+    ...
+
+    Attributes
+    ----------
+    d : float64
+        The measured optical density
+
+    rcalps : 1D numpy array
+        The current scan calibration parameters for the red channel
+
+    rratps : 1D numpy array
+        The current scan calibration rational approximation for the red channel
+
+    Returns
+    -------
+    D : float64
+        The calculated absorbed dose D corresponding to the measured optical density d for the red channel
+
+    """
+    return icalf(d, iratf(d, *rratps), *rcalps)
+
+Ricalfv = np.vectorize(Ricalf, excluded={1, 2})
+
+def Gicalf(d, gcalps, gratps):
+    """
+    The calibration function following the multiphase model for the green channel
+
+    ...
+
+    Attributes
+    ----------
+    d : float64
+        The measured optical density
+
+    gcalps : 1D numpy array
+        The current scan calibration parameters for the green channel
+
+    gratps : 1D numpy array
+        The current scan calibration rational approximation for the green channel
+
+
+    Returns
+    -------
+    D : float64
+        The calculated absorbed dose D corresponding to the measured optical density d for the green channel
+
+    """
+
+    return icalf(d, iratf(d, *gratps), *gcalps)
+
+Gicalfv = np.vectorize(Gicalf, excluded={1, 2})
+
+def Bicalf(d, bcalps, bratps):
+    """
+    The calibration function following the multiphase model for the blue channel
+
+    ...
+
+    Attributes
+    ----------
+    d : float64
+        The measured optical density
+
+    bcalps : 1D numpy array
+        The current scan calibration parameters for the blue channel
+
+    bratps : 1D numpy array
+        The current scan calibration rational approximation for the blue channel
+
+
+    Returns
+    -------
+    D : float64
+        The calculated absorbed dose D corresponding to the measured optical density d for the blue channel
+
+    """
+
+    return icalf(d, iratf(d, *bratps), *bcalps)
+
+Bicalfv = np.vectorize(Bicalf, excluded={1, 2})
+
+def dcalf(D, f, phir, kr, phib, kb):
+    """
+    The derivative with respect to the absorbed dose of the two phase polymer model dose response function
+
+    ...
+
+    Attributes
+    ----------
+    D : float64 or numpy array
+        Absorbed dose
+
+    f, phir, kr, phib, kb : float64 or numpy array
+        The multiphase model parameters, as in calf
+
+    Returns
+    -------
+    dd : float64 or numpy array
+        The derivative of the optical density with respect to the absorbed dose
+
+    """
+
+    return phir * kr * np.exp(-kr*D) + phib * kb * np.exp(-kb*D)
+
+def d2calf(D, f, phir, kr, phib, kb):
+    """
+    The second derivative with respect to the absorbed dose of the two phase polymer model dose response function
+
+    ...
+
+    Attributes
+    ----------
+    D : float64 or numpy array
+        Absorbed dose
+
+    f, phir, kr, phib, kb : float64 or numpy array
+        The multiphase model parameters, as in calf
+
+    Returns
+    -------
+    d2d : float64 or numpy array
+        The second derivative of the optical density with respect to the absorbed dose
+
+    """
+
+    return - phir * kr**2 * np.exp(-kr*D) - phib * kb**2 * np.exp(-kb*D)
+
+def icalfnewton(d, Dsem, f, phir, kr, phib, kb, method='newton', xtol=1.49012e-08, maxiter=50):
+    """
+    The calibration function following the multiphase model, solved for whole arrays at once
+
+    The nonlinear equation d = calf(D) is solved by Newton (or Halley) iterations using the analytic derivatives of calf.
+    Every argument is broadcast against the others, so a full optical density image can be solved in a single call
+    with per column parameter arrays. Only the elements not converged yet are updated in every iteration.
+
+    ...
+
+    Attributes
+    ----------
+    d : numpy array
+        The measured optical density
+
+    Dsem : numpy array
+        The seed values of the absorbed dose, usually given by the rational approximation iratf
+
+    f, phir, kr, phib, kb : float64 or numpy array
+        The multiphase model parameters, as in calf
+
+    method : str
+        The iteration scheme: 'newton' or 'halley'
+
+    xtol : float
+        The iterations stop when the dose step is smaller than xtol*max(1, |D|). The same meaning as the fsolve xtol argument. In float32 they also stop when the residual is below 4 float32 epsilons of d
+
+    maxiter : int
+        The maximum number of iterations
+
+    Returns
+    -------
+    D : numpy array
+        The calculated absorbed dose D corresponding to the measured optical density d. Elements not converged after maxiter iterations keep the last iterate, as fsolve does.
+
+    """
+
+    d, Dsem, f, phir, kr, phib, kb = np.broadcast_arrays(d, Dsem, f, phir, kr, phib, kb)
+    shape = d.shape
+    # The iterations run in the precision of d, float32 or float64
+    dtype = np.result_type(d, np.float32)
+    d, f, phir, kr, phib, kb = [np.ravel(a).astype(dtype, copy=False) for a in (d, f, phir, kr, phib, kb)]
+    D = np.array(Dsem, dtype=dtype).ravel()
+    # In float32 the residual reaches its rounding noise before the step gets below xtol, the iterations also stop there
+    rtol = 4 * np.finfo(dtype).eps if dtype.itemsize < 8 else 0.
+
+    # Seeds out of the domain of the rational approximation are replaced by a neutral value
+    D[~np.isfinite(D)] = 1.
+
+    # Indices of the elements still iterating
+    active = np.flatnonzero(np.isfinite(d))
+
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        for _ in range(maxiter):
+            if active.size == 0:
+                break
+            Da = D[active]
+            parms = (f[active], phir[active], kr[active], phib[active], kb[active])
+            g = calf(Da, *parms) - d[active]
+            dg = dcalf(Da, *parms)
+            if method == 'halley':
+                d2g = d2calf(Da, *parms)
+                step = 2 * g * dg / (2 * dg**2 - g * d2g)
+            else:
+                step = g / dg
+            # calf overflows far from the solution, sooner in float32, the element stops at its last finite iterate
+            step[~np.isfinite(step)] = 0.
+            D[active] = Da - step
+            done = ~(np.abs(step) > xtol * np.maximum(1., np.abs(Da))) | (np.abs(g) <= rtol * np.abs(d[active]))
+            active = active[~done]
+
+    return D.reshape(shape)
+
+def solverParms(config=None, solver=None):
+    """
+    A function to read the dose inversion solver configuration
+
+    ...
+
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    solver : str or None
+        The solver to use: 'fsolve', 'newton', 'halley' or 'lut'. If None the [Solver] method in the configuration is used
+
+    Returns
+    -------
+    solver : str
+        The selected solver
+
+    xtol : float
+        The tolerance of the dose inversion
+
+    maxiter : int
+        The maximum number of iterations of the vectorized solvers
+    """
+
+    if solver is None:
+        solver = config['Solver']['method']
+    xtol = float(config['Solver']['xtol'])
+    maxiter = int(config['Solver']['maxiter'])
+    return solver, xtol, maxiter
+
+def imDoseCalculationMphspcnlmprocf(dim, colsrcalps, colsgcalps, colsbcalps, rratps, gratps, bratps, method='newton', xtol=1.49012e-08, maxiter=50):
+    """
+    A function to calculate the dose for every color channel in every pixel of the optical density image in a single array pass
+    It is the vectorized counterpart of colDoseCalculationMphspcnlmprocf applied to every column.
+
+    ...
+
+    Attributes
+    ----------
+    dim : 3D numpy array
+        The optical density image with shape (rows, columns, channels)
+
+    colsrcalps, colsgcalps, colsbcalps : 2D numpy arrays
+        The spatially corrected multiphase parameters of every column, with shape (columns, 5)
+
+    rratps, gratps, bratps : 1D numpy arrays
+        The rational approximation parameters of every channel, used as seeds
+
+    method, xtol, maxiter :
+        The icalfnewton solver settings
+
+    Returns
+    -------
+    Dim : 3D numpy arrray
+        The dose distribution for the three color channels with shape (columns, rows, channels), in the precision of dim
+    """
+
+    Dim = np.empty((dim.shape[1], dim.shape[0], dim.shape[2]), dtype=np.result_type(dim, np.float32))
+    for ch, (colscalps, ratps) in enumerate(zip([colsrcalps, colsgcalps, colsbcalps], [rratps, gratps, bratps])):
+        d = dim[..., ch].T
+        colscalps = np.asarray(colscalps, dtype=Dim.dtype)
+        Dim[..., ch] = icalfnewton(d, iratf(d, *ratps), *colscalps.T[..., np.newaxis],
+                                   method=method, xtol=xtol, maxiter=maxiter)
+    return Dim
+
+def lutKnots(ncols=None, nknots=16):
+    """
+    A function to select the columns where the dose lookup tables are calculated
+
+    ...
+
+    Attributes
+    ----------
+    ncols : int
+        The number of columns of the film image
+
+    nknots : int
+        The number of knot columns. The first and last columns are always included
+
+    Returns
+    -------
+    knots : 1D numpy array
+        The sorted indices of the knot columns
+    """
+
+    return np.unique(np.round(np.linspace(0, ncols - 1, max(2, min(nknots, ncols)))).astype(int))
+
+def doseLUT(codes=None, colscalps=None, ratps=None, knots=None, method='newton', xtol=1.49012e-08, maxiter=50):
+    """
+    A function to build the dose lookup table of a color channel
+
+    The optical density of every scanner code, log10(2**16/code), and its inversion through the multiphase model are
+    tabulated once for every knot column.
+
+    ...
+
+    Attributes
+    ----------
+    codes : 1D numpy array
+        The scanner digital signal values (uint16 codes) to be tabulated
+
+    colscalps : 2D numpy array
+        The spatially corrected multiphase parameters of every column, with shape (columns, 5)
+
+    ratps : 1D numpy array
+        The rational approximation parameters of the channel, used as seeds
+
+    knots : 1D numpy array
+        The indices of the knot columns
+
+    method, xtol, maxiter :
+        The icalfnewton solver settings
+
+    Returns
+    -------
+    lut : 2D numpy array
+        The absorbed dose with shape (knots, codes). Non finite doses are replaced as postmphspcnlmprocf does
+    """
+
+    od = np.log10(2**16/(codes+0.0000001))[np.newaxis, :]
+    kcalps = np.asarray(colscalps, dtype=float)[knots]
+    lut = icalfnewton(od, iratf(od, *ratps), *kcalps.T[..., np.newaxis], method=method, xtol=xtol, maxiter=maxiter)
+    return np.nan_to_num(lut, posinf=1e10, neginf=-1e10)
+
+def lutWeights(cols=None, knots=None):
+    """
+    A function to get the linear interpolation weights of a set of columns between the knot columns
+
+    ...
+
+    Attributes
+    ----------
+    cols : 1D numpy array
+        The column indices
+
+    knots : 1D numpy array
+        The indices of the knot columns
+
+    Returns
+    -------
+    k : 1D numpy array
+        The index of the knot on the left of every column
+
+    w : 2D numpy array
+        The weight of the knot on the right of every column, with shape (columns, 1)
+    """
+
+    k = np.clip(np.searchsorted(knots, cols, side='right') - 1, 0, len(knots) - 2)
+    w = ((cols - knots[k]) / (knots[k + 1] - knots[k]))[:, np.newaxis]
+    return k, w
+
+def lutDoseChannel(ucol=None, colscalps=None, ratps=None, knots=None, refine=1, method='newton', xtol=1.49012e-08, maxiter=50):
+    """
+    A function to calculate the dose of a color channel through a lookup table indexed by the scanner code
+
+    ...
+
+    Attributes
+    ----------
+    ucol : 2D numpy array
+        The scanner codes of the color channel with shape (columns, rows)
+
+    colscalps : 2D numpy array
+        The spatially corrected multiphase parameters of every column, with shape (columns, 5)
+
+    ratps : 1D numpy array
+        The rational approximation parameters of the channel, used as seeds
+
+    knots : 1D numpy array
+        The indices of the knot columns
+
+    refine : int
+        The number of Newton steps applied to the gathered dose with the exact parameters of every column
+
+    method, xtol, maxiter :
+        The icalfnewton solver settings used to build the table
+
+    Returns
+    -------
+    D : 2D numpy array
+        The absorbed dose with shape (columns, rows)
+    """
+
+    codes, idx = np.unique(ucol, return_inverse=True)
+    idx = idx.reshape(ucol.shape)
+    lut = doseLUT(codes=codes, colscalps=colscalps, ratps=ratps, knots=knots, method=method, xtol=xtol, maxiter=maxiter)
+    k, w = lutWeights(cols=np.arange(ucol.shape[0]), knots=knots)
+    D = (1 - w) * lut[k[:, np.newaxis], idx] + w * lut[k[:, np.newaxis] + 1, idx]
+    if refine > 0:
+        od = np.log10(2**16/(codes+0.0000001))[idx]
+        D = icalfnewton(od, D, *np.asarray(colscalps, dtype=float).T[..., np.newaxis], method='newton', xtol=0., maxiter=refine)
+    return D
+
+def lutDoseCalculationMphspcnlmprocf(udim, colsrcalps, colsgcalps, colsbcalps, rratps, gratps, bratps, nknots=16, refine=1, method='newton', xtol=1.49012e-08, maxiter=50, dtype=np.float64):
+    """
+    A function to calculate the dose for every color channel in every pixel of the denoised image through lookup tables
+
+    Every channel has at most 65536 distinct uint16 codes, so the optical density conversion and the dose inversion are
+    tabulated for the codes present in the image at nknots knot columns and then gathered for every pixel. The cost of
+    the tables does not depend on the film size.
+
+    The tabulated values are exact within the solver xtol. The approximation comes from the linear interpolation of the
+    dose between knot columns, which follow the lateral correction of phir and phib. Its error e0 is bounded by
+    (h**2/8)*max|d2D/dx2| for a knot spacing of h columns. Every refine Newton step with the exact column parameters
+    reduces it to (M/2m)*e0**2, where M and m bound |calf''| and calf' over the dose range. For the Microtek 1000XL lateral
+    correction and 16 knots, e0 is about 0.05 Gy and a single refine step brings it below 1e-4 Gy, well under the
+    0.01 Gy resolution of the dxf output. lutErrorf measures both errors for a given image.
+
+    ...
+
+    Attributes
+    ----------
+    udim : 3D numpy array
+        The denoised image in scanner codes (uint16) with shape (rows, columns, channels)
+
+    colsrcalps, colsgcalps, colsbcalps : 2D numpy arrays
+        The spatially corrected multiphase parameters of every column, with shape (columns, 5)
+
+    rratps, gratps, bratps : 1D numpy arrays
+        The rational approximation parameters of every channel, used as seeds
+
+    nknots : int
+        The number of knot columns of the lookup tables
+
+    refine : int
+        The number of Newton steps applied to the gathered dose. 0 returns the plain table gather
+
+    method, xtol, maxiter :
+        The icalfnewton solver settings used to build the tables
+
+    dtype : numpy dtype
+        The precision of the dose. The tables are always calculated in float64, their size does not depend on the film
+
+    Returns
+    -------
+    Dim : 3D numpy arrray
+        The dose distribution for the three color channels with shape (columns, rows, channels)
+    """
+
+    knots = lutKnots(ncols=udim.shape[1], nknots=nknots)
+    Dim = np.empty((udim.shape[1], udim.shape[0], udim.shape[2]), dtype=dtype)
+    for ch, (colscalps, ratps) in enumerate(zip([colsrcalps, colsgcalps, colsbcalps], [rratps, gratps, bratps])):
+        Dim[..., ch] = lutDoseChannel(ucol=udim[..., ch].T, colscalps=colscalps, ratps=ratps, knots=knots, refine=refine,
+                                      method=method, xtol=xtol, maxiter=maxiter)
+    return Dim
+
+def lutErrorf(udim, colsrcalps, colsgcalps, colsbcalps, rratps, gratps, bratps, nknots=16, refine=1, Dmax=None, method='newton', xtol=1.49012e-08, maxiter=50):
+    """
+    A function to measure the error of the dose lookup tables against the exact solver
+
+    The exact dose is calculated at the columns halfway between knots, where the linear interpolation error is largest,
+    for every code present in the image.
+
+    ...
+
+    Attributes
+    ----------
+    udim, colsrcalps, colsgcalps, colsbcalps, rratps, gratps, bratps, nknots, refine, method, xtol, maxiter :
+        As in lutDoseCalculationMphspcnlmprocf
+
+    Dmax : float or None
+        If given, only doses within [0, Dmax] are taken into account
+
+    Returns
+    -------
+    err : 1D numpy array
+        The maximum absolute dose error in every color channel
+    """
+
+    knots = lutKnots(ncols=udim.shape[1], nknots=nknots)
+    mids = np.unique((knots[:-1] + knots[1:]) // 2)
+    k, w = lutWeights(cols=mids, knots=knots)
+    err = np.zeros(udim.shape[2])
+    for ch, (colscalps, ratps) in enumerate(zip([colsrcalps, colsgcalps, colsbcalps], [rratps, gratps, bratps])):
+        codes = np.unique(udim[..., ch])
+        lut = doseLUT(codes=codes, colscalps=colscalps, ratps=ratps, knots=knots, method=method, xtol=xtol, maxiter=maxiter)
+        approx = (1 - w) * lut[k] + w * lut[k + 1]
+        if refine > 0:
+            od = np.log10(2**16/(codes+0.0000001))[np.newaxis, :]
+            approx = icalfnewton(od, approx, *np.asarray(colscalps, dtype=float)[mids].T[..., np.newaxis], method='newton', xtol=0., maxiter=refine)
+        exact = doseLUT(codes=codes, colscalps=colscalps, ratps=ratps, knots=mids, method=method, xtol=xtol, maxiter=maxiter)
+        valid = np.ones(exact.shape, dtype=bool) if Dmax is None else (exact >= 0) & (exact <= Dmax)
+        err[ch] = np.abs(approx - exact)[valid].max(initial=0)
+    return err
+
+def ratSeeds(calps=None):
+    """
+    A function to fit the rational approximations used as initial guesses to invert the multiphase calibration model
+
+    ...
+
+    Attributes
+    ----------
+    calps : 2D numpy array
+        The multiphase calibration parameters (f, phir, kr, phib, kb) of the R, G and B channels, shape (3, 5)
+
+    Returns
+    -------
+    ratps : 2D numpy array
+        The rational approximation parameters (a, b, c) of the R, G and B channels, shape (3, 3)
+    """
+
+    # Generate calibration points
+    vDrat = np.array([0.5, 0.75, 1., 1.25, 1.5, 2., 3., 4., 5., 7., 9.])
+
+    ratps = []
+    for chcalps in np.asarray(calps, dtype=float):
+        ratfmodel = Model(iratf)
+        ratparams = ratfmodel.make_params(
+            a = 0.1,
+            b = 0.1,
+            c = 0.1
+        )
+        ratfit = ratfmodel.fit(data=vDrat, params=ratparams, d=calf(vDrat, *chcalps))
+        ratps.append([k.value for k in ratfit.params.values()])
+    return np.array(ratps)
+
+class CalibrationModel:
+    """
+    A class to represent the calibration of a scan
+
+    It gathers everything the dose calculation needs from the calibration: the multiphase parameters, the rational
+    approximations that seed their inversion, fitted once, and the lateral correction model. It is built once per
+    calibration and shared by the validation and every processing path.
+
+    ...
+
+    Attributes
+    ----------
+    caldf : pandas DataFrame
+        The current scan calibration parameters, one row per channel R, G, B
+
+    calps : 2D numpy array
+        The multiphase calibration parameters (f, phir, kr, phib, kb), shape (3, 5)
+
+    ratps : 2D numpy array
+        The rational approximation parameters (a, b, c), shape (3, 3)
+
+    lc : LateralCorrection
+        The lateral correction model
+    """
+
+    def __init__(self, caldf=None, lc=None, ratps=None):
+        self.caldf = caldf
+        self.calps = caldf.iloc[:3].to_numpy(dtype=float)
+        self.ratps = ratSeeds(calps=self.calps) if ratps is None else np.asarray(ratps, dtype=float)
+        self.lc = lc
+
+    @classmethod
+    def fromCalParms(cls, caldf=None, config=None):
+        """
+        A method to build the calibration model from the multiphase calibration parameters
+
+        ...
+
+        Attributes
+        ----------
+        caldf : pandas DataFrame
+            The current scan calibration parameters
+
+        config : ConfigParser
+            An object with the functionalities of the configparser module
+
+        Returns
+        -------
+        calmodel : CalibrationModel
+            The calibration model
+        """
+
+        return cls(caldf=caldf, lc=readOADC(config=config))
+
+    def colsCalParms(self, ccdf=None, ncols=None):
+        """
+        A method to calculate the multiphase calibration parameters corrected for every column of a film
+
+        ...
+
+        Attributes
+        ----------
+        ccdf : pandas DataFrame
+            A data structure containing the relevant geometric parameters for the spatial correction
+
+        ncols : int
+            The number of columns of the film dose region
+
+        Returns
+        -------
+        colscalps : 3D numpy array
+            The corrected parameters, shape (3, ncols, 5)
+        """
+
+        xl, xc = colsDistances(ccdf=ccdf, ncols=ncols)
+        return self.lc.colsCalParms(calps=self.calps, x=xl, xc=xc)
+
+def calibrationModel(caldf=None, config=None):
+    """
+    A function to get the calibration model of the current scan
+
+    ...
+
+    Attributes
+    ----------
+    caldf : CalibrationModel or pandas DataFrame
+        The current scan calibration model, or its multiphase calibration parameters
+
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    Returns
+    -------
+    calmodel : CalibrationModel
+        The calibration model, caldf itself when it is already one
+    """
+
+    if isinstance(caldf, CalibrationModel):
+        return caldf
+    return CalibrationModel.fromCalParms(caldf=caldf, config=config)
+
+def PDDCalibration(config=None, imfile=None, base=None, workspace=None, progress=None):
+    """
+    A function to get the current scan calibration parameters
+
+    ...
+
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    imfile : str or ScanImage
+        The name of the image file, the file containing the scanned image of the dose distribution, the calibration strip and the base strip in TIFF format, or the scan returned by segRegs.
+
+    base : 1D numpy array
+        Array containing the calculated base values for every color channel
+
+    workspace : Workspace or None
+        The workspace of the region files when imfile is a file name. If None they are read next to the scan
+
+    progress : Progress or None
+        The progress reporter of the strip denoising. If None a StreamlitProgress is used inside the app and a NullProgress otherwise
+
+    Returns
+    -------
+    calmodel : CalibrationModel
+        The current scan calibration model. Its caldf attribute holds the calibration parameters
+
+    cdf : pandas dataframe
+        The calibration data from which caldf is obtained
+
+    sips : float
+        Scanned image pixel size [mm]
+
+    """
+
+    pddcalibfile = config['Calibration']['Path'] + config['Calibration']['File']
+
+    # Read the calibration image segment data
+    cim = scanRegion(imfile, 'Calibration', workspace=workspace)
+
+    # Cached calibration for the same strip, base and calibration settings
+    configpath = config['DEFAULT']['configpath']
+    key = cacheKey('PDDCalibration', cim, np.asarray(base),
+                   configValues(config, 'Calibration'), configValues(config, 'Models', ['file', 'mphsheet', 'racsheet', 'oadcfile']),
+                   configValues(config, 'NonLocalMeans', ['patchsize', 'patchdistance', 'h', 'channelaxis']),
+                   configValues(config, 'Processing', ['precision']),
+                   fileStamp(pddcalibfile), fileStamp(configpath + config['Models']['File']),
+                   fileStamp(configpath + config['Models']['oadcFile']), tuple(TIFFPixelSpacing(imfile=imfile)))
+    cached = cacheLoad(config=config, key=key)
+    # An entry of another layout is a miss, it is overwritten below
+    if isinstance(cached, tuple) and len(cached) == 3 and isinstance(cached[0], CalibrationModel):
+        return cached
+
+    # Read the calculated calibration absorbed dose distributiom (PDD)
+    cdf = readTable(config=config, source=pddcalibfile)
+
+    # Denoise
+    dcim = nlmf(config=config, im=cim, progress=progress)
+
+    # Calculate spatial coordinates
+    zres = TIFFPixelSpacing(imfile=imfile)[0]/10
+    sips = zres
+    zv = np.arange(0, (cim.shape[0]+0.5)*zres, zres)
+
+    # Depth dose distribution in digital signal units
+    dch, dcw, _chanels = dcim.shape
+    cdd = profile_line(dcim, src=(0, dcw/2), dst=(dch, dcw/2), linewidth=20)
+
+    # Depth dose distribution in optical density units
+    ddf = pd.DataFrame({'z': zv, 'dr' : np.log10(2**16/cdd[:,0]), 'dg' : np.log10(2**16/cdd[:,1]), 'db' : np.log10(2**16/cdd[:,2])})
+    ddf.replace([np.inf, -np.inf], np.nan, inplace=True)
+    ddf.dropna(inplace=True)
+
+    # Resampling to the used ratiotherapy planning system spatial resolution
+    zsh, zmin, zmax = float(config['Calibration']['shift']), float(config['Calibration']['depthmin']), float(config['Calibration']['depthmax'])
+
+    # Interpolation functions
+    rddf = interp1d(ddf.z + zsh, ddf.dr, bounds_error=False)
+    gddf = interp1d(ddf.z + zsh, ddf.dg, bounds_error=False)
+    bddf = interp1d(ddf.z + zsh, ddf.db, bounds_error=False)
+
+    # Add to the calibration DataFrame the optical density corresponding to the radiotherapy planning system data points
+    cdf['dR'] = rddf(cdf.z)
+    cdf['dG'] = gddf(cdf.z)
+    cdf['dB'] = bddf(cdf.z)
+
+    # Filter the calibration relevant depths
+    cdf = cdf.loc[(cdf.z > zmin) & (cdf.z < zmax)]
+
+    # Drop NA values
+    cdf.dropna(inplace=True)
+
+    # Read the standard calibration parameters (multiphse model)
+    configpath = config['DEFAULT']['configpath']
+    modelsfile = config['Models']['File']
+    modelsheet = config['Models']['mphSheet']
+    caldf = readTable(config=config, source=configpath + modelsfile, sheet=modelsheet)
+    caldf.set_index('Unnamed: 0', inplace=True)
+    caldf.index.names = ['ch']
+
+    # Read the standard calibration parameters (rational model)
+    modelsheet = config['Models']['racSheet']
+    racdf = readTable(config=config, source=configpath + modelsfile, sheet=modelsheet)
+    racdf.set_index('Unnamed: 0', inplace=True)
+    racdf.index.names = ['ch']
+
+    # Extract every color channel parameters
+    # Multiphase
+    rcalps = caldf.iloc[0].values
+    gcalps = caldf.iloc[1].values
+    bcalps = caldf.iloc[2].values
+    # Rational
+    rracps = racdf.iloc[0].values
+    gracps = racdf.iloc[1].values
+    bracps = racdf.iloc[2].values
+
+    # Calibration models for every channel
+    rcalfmodel = Model(calf)
+    gcalfmodel = Model(calf)
+    bcalfmodel = Model(calf)
+
+    # Parameter initialization
+    # Red
+    rcalfparams = rcalfmodel.make_params(
+        f = base[0],
+        phir = rcalps[1],
+        kr = rcalps[2],
+        phib = rcalps[3],
+        kb = rcalps[4]
+    )
+
+    rcalfparams['f'].vary = False
+    rcalfparams['phir'].min = 0
+    rcalfparams['kr'].vary = False
+    rcalfparams['phib'].min = 0
+    rcalfparams['kb'].vary = False
+
+    # Green
+    gcalfparams = gcalfmodel.make_params(
+        f = base[1],
+        phir = gcalps[1],
+        kr = gcalps[2],
+        phib = gcalps[3],
+        kb = gcalps[4],
+    )
+
+    gcalfparams['f'].vary = False
+    gcalfparams['phir'].min = 0
+    gcalfparams['kr'].vary = False
+    gcalfparams['phib'].min = 0
+    gcalfparams['kb'].vary = False
+
+    # Blue
+    bcalfparams = bcalfmodel.make_params(
+        f = base[2],
+        phir = bcalps[1],
+        kr = bcalps[2],
+        phib = bcalps[3],
+        kb = gcalps[4],
+    )
+
+    bcalfparams['f'].vary = False
+    bcalfparams['phir'].min = 0
+    bcalfparams['kr'].vary = False
+    bcalfparams['phib'].min = 0
+    bcalfparams['kb'].vary = False
+
+    # Fit
+    rcalfresult = rcalfmodel.fit(cdf.dR, rcalfparams, D = cdf.D)
+    gcalfresult = gcalfmodel.fit(cdf.dG, gcalfparams, D = cdf.D)
+    bcalfresult = bcalfmodel.fit(cdf.dB, bcalfparams, D = cdf.D)
+
+    # Parameter reorganization
+    caldf = pd.DataFrame({'f' : base[0], 'phir' : rcalfresult.params.get('phir').value, 'kr' : rcalps[2], 'phib' : rcalfresult.params.get('phib').value, 'kb' : rcalps[4]}, index=['R'])
+    tcaldf = pd.DataFrame({'f' : base[1], 'phir' : gcalfresult.params.get('phir').value, 'kr' : gcalps[2], 'phib' : gcalfresult.params.get('phib').value, 'kb' : gcalps[4]}, index=['G'])
+    caldf = pd.concat([caldf, tcaldf])
+    tcaldf = pd.DataFrame({'f' : base[2], 'phir' : bcalfresult.params.get('phir').value, 'kr' : bcalps[2], 'phib' : bcalfresult.params.get('phib').value, 'kb' : bcalps[4]}, index=['B'])
+    caldf = pd.concat([caldf, tcaldf])
+
+
+    # Calibration model, the rational seeds are fitted once here
+    calmodel = CalibrationModel.fromCalParms(caldf=caldf, config=config)
+
+    # Return the current scan calibration model, calibration dataframe and pixel size
+    cacheStore(config=config, key=key, value=(calmodel, cdf, sips))
+    return calmodel, cdf, sips
+
+def validatecalibf(cda=None, config=None, caldf=None, solver=None, progress=None):
+    """
+    A function to validate de calibration parameters
+
+    ...
+
+    Attributes
+    ----------
+    cda : 3D numpy array
+        Optical density array from the calibration film. Each dimension correspond to one color channel
+
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    caldf : CalibrationModel or pandas DataFrame
+        The current scan calibration model, or its multiphase calibration parameters
+
+    solver : str or None
+        The dose inversion solver: 'fsolve', 'newton', 'halley' or 'lut'. If None the [Solver] method in the configuration is used
+
+    progress : Progress or None
+        The progress reporter. If None a StreamlitProgress is used inside the app and a NullProgress otherwise
+
+    Returns
+    -------
+    validatecaliba : 1D numpy arrray
+        The array of doses predicted by the calibration model
+    """
+    progress = progressReporter(progress)
+
+    # Current scan calibration model
+    calmodel = calibrationModel(caldf=caldf, config=config)
+    rcalps, gcalps, bcalps = calmodel.calps
+    rratps, gratps, bratps = calmodel.ratps
+
+    # Dose calculation
+    solver, xtol, maxiter = solverParms(config=config, solver=solver)
+    if solver == 'fsolve':
+        adDr = np.zeros_like(cda[...,0])
+        adDg = np.zeros_like(cda[...,1])
+        adDb = np.zeros_like(cda[...,2])
+        nrs = cda.shape[0]
+        for j in progress.iterate(np.arange(nrs), desc='Validando la calibración:'):
+
+            # Red channel
+            adDr[j] = Ricalf(cda[j, 0], rcalps, rratps)
+
+            # Green channel
+            adDg[j] = Gicalf(cda[j, 1], gcalps, rratps)
+
+            # Blue channel
+            adDb[j] = Bicalf(cda[j, 2], bcalps, rratps)
+    else:
+        # The calibration optical densities are not scanner codes, lookup tables fall back to Newton
+        solver = 'newton' if solver == 'lut' else solver
+        adDr = icalfnewton(cda[..., 0], iratf(cda[..., 0], *rratps), *rcalps, method=solver, xtol=xtol, maxiter=maxiter)
+        adDg = icalfnewton(cda[..., 1], iratf(cda[..., 1], *gratps), *gcalps, method=solver, xtol=xtol, maxiter=maxiter)
+        adDb = icalfnewton(cda[..., 2], iratf(cda[..., 2], *bratps), *bcalps, method=solver, xtol=xtol, maxiter=maxiter)
+
+    Dmax = float(config['DosePlane']['Dmax'])
+    wr, wg, wb = float(config['NonLocalMeans']['wRed']), float(config['NonLocalMeans']['wGreen']), float(config['NonLocalMeans']['wBlue'])
+    wT = wr + wg + wb
+
+    validatecaliba = (wr*adDr + wg*adDg + wb*adDb)/wT
+
+    validatecaliba = np.nan_to_num(validatecaliba, posinf=1e10, neginf=-1e10)
+
+    validatecaliba[validatecaliba < 0] = 0
+
+    validatecaliba[validatecaliba > Dmax] = Dmax
+
+    # Return the dose array for validation purposes
+    return validatecaliba
+
+def mphspcnlmprocf(imfile=None, config=None, caldf=None, ccdf=None, solver=None, progress=None, workspace=None):
+    """
+    A function to process the dose distribution image using nonlocal means denoising and the multiphase calibration model with spatial correction
+
+    ...
+
+    Attributes
+    ----------
+    imfile : str or ScanImage
+        The name of the image file, the file containing the scanned image of the dose distribution, the calibration strip and the base strip in TIFF format, or the scan returned by segRegs.
+
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    caldf : CalibrationModel or pandas DataFrame
+        The current scan calibration model, or its multiphase calibration parameters
+
+    ccdf : pandas DataFrame
+        A data structure containing the relevant geometric parameters for the spatial correction
+
+    solver : str or None
+        The dose inversion solver: 'fsolve', 'newton', 'halley' or 'lut'. If None the [Solver] method in the configuration is used
+
+    progress : Progress or None
+        The progress reporter. If None a StreamlitProgress is used inside the app and a NullProgress otherwise
+
+    workspace : Workspace or None
+        The workspace of the region files when imfile is a file name. If None they are read next to the scan
+
+    Returns
+    -------
+    mphspcnlmprocim : 2D numpy arrray
+        The dose distribution
+    """
+    progress = progressReporter(progress)
+
+    # Denoise
+    udim = nlmf(config=config, im=scanRegion(imfile, 'Film', workspace=workspace), progress=progress)
+
+    # Optical density image
+    dim = np.log10(2**16/(udim+0.0000001))
+
+    # Current scan calibration model
+    calmodel = calibrationModel(caldf=caldf, config=config)
+    rcalps, gcalps, bcalps = calmodel.calps
+    rratps, gratps, bratps = calmodel.ratps
+
+    # Dose calculation
+    solver, xtol, maxiter = solverParms(config=config, solver=solver)
+    colsrcalps, colsgcalps, colsbcalps = calmodel.colsCalParms(ccdf=ccdf, ncols=dim.shape[1])
+    if solver == 'fsolve':
+        adDr = np.zeros_like(dim[...,0])
+        adDg = np.zeros_like(dim[...,1])
+        adDb = np.zeros_like(dim[...,2])
+        nrs = dim.shape[1]
+        for j in progress.iterate(np.arange(nrs), desc='Procesando la película'):
+            npx = dim.shape[0]
+            for i in np.arange(npx):
+
+                # Red channel
+                adDr[i, j] = Ricalf(dim[i, j, 0], colsrcalps[j], rratps)
+
+                # Green channel
+                adDg[i, j] = Gicalf(dim[i, j, 1], colsgcalps[j], rratps)
+
+                # Blue channel
+                adDb[i, j] = Bicalf(dim[i, j, 2], colsbcalps[j], rratps)
+    else:
+        if solver == 'lut':
+            Dim = lutDoseCalculationMphspcnlmprocf(udim, colsrcalps, colsgcalps, colsbcalps, rratps, gratps, bratps,
+                                                   nknots=int(config['Solver']['lutknots']), refine=int(config['Solver']['lutrefine']),
+                                                   xtol=xtol, maxiter=maxiter)
+        else:
+            Dim = imDoseCalculationMphspcnlmprocf(dim, colsrcalps, colsgcalps, colsbcalps, rratps, gratps, bratps,
+                                                  method=solver, xtol=xtol, maxiter=maxiter)
+        adDr, adDg, adDb = [Dim[..., ch].T for ch in range(3)]
+
+    Dmax = float(config['DosePlane']['Dmax'])
+    wr, wg, wb = float(config['NonLocalMeans']['wRed']), float(config['NonLocalMeans']['wGreen']), float(config['NonLocalMeans']['wBlue'])
+    wT = wr + wg + wb
+
+    mphspcnlmprocim = (wr*adDr + wg*adDg + wb*adDb)/wT
+
+    mphspcnlmprocim = np.nan_to_num(mphspcnlmprocim, posinf=1e10, neginf=-1e10)
+
+    mphspcnlmprocim[mphspcnlmprocim < 0] = 0
+
+    mphspcnlmprocim[mphspcnlmprocim > Dmax] = Dmax
+
+    # Return the dose image
+    return mphspcnlmprocim
+
+def premphspcnlmprocf(imfile=None, config=None, caldf=None, ccdf=None, solver=None, progress=None, workspace=None):
+    """
+    A function to preprocess the dose distribution image using nonlocal means denoising and the multiphase calibration model with spatial correction
+
+    ...
+
+    Attributes
+    ----------
+    imfile : str or ScanImage
+        The name of the image file, the file containing the scanned image of the dose distribution, the calibration strip and the base strip in TIFF format, or the scan returned by segRegs.
+
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    caldf : CalibrationModel or pandas DataFrame
+        The current scan calibration model, or its multiphase calibration parameters
+
+    ccdf : pandas DataFrame
+        A data structure containing the relevant geometric parameters for the spatial correction
+
+    solver : str or None
+        The dose inversion solver: 'fsolve', 'newton', 'halley' or 'lut'. If None the [Solver] method in the configuration is used
+
+    progress : Progress or None
+        The progress reporter. If None a ConsoleProgress is used, the text bar this function has always shown
+
+    workspace : Workspace or None
+        The workspace of the region files when imfile is a file name. If None they are read next to the scan
+
+    Returns
+    -------
+    mphspcnlmprocim : 2D numpy arrray
+        The dose distribution
+    """
+    progress = ConsoleProgress() if progress is None else progress
+
+    # Denoise
+    udim = nlmf(config=config, im=scanRegion(imfile, 'Film', workspace=workspace), progress=progress)
+
+    # Optical density image
+    dim = np.log10(2**16/(udim+0.0000001))
+
+    # Current scan calibration model
+    calmodel = calibrationModel(caldf=caldf, config=config)
+    rcalps, gcalps, bcalps = calmodel.calps
+    rratps, gratps, bratps = calmodel.ratps
+
+    dimcols = [dim[:, y, :] for y in np.arange(dim.shape[1])]
+    colsrcalps, colsgcalps, colsbcalps = calmodel.colsCalParms(ccdf=ccdf, ncols=dim.shape[1])
+
+    solver, xtol, maxiter = solverParms(config=config, solver=solver)
+    if solver == 'lut':
+        return lutDoseCalculationMphspcnlmprocf(udim, colsrcalps, colsgcalps, colsbcalps, rratps, gratps, bratps,
+                                                nknots=int(config['Solver']['lutknots']), refine=int(config['Solver']['lutrefine']),
+                                                xtol=xtol, maxiter=maxiter)
+    if solver != 'fsolve':
+        return imDoseCalculationMphspcnlmprocf(dim, colsrcalps, colsgcalps, colsbcalps, rratps, gratps, bratps,
+                                               method=solver, xtol=xtol, maxiter=maxiter)
+
+    Dim = np.array(
+        list(
+            progress.iterate(
+                map(wrapped_colDoseCalculationMphspcnlmprocf,
+                    [
+                        [dimcol,
+                         colsrcalps[col], colsgcalps[col], colsbcalps[col],
+                         rratps, gratps, bratps] for col, dimcol in enumerate(dimcols)
+                    ]
+                ), total=len(dimcols)
+            )
+        )
+    )
+    return Dim
+
+def mphspcnlmprocf_multiprocessing(imfile=None, config=None, caldf=None, ccdf=None, solver=None, progress=None, workspace=None):
+    """
+    A function to preprocess the dose distribution image using nonlocal means denoising and the multiphase calibration model with spatial correction
+
+    ...
+
+    Attributes
+    ----------
+    imfile : str or ScanImage
+        The name of the image file, the file containing the scanned image of the dose distribution, the calibration strip and the base strip in TIFF format, or the scan returned by segRegs.
+
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    caldf : CalibrationModel or pandas DataFrame
+        The current scan calibration model, or its multiphase calibration parameters
+
+    ccdf : pandas DataFrame
+        A data structure containing the relevant geometric parameters for the spatial correction
+
+    solver : str or None
+        The dose inversion solver: 'fsolve', 'newton', 'halley' or 'lut'. If None the [Solver] method in the configuration is used
+
+    progress : Progress or None
+        The progress reporter. If None a StreamlitProgress is used inside the app and a NullProgress otherwise
+
+    workspace : Workspace or None
+        The workspace of the region files when imfile is a file name. If None they are read next to the scan
+
+    Returns
+    -------
+    mphspcnlmprocim : 2D numpy arrray
+        The dose distribution, in the [Processing] precision
+    """
+    progress = progressReporter(progress)
+    im = scanRegion(imfile, 'Film', workspace=workspace)
+
+    # Current scan calibration model
+    calmodel = calibrationModel(caldf=caldf, config=config)
+    rcalps, gcalps, bcalps = calmodel.calps
+    rratps, gratps, bratps = calmodel.ratps
+
+    # Cached dose for the same film, calibration and processing settings
+    solver, xtol, maxiter = solverParms(config=config, solver=solver)
+    key = cacheKey('mphspcnlmprocf', im, calmodel.calps, ccdf.values, solver,
+                   configValues(config, 'Solver'), configValues(config, 'Models', ['oadcfile']),
+                   configValues(config, 'NonLocalMeans', ['patchsize', 'patchdistance', 'h', 'channelaxis']),
+                   configValues(config, 'Processing', ['precision']),
+                   fileStamp(config['DEFAULT']['configpath'] + config['Models']['oadcFile']))
+    Dim = cacheLoad(config=config, key=key)
+    if Dim is not None:
+        return Dim
+
+    # Denoise
+    udim = nlmf(config=config, im=im, progress=progress)
+
+    # Optical density image, in the [Processing] precision
+    dtype = processingDtype(config)
+    dim = opticalDensity(udim, dtype=dtype)
+
+    dimcols = [dim[:, y, :] for y in np.arange(dim.shape[1])]
+    colsrcalps, colsgcalps, colsbcalps = calmodel.colsCalParms(ccdf=ccdf, ncols=dim.shape[1])
+
+    if solver == 'lut':
+        Dim = lutDoseCalculationMphspcnlmprocf(udim, colsrcalps, colsgcalps, colsbcalps, rratps, gratps, bratps,
+                                               nknots=int(config['Solver']['lutknots']), refine=int(config['Solver']['lutrefine']),
+                                               xtol=xtol, maxiter=maxiter, dtype=dtype)
+    elif config['Processing']['backend'] == 'sharedmemory':
+        # Finished tiles of an interrupted calculation of the same film and settings are not calculated again
+        checkpoint = doseCheckpoint(config=config, key=key, shape=(dim.shape[1], dim.shape[0], dim.shape[2]), dtype=dtype)
+        try:
+            with usePool(config) as p:
+                Dim = shmDoseCalculationMphspcnlmprocf(dim, colsrcalps, colsgcalps, colsbcalps, rratps, gratps, bratps,
+                                                       pool=p, tilecols=int(config['Processing']['tilecols']),
+                                                       method=solver, xtol=xtol, maxiter=maxiter, progress=progress,
+                                                       checkpoint=checkpoint, maxinflight=poolWorkers(config) + 1)
+        except BaseException:
+            if checkpoint is not None:
+                checkpoint.close()
+            raise
+        if checkpoint is not None:
+            checkpoint.remove()
+    elif solver != 'fsolve':
+        Dim = imDoseCalculationMphspcnlmprocf(dim, colsrcalps, colsgcalps, colsbcalps, rratps, gratps, bratps,
+                                              method=solver, xtol=xtol, maxiter=maxiter)
+    else:
+        with usePool(config) as p:
+            Dim = np.array(
+                list(
+                    progress.iterate(
+                         p.imap(wrapped_colDoseCalculationMphspcnlmprocf,
+                                  [[dimcol,
+                                    colsrcalps[col], colsgcalps[col], colsbcalps[col],
+                                    rratps, gratps, bratps] for col, dimcol in enumerate(dimcols)]
+                         ), total=len(dimcols), desc='Procecesando la película:'
+                    )
+                )
+            )
+
+    cacheStore(config=config, key=key, value=Dim)
+    return Dim
+
+def mphspcnlmprocf_streaming(imfile=None, config=None, caldf=None, ccdf=None, solver=None, progress=None, workspace=None, Dmax=None, outfile=None):
+    """
+    A function to process the dose distribution image strip by strip with bounded memory: non-local means denoising,
+    multiphase calibration model with spatial correction and channel combination
+
+    The film is split in strips of [Processing] striprows rows. Every strip is read from the scan with the non-local
+    means halo, denoised, converted to optical density and dose, and combined as postmphspcnlmprocf in a worker of the
+    persistent pool, and the parent writes it into a memory mapped npy file. At most one strip more than the workers is
+    in flight, so the peak memory is a small multiple of the strip size whatever the film size. The full image arrays of
+    mphspcnlmprocf_multiprocessing are never built and the result is not cached.
+
+    ...
+
+    Attributes
+    ----------
+    imfile : str or ScanImage
+        The name of the image file, the file containing the scanned image of the dose distribution, the calibration strip and the base strip in TIFF format, or the scan returned by segRegs. Only the scan reads the film strips lazily from disk, the region file is read whole.
+
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    caldf : CalibrationModel or pandas DataFrame
+        The current scan calibration model, or its multiphase calibration parameters
+
+    ccdf : pandas DataFrame
+        A data structure containing the relevant geometric parameters for the spatial correction
+
+    solver : str or None
+        The dose inversion solver: 'fsolve', 'newton', 'halley' or 'lut'. If None the [Solver] method in the configuration is used
+
+    progress : Progress or None
+        The progress reporter. If None a StreamlitProgress is used inside the app and a NullProgress otherwise
+
+    workspace : Workspace or None
+        The workspace of the region files when imfile is a file name, and of the output file
+
+    Dmax : float or None
+        The maximum dose. If None the Streamlit session Dmax is used when running inside the app, the [DosePlane] Dmax otherwise
+
+    outfile : str, Path or None
+        The npy file of the dose distribution. If None fDim.npy in the workspace, or a new file in the temporary directory
+        without a workspace
+
+    Returns
+    -------
+    mphspcnlmprocim : 2D numpy memmap
+        The dose distribution with shape (columns, rows), as returned by postmphspcnlmprocf, in the [Processing] precision
+    """
+    progress = progressReporter(progress)
+    im = scanRegion(imfile, 'Film', workspace=workspace)
+    nrows, ncols, _nchs = im.shape
+
+    # Current scan calibration model, corrected for every column once
+    calmodel = calibrationModel(caldf=caldf, config=config)
+    colscalps = calmodel.colsCalParms(ccdf=ccdf, ncols=ncols)
+    solverparms = list(solverParms(config=config, solver=solver)) + [int(config['Solver']['lutknots']), int(config['Solver']['lutrefine'])]
+    Dmax = doseMax(config=config, Dmax=Dmax)
+
+    nlmkw = nlmParms(config=config)
+    halo = nlmkw['patch_size'] // 2 + nlmkw['patch_distance'] + 1
+    striprows = int(config['Processing']['striprows'])
+    strips = [(r0, min(r0 + striprows, nrows)) for r0 in range(0, nrows, striprows)]
+
+    dtype = processingDtype(config)
+    if outfile is None:
+        outfile = workspaceFile(workspace, 'fDim.npy', Path(tempfile.gettempdir()) / ('fDim.%s.npy' % uuid4().hex))
+    mphspcnlmprocim = np.lib.format.open_memmap(outfile, mode='w+', dtype=dtype, shape=(ncols, nrows))
+
+    def collect():
+        (r0, r1), result = inflight.popleft()
+        mphspcnlmprocim[:, r0:r1] = result.get()
+        progress.update()
+
+    with usePool(config) as p:
+        maxinflight = poolWorkers(config) + 1
+        inflight = deque()
+        progress.start(total=len(strips), desc='Procesando la película:')
+        for r0, r1 in strips:
+            h0, h1 = max(r0 - halo, 0), min(r1 + halo, nrows)
+            parl = [np.array(im[h0:h1]), (r0 - h0, r1 - h0), nlmkw, colscalps, calmodel.ratps, solverparms, config, Dmax, dtype]
+            inflight.append(((r0, r1), p.apply_async(streamStripf, (parl,))))
+            if len(inflight) >= maxinflight:
+                collect()
+        while inflight:
+            collect()
+        progress.finish()
+    mphspcnlmprocim.flush()
+    return mphspcnlmprocim
+
+def streamStripf(parl):
+    """
+    A function to convert a strip of the film to the combined dose. It is an accessory function for multiprocessing. It should not be call outside the mphspcnlmprocf_streaming function.
+
+    ...
+
+    Attributes
+    ----------
+    parl : list
+        The strip with halo rows, the first and last (excluded) row of the strip without halo, the denoise_nl_means
+        keyword arguments, the column calibration parameters with shape (3, columns, 5), the rational parameters, the
+        solver settings (method, xtol, maxiter, lutknots and lutrefine), the configuration, the maximum dose and the
+        precision
+
+    Returns
+    -------
+    mphspcnlmprocim : 2D numpy arrray
+        The dose of the strip with shape (columns, rows)
     """
-    A function to validate de calibration parameters
+
+    strip, (i0, i1), nlmkw, colscalps, ratps, (method, xtol, maxiter, nknots, refine), config, Dmax, dtype = parl
+    fstrip = img_as_float32(strip) if dtype == np.float32 else img_as_float(strip)
+    udim = img_as_uint(denoise_nl_means(fstrip, **nlmkw))[i0:i1]
+    if method == 'lut':
+        Dim = lutDoseCalculationMphspcnlmprocf(udim, *colscalps, *ratps, nknots=nknots, refine=refine, xtol=xtol, maxiter=maxiter, dtype=dtype)
+    else:
+        dim = opticalDensity(udim, dtype=dtype)
+        if method == 'fsolve':
+            Dim = np.stack([colDoseCalculationMphspcnlmprocf([dim[:, col, :], *colscalps[:, col], *ratps]) for col in range(dim.shape[1])])
+        else:
+            Dim = imDoseCalculationMphspcnlmprocf(dim, *colscalps, *ratps, method=method, xtol=xtol, maxiter=maxiter)
+    return postmphspcnlmprocf(Dim, config=config, Dmax=Dmax)
+
+def precisionReport(imfile=None, config=None, caldf=None, ccdf=None, solver=None, Dmax=None, progress=None, workspace=None):
+    """
+    A function to measure the accuracy and the cost of the float32 precision against float64 for a film
+
+    The dose of the film is calculated twice by mphspcnlmprocf_multiprocessing, with [Processing] precision float64 and
+    float32 and the cache disabled, and the doses combined by postmphspcnlmprocf are compared.
 
     ...
 
     Attributes
     ----------
-    cda : 3D numpy array
-        Optical density array from the calibration film. Each dimension correspond to one color channel
+    imfile, config, caldf, ccdf, solver, progress, workspace :
+        As in mphspcnlmprocf_multiprocessing
+
+    Dmax : float or None
+        The maximum dose. If None the Streamlit session Dmax is used when running inside the app, the [DosePlane] Dmax otherwise
+
+    Returns
+    -------
+    report : dict
+        maxerr, meanerr and p99err: the maximum, mean and 99th percentile of the absolute dose difference in Gy;
+        dxffraction: the fraction of pixels whose dose rounded to the two decimals of the dxf output differs;
+        time64 and time32: the seconds spent in the dose calculation; nbytes64 and nbytes32: the size of the dose of
+        the three channels in bytes
+    """
+
+    report = {}
+    doses = {}
+    for precision in ('float64', 'float32'):
+        pconfig = configparser.ConfigParser()
+        pconfig.read_dict(config)
+        pconfig['Processing']['precision'] = precision
+        pconfig['Cache']['enabled'] = 'False'
+        t0 = time.perf_counter()
+        Dim = mphspcnlmprocf_multiprocessing(imfile=imfile, config=pconfig, caldf=caldf, ccdf=ccdf, solver=solver, progress=progress, workspace=workspace)
+        report['time' + precision[-2:]] = time.perf_counter() - t0
+        report['nbytes' + precision[-2:]] = Dim.nbytes
+        doses[precision] = np.asarray(postmphspcnlmprocf(Dim, config=pconfig, Dmax=Dmax), dtype=np.float64)
+
+    err = np.abs(doses['float32'] - doses['float64'])
+    report.update(maxerr=float(err.max(initial=0)), meanerr=float(err.mean()), p99err=float(np.percentile(err, 99)),
+                  dxffraction=float(np.mean(np.round(doses['float32'], 2) != np.round(doses['float64'], 2))))
+    return report
+
+def colDoseCalculationMphspcnlmprocf(parl):
+    """
+    A function to calculate the dose for every color channel in every pixel of a given colummn from the optical density image
+    It is an accessory function for multiprocessing. It should not be call outside the premphspcnlmprocf function.
+
+    ...
+
+    Attributes
+    ----------
+
+    Returns
+    -------
+    Dimcol : 2D numpy arrray
+        The column dose distribution for the three color channels
+    """
+
+    dimcol = parl[0]
+    colrcalps = parl[1]
+    colgcalps = parl[2]
+    colbcalps = parl[3]
+    rratps = parl[4]
+    gratps = parl[5]
+    bratps = parl[6]
+
+    Dimcol  = np.empty_like(dimcol)
+
+    for i in np.arange(len(dimcol)):
+        # Red channel
+        Dimcol[i, 0] = Ricalf(dimcol[i, 0], colrcalps, rratps)
+
+        # Green channel
+        Dimcol[i, 1] = Gicalf(dimcol[i, 1], colgcalps, gratps)
+
+        # Blue channel
+        Dimcol[i, 2] = Bicalf(dimcol[i, 2], colbcalps, bratps)
+
+    return Dimcol
+
+def wrapped_colDoseCalculationMphspcnlmprocf(parl):
+    return colDoseCalculationMphspcnlmprocf(parl)
+
+# Persistent worker pool, shared by every film and every Streamlit session of the process
+_pool = None
+_poolLock = threading.RLock()
+_poolStats = {'workers' : 0, 'starts' : 0, 'startup' : None, 'calls' : 0, 'first' : None, 'last' : None, 'users' : 0}
+_scheduler = None
+_jobs = {}
+_jobQueue = {}
+_jobExecutor = None
+_jobLimits = {'workers' : 0, 'retention' : 24., 'finished' : 16}
+
+def poolWorkers(config=None):
+    """
+    A function to read the number of workers of the persistent pool from the configuration
+
+    ...
 
+    Attributes
+    ----------
     config : ConfigParser
         An object with the functionalities of the configparser module
 
-    caldf : pandas DataFrame
-        The current scan calibration parameters
+    Returns
+    -------
+    workers : int
+        The [Processing] workers value, or the number of CPUs when it is 0
+    """
+
+    workers = int(config['Processing']['workers'])
+    return workers if workers > 0 else os.cpu_count()
+
+def poolWarmup(_i=None):
+    """
+    An internal module use function run once in every worker when the pool starts, so the module imports and the process spawning are paid before the first film.
+    """
+
+    return os.getpid()
+
+def getPool(config=None):
+    """
+    A function to get the persistent worker pool, starting it on first use
+
+    The pool lives at module level, so it is reused by every call and every Streamlit session and rerun of the process.
+    It is restarted if the configured number of workers changes, but only when no usePool block is running: another
+    session's job may be iterating its results, the new size is applied once the pool is idle.
+
+    ...
+
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
 
     Returns
     -------
-    validatecaliba : 1D numpy arrray
-        The array of doses predicted by the calibration model
+    pool : multiprocessing Pool
+        The warm worker pool
     """
 
-    # Current multiphase calibration parameters
-    rcalps = caldf.iloc[0].values
-    gcalps = caldf.iloc[1].values
-    bcalps = caldf.iloc[2].values
+    global _pool
+    workers = poolWorkers(config)
+    with _poolLock:
+        if _pool is not None and _poolStats['workers'] != workers and _poolStats['users'] == 0:
+            shutdownPool()
+        if _pool is None:
+            t0 = time.perf_counter()
+            # Start the resource tracker before forking, so the workers share it for the shared memory blocks
+            resource_tracker.ensure_running()
+            _pool = Pool(workers)
+            _pool.map(poolWarmup, range(workers), chunksize=1)
+            _poolStats['workers'] = workers
+            _poolStats['starts'] += 1
+            _poolStats['startup'] = time.perf_counter() - t0
+        return _pool
+
+def shutdownPool():
+    """
+    A function to stop the persistent worker pool. The next getPool call starts a new one.
+    It is called automatically when the interpreter exits.
+
+    ...
 
-    # Rational approximation
+    Returns
+    -------
+    No value returned
+    """
 
-    # Define models
-    rratfmodel = Model(iratf)
-    gratfmodel = Model(iratf)
-    bratfmodel = Model(iratf)
+    global _pool
+    with _poolLock:
+        if _pool is not None:
+            _pool.terminate()
+            _pool.join()
+            _pool = None
+            _poolStats['workers'] = 0
 
-    # Initialize parameters
-    rratparams = rratfmodel.make_params(
-        a = 0.1,
-        b = 0.1,
-        c = 0.1
-    )
+atexit.register(shutdownPool)
 
-    gratparams = gratfmodel.make_params(
-        a = 0.1,
-        b = 0.1,
-        c = 0.1
-    )
+@contextmanager
+def usePool(config=None):
+    """
+    A context manager to run work in the persistent worker pool and record its latency
+    Unlike 'with Pool()' the pool is not closed on exit. The running blocks are counted, getPool never restarts the
+    pool while one of them is using it.
 
-    bratparams = bratfmodel.make_params(
-        a = 0.1,
-        b = 0.1,
-        c = 0.1
-    )
+    ...
 
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
 
-    # Generate calibration points
+    Returns
+    -------
+    pool : multiprocessing Pool
+        The warm worker pool
+    """
 
-    vDrat = np.array([0.5, 0.75, 1., 1.25, 1.5, 2., 3., 4., 5., 7., 9.])
+    t0 = time.perf_counter()
+    with _poolLock:
+        pool = getPool(config)
+        _poolStats['users'] += 1
+    try:
+        yield pool
+    finally:
+        elapsed = time.perf_counter() - t0
+        with _poolLock:
+            _poolStats['users'] -= 1
+            _poolStats['calls'] += 1
+            if _poolStats['first'] is None:
+                _poolStats['first'] = elapsed
+            _poolStats['last'] = elapsed
+
+def poolStats():
+    """
+    A function to get the usage statistics of the persistent worker pool
 
-    vdrrat =  calf(vDrat, *rcalps)
-    vdgrat =  calf(vDrat, *gcalps)
-    vdbrat =  calf(vDrat, *bcalps)
+    ...
 
-    # Fit
-    rratfit = rratfmodel.fit(data=vDrat, params=rratparams, d=vdrrat)
-    gratfit = gratfmodel.fit(data=vDrat, params=gratparams, d=vdgrat)
-    bratfit = bratfmodel.fit(data=vDrat, params=bratparams, d=vdbrat)
+    Returns
+    -------
+    stats : dict
+        workers: number of running workers (0 if stopped), starts: number of pool starts,
+        startup: seconds spent starting and warming the last pool, calls: number of usePool blocks,
+        first and last: seconds spent in the first and the last usePool blocks (first and repeat film latency),
+        users: number of usePool blocks running
+    """
+
+    with _poolLock:
+        return dict(_poolStats)
+
+class JobScheduler:
+    """
+    A class to admit the film processing jobs of every Streamlit session of the process
+
+    The jobs share the persistent worker pool, so running several of them at once only splits the same workers and
+    slows every film down. The scheduler lets at most maxjobs jobs run, the others wait in a priority queue (lower
+    values first, in arrival order for the same priority) and are told their queue position and the estimated time to
+    start, from the duration of the last jobs.
+
+    ...
+
+    Attributes
+    ----------
+    maxjobs : int
+        The maximum number of jobs running at the same time
+
+    durations : deque
+        The duration in seconds of the last finished jobs
+    """
+
+    def __init__(self, maxjobs=1, history=10):
+        self.maxjobs = maxjobs
+        self.durations = deque(maxlen=history)
+        self._cond = threading.Condition()
+        self._queue = []
+        self._running = {}
+        self._seq = count()
+
+    def _admissible(self, ticket):
+        free = self.maxjobs - len(self._running)
+        return free > 0 and ticket in heapq.nsmallest(free, self._queue)
+
+    def _position(self, ticket):
+        return 1 + sum(1 for queued in self._queue if queued < ticket)
+
+    def _eta(self, ticket):
+        if not self.durations:
+            return None
+        mean = sum(self.durations)/len(self.durations)
+        now = time.perf_counter()
+        # Simulated slots: the remaining time of the running jobs, then the queued jobs ahead of the ticket
+        slots = [max(mean - (now - t0), 0.) for t0 in self._running.values()]
+        slots += [0.] * max(self.maxjobs - len(slots), 0)
+        heapq.heapify(slots)
+        for _i in range(self._position(ticket) - 1):
+            heapq.heapreplace(slots, slots[0] + mean)
+        return slots[0]
+
+    def queued(self, ticket):
+        """
+        A method to get the queue position and the estimated time to start of a ticket
+
+        ...
+
+        Attributes
+        ----------
+        ticket : tuple
+            The job ticket returned by enqueue
+
+        Returns
+        -------
+        position : int
+            The queue position, 0 when the ticket is no longer queued
+
+        eta : float or None
+            The estimated time to start in seconds, 0 when the ticket is no longer queued and None without finished jobs
+        """
+
+        with self._cond:
+            if ticket not in self._queue:
+                return 0, 0.
+            return self._position(ticket), self._eta(ticket)
+
+    def status(self):
+        """
+        A method to get the state of the jobs
+
+        ...
+
+        Returns
+        -------
+        jobs : list
+            A dict for every job: name, priority, state ('running' or 'queued'), position (0 when running) and eta
+            in seconds (None without finished jobs)
+        """
+
+        with self._cond:
+            jobs = [{'name' : ticket[2], 'priority' : ticket[0], 'state' : 'running', 'position' : 0, 'eta' : 0.}
+                    for ticket in self._running]
+            jobs += [{'name' : ticket[2], 'priority' : ticket[0], 'state' : 'queued', 'position' : self._position(ticket), 'eta' : self._eta(ticket)}
+                     for ticket in sorted(self._queue)]
+            return jobs
+
+    @contextmanager
+    def job(self, name='', priority=0, report=None, interval=1.):
+        """
+        A context manager to run a job when it is admitted. It blocks while the job is queued
+
+        ...
+
+        Attributes
+        ----------
+        name : str
+            The job name, shown in status
+
+        priority : int
+            The job priority, lower values first
+
+        report : callable or None
+            Called as report(position, eta) every interval seconds while the job is queued
+
+        interval : float
+            The report interval in seconds
+
+        Returns
+        -------
+        ticket : tuple
+            The job ticket (priority, sequence number and name)
+        """
+
+        ticket = self.enqueue(name=name, priority=priority)
+        self.admit(ticket, report=report, interval=interval)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def enqueue(self, name='', priority=0):
+        """
+        A method to queue a job without waiting for its turn. The job is then started with admit and ended with release
+
+        ...
+
+        Attributes
+        ----------
+        name : str
+            The job name, shown in status
+
+        priority : int
+            The job priority, lower values first
+
+        Returns
+        -------
+        ticket : tuple
+            The job ticket (priority, sequence number and name)
+        """
+
+        with self._cond:
+            ticket = (priority, next(self._seq), name)
+            heapq.heappush(self._queue, ticket)
+            return ticket
+
+    def admit(self, ticket, report=None, interval=1.):
+        """
+        A method to wait until a queued ticket is admitted and mark it running. If the wait fails the ticket leaves the
+        queue
+
+        ...
+
+        Attributes
+        ----------
+        ticket : tuple
+            The job ticket returned by enqueue
+
+        report : callable or None
+            Called as report(position, eta) every interval seconds while the job is queued
+
+        interval : float
+            The report interval in seconds
+        """
+
+        with self._cond:
+            try:
+                while not self._admissible(ticket):
+                    if report is not None:
+                        report(self._position(ticket), self._eta(ticket))
+                    self._cond.wait(interval)
+            finally:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+            self._running[ticket] = time.perf_counter()
+
+    def release(self, ticket):
+        """
+        A method to end a running ticket, recording its duration
+        """
+
+        with self._cond:
+            self.durations.append(time.perf_counter() - self._running.pop(ticket))
+            self._cond.notify_all()
+
+def getScheduler(config=None):
+    """
+    A function to get the job scheduler of the process, creating it on first use
+
+    Like the worker pool it lives at module level and is shared by every Streamlit session. Its maximum number of
+    running jobs follows the [Processing] maxjobs value.
+
+    ...
+
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    Returns
+    -------
+    scheduler : JobScheduler
+        The job scheduler
+    """
+
+    global _scheduler
+    maxjobs = max(1, int(config['Processing']['maxjobs']))
+    with _poolLock:
+        if _scheduler is None:
+            _scheduler = JobScheduler(maxjobs=maxjobs)
+    with _scheduler._cond:
+        if _scheduler.maxjobs != maxjobs:
+            _scheduler.maxjobs = maxjobs
+            _scheduler._cond.notify_all()
+    return _scheduler
+
+class BackgroundJob:
+    """
+    A class to represent a film processing job run in the background, polled by the page that submitted it
+
+    The job lives in the module, not in the Streamlit session, so it goes on through reruns and browser refreshes and
+    the page finds it again by its id.
+
+    ...
+
+    Attributes
+    ----------
+    id : str
+        The job id, a random hex string
+
+    name : str
+        The job name, the scan file name for the film jobs
+
+    state : str
+        'queued', 'running', 'done' or 'failed'
+
+    stage : str
+        The description of the running stage
+
+    position : int
+        The queue position while queued, 0 once running
+
+    eta : float or None
+        The estimated time to start in seconds while queued
+
+    progress : Progress
+        The progress of the running loop, polled through its done, total and desc attributes
+
+    results : dict
+        The partial results, filled as the stages finish
+
+    error : str or None
+        The error message of a failed job
+
+    submitted, finished : float or None
+        The submission and end times, as returned by time.time
+
+    workspace : Workspace or None
+        The workspace the job reads and writes, kept by workspaceClean until the job ends
+
+    ticket : tuple or None
+        The job scheduler ticket
+    """
+
+    def __init__(self, name='', workspace=None):
+        self.id = uuid4().hex
+        self.name = name
+        self.workspace = workspace
+        self.ticket = None
+        self.state = 'queued'
+        self.stage = ''
+        self.position, self.eta = 0, None
+        self.progress = Progress()
+        self.results = {}
+        self.error = None
+        self.submitted, self.finished = time.time(), None
+
+    def report(self, position=0, eta=None):
+        """
+        A method to record the queue position and the estimated time to start, the report callback of JobScheduler.job
+        """
+
+        self.position, self.eta = position, eta
+
+def runJob():
+    """
+    An internal module use function to run the first queued background job through the job scheduler and record its end
+    state. The executor runs one call per submitted job, so every job runs, in the scheduler order
+    """
+
+    with _poolLock:
+        ticket = min(_jobQueue)
+        job, target, config, kwargs = _jobQueue.pop(ticket)
+    scheduler = getScheduler(config)
+    try:
+        scheduler.admit(ticket, report=job.report)
+        try:
+            job.state, job.position, job.eta = 'running', 0, 0.
+            target(job=job, config=config, **kwargs)
+        finally:
+            scheduler.release(ticket)
+        job.state = 'done'
+    except Exception as e:
+        job.state, job.error = 'failed', '%s: %s' % (type(e).__name__, e)
+    finally:
+        job.finished = time.time()
+
+def pruneJobs():
+    """
+    An internal module use function to forget the finished jobs older than the retention time and the oldest finished
+    jobs beyond the maximum number kept. It is called with _poolLock held
+    """
+
+    finished = sorted((job for job in _jobs.values() if job.finished is not None), key=lambda job: job.finished)
+    now = time.time()
+    old = [job for job in finished if now - job.finished > _jobLimits['retention']]
+    old += finished[len(old):max(len(finished) - _jobLimits['finished'], len(old))]
+    for job in old:
+        del _jobs[job.id]
+
+def submitJob(target=None, config=None, name='', priority=1, **kwargs):
+    """
+    A function to run a job in the background. It returns at once
+
+    The job is queued in the job scheduler at once, so it has a queue position and an estimated time to start, and it
+    runs in a thread of the module executor when admitted. The executor has one thread per scheduler slot, the heavy
+    loops still run in the persistent worker pool. Finished jobs older than [Processing] jobretention hours, and the
+    oldest ones beyond [Processing] maxfinishedjobs, are forgotten.
+
+    ...
+
+    Attributes
+    ----------
+    target : callable
+        The job function, called as target(job=job, config=config, **kwargs). It records its stage, progress and
+        results in the job
+
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    name : str
+        The job name
+
+    priority : int
+        The job priority, lower values first
+
+    kwargs :
+        The keyword arguments of target. The workspace argument is also recorded as the job workspace
+
+    Returns
+    -------
+    jobid : str
+        The job id, to be passed to getJob
+    """
+
+    global _jobExecutor
+    scheduler = getScheduler(config)
+    job = BackgroundJob(name=name, workspace=kwargs.get('workspace'))
+    with _poolLock:
+        _jobLimits['retention'] = float(config['Processing']['jobretention']) * 3600
+        _jobLimits['finished'] = int(config['Processing']['maxfinishedjobs'])
+        pruneJobs()
+        job.ticket = scheduler.enqueue(name=name, priority=priority)
+        job.report(*scheduler.queued(job.ticket))
+        _jobs[job.id] = job
+        _jobQueue[job.ticket] = (job, target, config, kwargs)
+        # A wider executor for more slots. The calls queued in the previous one still run there
+        if _jobExecutor is None or _jobLimits['workers'] != scheduler.maxjobs:
+            if _jobExecutor is not None:
+                _jobExecutor.shutdown(wait=False)
+            _jobExecutor = ThreadPoolExecutor(max_workers=scheduler.maxjobs, thread_name_prefix='filmqa-job')
+            _jobLimits['workers'] = scheduler.maxjobs
+        _jobExecutor.submit(runJob)
+    return job.id
+
+def getJob(jobid=None):
+    """
+    A function to get a background job by its id
+
+    ...
+
+    Attributes
+    ----------
+    jobid : str
+        The job id returned by submitJob
+
+    Returns
+    -------
+    job : BackgroundJob or None
+        The job, None if unknown (a restarted server or a forgotten job)
+    """
+
+    with _poolLock:
+        pruneJobs()
+        job = _jobs.get(jobid)
+    if job is not None and job.state == 'queued' and _scheduler is not None:
+        job.report(*_scheduler.queued(job.ticket))
+    return job
+
+def jobWorkspaces():
+    """
+    A function to get the names of the workspaces of the queued and running background jobs
+    """
+
+    with _poolLock:
+        pruneJobs()
+        return {job.workspace.name for job in _jobs.values() if job.workspace is not None and job.state in ('queued', 'running')}
+
+def filmJob(job=None, config=None, imfile=None, bbfile=None, bbdf=None, workspace=None, Dmax=None):
+    """
+    A function to process a film scan from its labelled regions to the dose distribution, the target of the background
+    jobs of the app. Streamlit is not used: the job thread has no session, the job progress and Dmax are passed to
+    every stage instead of the session defaults
+
+    ...
+
+    Attributes
+    ----------
+    job : BackgroundJob
+        The job. Its results are pxsp, the scan pixel spacing, after the segmentation, calmodel, cddf and fps after the
+        calibration and, after the dose calculation, fDim with Dmax or Dim without it. The per channel Dim is not kept
+        once fDim is built. With the [Processing] streaming pipeline there is no Dim and fDim is a memory mapped file of
+        the workspace
+
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    imfile : str or Path
+        The name of the image file, a snapshot of the upload (see workspaceSnapshot) for the jobs of the app
+
+    bbfile : str or Path or None
+        The bounding box file. If None the bb.csv file of the workspace
+
+    bbdf : pandas DataFrame or None
+        The bounding boxes. If given bbfile is not read, so the page can label the next scan meanwhile
+
+    workspace : Workspace or None
+        The workspace of the session
+
+    Dmax : float or None
+        The maximum dose of the post-processing. If None fDim is not calculated
+
+    Returns
+    -------
+    No value returned
+    """
+
+    job.stage = 'Segmentación'
+    scan = segRegs(imfile=imfile, bbfile=bbfile, bbdf=bbdf, workspace=workspace)
+    job.results['pxsp'] = TIFFPixelSpacing(imfile=scan)
+    job.stage = 'Determinación del fondo'
+    cdf = coordOAC(imfile=scan)
+    abase = baseDetermination(imfile=scan, config=config)
+    job.stage = 'Calibración'
+    calmodel, cddf, fps = PDDCalibration(config=config, imfile=scan, base=abase, progress=job.progress)
+    job.results.update(calmodel=calmodel, cddf=cddf, fps=fps)
+    job.stage = 'Cálculo de la dosis'
+    if config['Processing']['pipeline'] == 'streaming':
+        # The channels are combined strip by strip, Dim is never built
+        if Dmax is not None:
+            job.results['fDim'] = mphspcnlmprocf_streaming(imfile=scan, config=config, caldf=calmodel, ccdf=cdf, progress=job.progress, workspace=workspace,
+                                                           Dmax=Dmax, outfile=None if workspace is None else workspace.file('fDim.%s.npy' % job.id))
+        return
+    Dim = mphspcnlmprocf_multiprocessing(imfile=scan, config=config, caldf=calmodel, ccdf=cdf, progress=job.progress, workspace=workspace)
+    if Dmax is None:
+        job.results['Dim'] = Dim
+    else:
+        job.results['fDim'] = postmphspcnlmprocf(Dim, config=config, Dmax=Dmax)
+
+def shmAttach(name=None):
+    """
+    A function to attach to an existing shared memory block from a worker process
+    The block is not tracked by the worker, its owner is the process that created it and unlinks it.
+
+    ...
+
+    Attributes
+    ----------
+    name : str
+        The name of the shared memory block
+
+    Returns
+    -------
+    shm : SharedMemory
+        The attached shared memory block
+    """
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13: the pool workers share the resource tracker of the owner, the block stays registered once
+        return shared_memory.SharedMemory(name=name)
+
+def shmTileDoseCalculationMphspcnlmprocf(parl):
+    """
+    A function to calculate the dose of a range of columns of the optical density image stored in shared memory
+    It is an accessory function for multiprocessing. It should not be call outside the shmDoseCalculationMphspcnlmprocf function.
+
+    ...
+
+    Attributes
+    ----------
+    parl : list
+        The shared memory descriptors (name, shape, dtype) of the optical density image, the column parameters and the output
+        dose, the first and last (excluded) column of the tile, the rational parameters and the solver settings
+
+    Returns
+    -------
+    tile : tuple
+        The first and last (excluded) column of the calculated tile
+    """
+
+    (dimdesc, calpsdesc, Dimdesc), (c0, c1), ratps, (method, xtol, maxiter) = parl
+    blocks = [shmAttach(name) for name, _shape, _dtype in (dimdesc, calpsdesc, Dimdesc)]
+    try:
+        dim, colscalps, Dim = [np.ndarray(shape, dtype=dtype, buffer=shm.buf) for shm, (_name, shape, dtype) in zip(blocks, (dimdesc, calpsdesc, Dimdesc))]
+        if method == 'fsolve':
+            for col in range(c0, c1):
+                Dim[col] = colDoseCalculationMphspcnlmprocf([dim[:, col, :], *colscalps[:, col], *ratps])
+        else:
+            Dim[c0:c1] = imDoseCalculationMphspcnlmprocf(dim[:, c0:c1, :], *colscalps[:, c0:c1], *ratps,
+                                                         method=method, xtol=xtol, maxiter=maxiter)
+        del dim, colscalps, Dim
+    finally:
+        for shm in blocks:
+            shm.close()
+    return c0, c1
+
+def shmDoseCalculationMphspcnlmprocf(dim, colsrcalps, colsgcalps, colsbcalps, rratps, gratps, bratps, pool=None, tilecols=16, method='fsolve', xtol=1.49012e-08, maxiter=50, progress=None, checkpoint=None, maxinflight=None):
+    """
+    A function to calculate the dose of the optical density image in a process pool through shared memory
+
+    The optical density image and the per column parameters are placed once in shared memory blocks. The workers receive
+    only ranges of tilecols columns and write the dose straight into a shared output block, so no image data is pickled.
+    At most maxinflight tiles are submitted to the pool at a time. If the calculation fails or is interrupted, the tiles
+    already submitted finish before the blocks are released, so no work is left in the pool against released blocks.
+
+    ...
+
+    Attributes
+    ----------
+    dim : 3D numpy array
+        The optical density image with shape (rows, columns, channels)
+
+    colsrcalps, colsgcalps, colsbcalps : 2D numpy arrays
+        The spatially corrected multiphase parameters of every column, with shape (columns, 5)
+
+    rratps, gratps, bratps : 1D numpy arrays
+        The rational approximation parameters of every channel, used as seeds
+
+    pool : multiprocessing Pool
+        The process pool doing the calculation
+
+    tilecols : int
+        The number of columns dispatched in every task
+
+    method, xtol, maxiter :
+        The solver settings: 'fsolve' solves every pixel as colDoseCalculationMphspcnlmprocf, 'newton' or 'halley' solve each tile with icalfnewton
+
+    progress : Progress or None
+        The progress reporter. If None a StreamlitProgress is used inside the app and a NullProgress otherwise
+
+    checkpoint : DoseCheckpoint or None
+        The checkpoint of the finished tiles. Its tiles are not calculated again and the new ones are added to it
 
-    # Rational calibration paramters
-    rratps = np.array([k.value for k in rratfit.params.values()])
-    gratps = np.array([k.value for k in gratfit.params.values()])
-    bratps = np.array([k.value for k in bratfit.params.values()])
+    maxinflight : int or None
+        The maximum number of tiles submitted to the pool at a time. If None the number of CPUs plus one
 
-    # Dose calculation
-    adDr = np.zeros_like(cda[...,0])
-    adDg = np.zeros_like(cda[...,1])
-    adDb = np.zeros_like(cda[...,2])
-    nrs = cda.shape[0]
-    for j in stqdm(np.arange(nrs), st_container=st.sidebar, desc='Validando la calibración:'):
+    Returns
+    -------
+    Dim : 3D numpy arrray
+        The dose distribution for the three color channels with shape (columns, rows, channels), in the precision of dim
+    """
 
-        # Red channel
-        adDr[j] = Ricalf(cda[j, 0], rcalps, rratps)
+    progress = progressReporter(progress)
+    maxinflight = os.cpu_count() + 1 if maxinflight is None else maxinflight
+    nrows, ncols, nchs = dim.shape
+    shapes = [(nrows, ncols, nchs), (3, ncols, 5), (ncols, nrows, nchs)]
+    # Every block in the precision of dim
+    dtype = np.result_type(dim, np.float32)
+    blocks = []
+    inflight = deque()
+
+    def collect():
+        c0, c1 = inflight.popleft().get()
+        if checkpoint is not None:
+            checkpoint.add(c0, c1, sDim[c0:c1])
+        progress.update()
+
+    try:
+        for shape in shapes:
+            blocks.append(shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize)))
+        sdim, scalps, sDim = [np.ndarray(shape, dtype=dtype, buffer=shm.buf) for shm, shape in zip(blocks, shapes)]
+        sdim[...] = dim
+        scalps[...] = np.stack([colsrcalps, colsgcalps, colsbcalps])
+
+        descs = [(shm.name, shape, dtype.str) for shm, shape in zip(blocks, shapes)]
+        tiles = [(c0, min(c0 + tilecols, ncols)) for c0 in range(0, ncols, tilecols)]
+        if checkpoint is not None:
+            tiles = [tile for tile in tiles if tile not in checkpoint.tiles]
+        progress.start(total=len(tiles), desc='Procesando la película:')
+        for tile in tiles:
+            inflight.append(pool.apply_async(shmTileDoseCalculationMphspcnlmprocf,
+                                             ([descs, tile, [rratps, gratps, bratps], [method, xtol, maxiter]],)))
+            if len(inflight) >= maxinflight:
+                collect()
+        while inflight:
+            collect()
+        progress.finish()
+
+        Dim = sDim.copy() if checkpoint is None else np.array(checkpoint.Dim)
+        del sdim, scalps, sDim
+    finally:
+        # The submitted tiles still write to the blocks
+        for result in inflight:
+            result.wait()
+        if checkpoint is not None:
+            checkpoint.save()
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return Dim
 
-        # Green channel
-        adDg[j] = Gicalf(cda[j, 1], gcalps, rratps)
+class DoseCheckpoint:
+    """
+    A class to keep the finished tiles of a dose calculation on disk, so an interrupted calculation resumes only the
+    missing tiles
 
-        # Blue channel
-        adDb[j] = Bicalf(cda[j, 2], bcalps, rratps)
+    The dose is a memory mapped npy file and the finished tiles are listed in a json manifest, both in a directory named
+    after the cache key of the calculation (the film, the calibration and the processing settings). The manifest is
+    replaced atomically after the dose file is flushed, so it never lists a tile that is not on disk. A lock file created
+    with O_EXCL keeps a directory to one run at a time: the lock of a dead process is taken over, a held one raises
+    FileExistsError.
 
-    Dmax = float(config['DosePlane']['Dmax'])
-    wr, wg, wb = float(config['NonLocalMeans']['wRed']), float(config['NonLocalMeans']['wGreen']), float(config['NonLocalMeans']['wBlue'])
-    wT = wr + wg + wb
+    ...
 
-    validatecaliba = (wr*adDr + wg*adDg + wb*adDb)/wT
+    Attributes
+    ----------
+    path : Path
+        The checkpoint directory
 
-    validatecaliba = np.nan_to_num(validatecaliba, posinf=1e10, neginf=-1e10)
+    key : str
+        The cache key of the dose calculation
 
-    validatecaliba[validatecaliba < 0] = 0
+    Dim : 3D numpy memmap
+        The dose distribution with shape (columns, rows, channels), valid in the finished tiles
 
-    validatecaliba[validatecaliba > Dmax] = Dmax
+    tiles : set
+        The finished tiles, (first, last excluded) column
 
-    # Return the dose array for validation purposes
-    return validatecaliba
+    resume : bool
+        If False the directory belongs to this run only, it is not resumed and it is removed by close
+    """
 
-def mphspcnlmprocf(imfile=None, config=None, caldf=None, ccdf=None):
+    def __init__(self, path=None, key=None, shape=None, tilecols=16, interval=2., dtype=np.float64, resume=True):
+        self.path = Path(path)
+        self.key = key
+        self.interval = interval
+        self.resume = resume
+        self._pending = []
+        self._last = time.perf_counter()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lockfile = self.path / 'lock'
+        if not self.lock():
+            raise FileExistsError('Checkpoint in use by another run: ' + str(self.path))
+        manifest = self.path / 'manifest.json'
+        dosefile = self.path / 'Dim.npy'
+        self.tiles = set()
+        try:
+            if not resume:
+                raise FileNotFoundError(manifest)
+            saved = json.loads(manifest.read_text())
+            if saved['key'] == key and tuple(saved['shape']) == tuple(shape) and saved['tilecols'] == tilecols and saved['dtype'] == np.dtype(dtype).str:
+                self.Dim = np.lib.format.open_memmap(dosefile, mode='r+')
+                self.tiles = {tuple(tile) for tile in saved['tiles']}
+        except (OSError, ValueError, KeyError):
+            pass
+        self.manifest = {'key' : key, 'shape' : list(shape), 'dtype' : np.dtype(dtype).str, 'tilecols' : tilecols, 'tiles' : sorted(self.tiles)}
+        if not self.tiles:
+            self.Dim = np.lib.format.open_memmap(dosefile, mode='w+', dtype=dtype, shape=tuple(shape))
+            self.save()
+
+    def lock(self):
+        """
+        A method to take the lock of the checkpoint directory, a file with the process id created with O_EXCL
+
+        ...
+
+        Returns
+        -------
+        locked : bool
+            True if the lock is taken, False if another live run holds it
+        """
+
+        for _attempt in range(2):
+            try:
+                fd = os.open(self._lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    pid = int(self._lockfile.read_text())
+                except (OSError, ValueError):
+                    # Being written by its owner
+                    return False
+                try:
+                    os.kill(pid, 0)
+                    return False
+                except PermissionError:
+                    return False
+                except OSError:
+                    # The owner died without releasing it, an interrupted run to be resumed
+                    self._lockfile.unlink(missing_ok=True)
+                    continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(str(os.getpid()))
+            return True
+        return False
+
+    def close(self):
+        """
+        A method to release the checkpoint of an unfinished calculation, kept for a later run to resume it
+
+        ...
+
+        Returns
+        -------
+        No value returned
+        """
+
+        if not self.resume:
+            self.remove()
+            return
+        self._lockfile.unlink(missing_ok=True)
+
+    def add(self, c0=None, c1=None, tile=None):
+        """
+        A method to store a finished tile. The manifest is written at most every interval seconds
+
+        ...
+
+        Attributes
+        ----------
+        c0, c1 : int
+            The first and last (excluded) column of the tile
+
+        tile : 3D numpy array
+            The dose of the tile with shape (c1 - c0, rows, channels)
+
+        Returns
+        -------
+        No value returned
+        """
+
+        self.Dim[c0:c1] = tile
+        self._pending.append((c0, c1))
+        if time.perf_counter() - self._last >= self.interval:
+            self.save()
+
+    def save(self):
+        """
+        A method to flush the dose file and write the manifest with every stored tile
+
+        ...
+
+        Returns
+        -------
+        No value returned
+        """
+
+        self.Dim.flush()
+        self.tiles.update(self._pending)
+        self._pending = []
+        self.manifest['tiles'] = sorted(self.tiles)
+        manifest = self.path / 'manifest.json'
+        with tempfile.NamedTemporaryFile('w', dir=self.path, prefix='manifest.', suffix='.tmp', delete=False) as f:
+            f.write(dumps(self.manifest))
+        os.replace(f.name, manifest)
+        self._last = time.perf_counter()
+
+    def remove(self):
+        """
+        A method to remove the checkpoint once the dose is complete
+
+        ...
+
+        Returns
+        -------
+        No value returned
+        """
+
+        del self.Dim
+        shutil.rmtree(self.path, ignore_errors=True)
+
+def doseCheckpoint(config=None, key=None, shape=None, dtype=np.float64):
     """
-    A function to process the dose distribution image using nonlocal means denoising and the multiphase calibration model with spatial correction
+    A function to open the checkpoint of a dose calculation, resuming a previous one with the same key, after removing
+    the checkpoints older than [Processing] checkpointmaxage hours. When another run of the same key holds its
+    checkpoint, this run gets a directory of its own that is not resumed
 
     ...
 
     Attributes
     ----------
-    imfile : str
-        The name of the image file, the file containing the scanned image of the dose distribution, the calibration strip and the base strip in TIFF format.
-
     config : ConfigParser
         An object with the functionalities of the configparser module
 
-    caldf : pandas DataFrame
-        The current scan calibration parameters
+    key : str
+        The cache key of the dose calculation
 
-    ccdf : pandas DataFrame
-        A data structure containing the relevant geometric parameters for the spatial correction
+    shape : tuple
+        The shape of the dose distribution (columns, rows, channels)
+
+    dtype : numpy dtype
+        The precision of the dose distribution
 
     Returns
     -------
-    mphspcnlmprocim : 2D numpy arrray
-        The dose distribution
+    checkpoint : DoseCheckpoint or None
+        The checkpoint in the [Processing] checkpointpath directory, or None if [Processing] checkpoint is off
     """
 
-    dosefilename = Path(imfile)
-    dosefilename = dosefilename.with_suffix('.Film.tif')
-
-    # Denoise
-    udim = nlmf(dosefilename, config)
-
-    # Optical density image
-    dim = np.log10(2**16/(udim+0.0000001))
-
-    # Current multiphase calibration parameters
-    rcalps = caldf.iloc[0].values
-    gcalps = caldf.iloc[1].values
-    bcalps = caldf.iloc[2].values
-
-    # Spatial correction functions
-    recadc = np.load(config['DEFAULT']['configpath'] + config['Models']['oadcFile'], allow_pickle=True)
-    phiRrf = recadc[0, 0].item()
-    phiGrf = recadc[0, 1].item()
-    phiBrf = recadc[0, 2].item()
-    phiRbf = recadc[1, 0].item()
-    phiGbf = recadc[1, 1].item()
-    phiBbf = recadc[1, 2].item()
-
-    # Rational approximation
-
-    # Define models
-    rratfmodel = Model(iratf)
-    gratfmodel = Model(iratf)
-    bratfmodel = Model(iratf)
-
-    # Initialize parameters
-    rratparams = rratfmodel.make_params(
-        a = 0.1,
-        b = 0.1,
-        c = 0.1
-    )
+    if not config.getboolean('Processing', 'checkpoint'):
+        return None
+    root = Path(config['Processing']['checkpointpath'])
+    maxage = float(config['Processing']['checkpointmaxage']) * 3600
+    for path in root.glob('*'):
+        try:
+            if path.name != key and time.time() - path.stat().st_mtime > maxage:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            continue
+    tilecols = int(config['Processing']['tilecols'])
+    try:
+        return DoseCheckpoint(path=root / key, key=key, shape=shape, tilecols=tilecols, dtype=dtype)
+    except FileExistsError:
+        return DoseCheckpoint(path=root / ('%s.%s' % (key, uuid4().hex)), key=key, shape=shape, tilecols=tilecols, dtype=dtype, resume=False)
+
+def doseMax(config=None, Dmax=None):
+    """
+    A function to get the maximum dose of the post-processing
 
-    gratparams = gratfmodel.make_params(
-        a = 0.1,
-        b = 0.1,
-        c = 0.1
-    )
+    ...
 
-    bratparams = bratfmodel.make_params(
-        a = 0.1,
-        b = 0.1,
-        c = 0.1
-    )
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
 
+    Dmax : float or None
+        The maximum dose given by the caller
 
-    # Generate calibration points
+    Returns
+    -------
+    Dmax : float
+        Dmax if given, else the Streamlit session Dmax when called from a script thread of the app (see
+        streamlitSession), the [DosePlane] Dmax otherwise
+    """
 
-    vDrat = np.array([0.5, 0.75, 1., 1.25, 1.5, 2., 3., 4., 5., 7., 9.])
+    if Dmax is None:
+        Dmax = float(config['DosePlane']['Dmax'])
+        st = streamlitSession()
+        if st is not None and 'Dmax' in st.session_state:
+            Dmax = st.session_state.Dmax
+    return Dmax
 
-    vdrrat =  calf(vDrat, *rcalps)
-    vdgrat =  calf(vDrat, *gcalps)
-    vdbrat =  calf(vDrat, *bcalps)
+def postmphspcnlmprocf(Dim=None, config=None, Dmax=None):
+    """
+    Postprocessing the dose distribution image
 
-    # Fit
-    rratfit = rratfmodel.fit(data=vDrat, params=rratparams, d=vdrrat)
-    gratfit = gratfmodel.fit(data=vDrat, params=gratparams, d=vdgrat)
-    bratfit = bratfmodel.fit(data=vDrat, params=bratparams, d=vdbrat)
+    ...
 
-    # Rational calibration paramters
-    rratps = np.array([k.value for k in rratfit.params.values()])
-    gratps = np.array([k.value for k in gratfit.params.values()])
-    bratps = np.array([k.value for k in bratfit.params.values()])
+    Attributes
+    ----------
+    Dim : 3D numpy array
+        A numpy array with the image dose from every color channel
 
-    # Dose calculation
-    adDr = np.zeros_like(dim[...,0])
-    adDg = np.zeros_like(dim[...,1])
-    adDb = np.zeros_like(dim[...,2])
-    nrs = dim.shape[1]
-    for j in stqdm(np.arange(nrs), st_container=st.sidebar, desc='Procesando la película'):
-        xc = np.abs(ccdf.o - ccdf.c) * ccdf.s / 25.4
-        x = np.abs(ccdf.o - (ccdf.p0 + j)) * ccdf.s / 25.4
-        npx = dim.shape[0]
-        for i in np.arange(npx):
+    config : ConfigParser
+        An object with the functionalities of the configparser module
 
-            # Red channel
-            f, phir, kr, phib, kb = rcalps
-            rcalcps = np.array([f, phir * phiRrf(x)/phiRrf(xc), kr, phib * phiRbf(x)/phiRbf(xc), kb])
-            adDr[i, j] = Ricalf(dim[i, j, 0], rcalcps, rratps)
+    Dmax : float or None
+        The maximum dose. If None the Streamlit session Dmax is used when running inside the app, the [DosePlane] Dmax otherwise
 
-            # Green channel
-            f, phir, kr, phib, kb = gcalps
-            gcalcps = np.array([f, phir * phiGrf(x)/phiGrf(xc), kr, phib * phiGbf(x)/phiGbf(xc), kb])
-            adDg[i, j] = Gicalf(dim[i, j, 1], gcalcps, rratps)
+    Returns
+    -------
+    mphspcnlmprocim : 2D numpy arrray
+        The dose distribution
 
-            # Blue channel
-            f, phir, kr, phib, kb = bcalps
-            bcalcps = np.array([f, phir * phiBrf(x)/phiBrf(xc), kr, phib * phiBbf(x)/phiBbf(xc), kb])
-            adDb[i, j] = Bicalf(dim[i, j, 2], bcalcps, rratps)
+    """
+    Dmax = doseMax(config=config, Dmax=Dmax)
 
-    Dmax = float(config['DosePlane']['Dmax'])
     wr, wg, wb = float(config['NonLocalMeans']['wRed']), float(config['NonLocalMeans']['wGreen']), float(config['NonLocalMeans']['wBlue'])
     wT = wr + wg + wb
 
-    mphspcnlmprocim = (wr*adDr + wg*adDg + wb*adDb)/wT
+    mphspcnlmprocim = (wr*Dim[..., 0] + wg*Dim[..., 1] + wb*Dim[..., 2])/wT
 
     mphspcnlmprocim = np.nan_to_num(mphspcnlmprocim, posinf=1e10, neginf=-1e10)
 
@@ -1136,310 +4954,399 @@ def mphspcnlmprocf(imfile=None, config=None, caldf=None, ccdf=None):
     # Return the dose image
     return mphspcnlmprocim
 
-def premphspcnlmprocf(imfile=None, config=None, caldf=None, ccdf=None):
+def configValues(config=None, section=None, keys=None):
     """
-    A function to preprocess the dose distribution image using nonlocal means denoising and the multiphase calibration model with spatial correction
+    A function to get the values of a configuration section as a hashable tuple
 
     ...
 
     Attributes
     ----------
-    imfile : str
-        The name of the image file, the file containing the scanned image of the dose distribution, the calibration strip and the base strip in TIFF format.
-
     config : ConfigParser
         An object with the functionalities of the configparser module
 
-    caldf : pandas DataFrame
-        The current scan calibration parameters
+    section : str
+        The configuration section
 
-    ccdf : pandas DataFrame
-        A data structure containing the relevant geometric parameters for the spatial correction
+    keys : list or None
+        The keys to take into account. If None every key of the section is used
 
     Returns
     -------
-    mphspcnlmprocim : 2D numpy arrray
-        The dose distribution
+    values : tuple
+        The sorted (key, value) pairs
     """
-    dosefilename = Path(imfile)
-    dosefilename = dosefilename.with_suffix('.Film.tif')
 
-    # Denoise
-    udim = nlmf(dosefilename, config)
+    keys = config[section].keys() if keys is None else keys
+    return tuple(sorted((key, config[section][key]) for key in keys))
 
-    # Optical density image
-    dim = np.log10(2**16/(udim+0.0000001))
+def fileStamp(filename=None):
+    """
+    A function to identify the version of a file by its name, size and modification time
 
-    # Current multiphase calibration parameters
-    rcalps = caldf.iloc[0].values
-    gcalps = caldf.iloc[1].values
-    bcalps = caldf.iloc[2].values
+    ...
 
-    # Spatial correction functions
-    recadc = np.load(config['DEFAULT']['configpath'] + config['Models']['oadcFile'], allow_pickle=True)
-    phiRrf = recadc[0, 0].item()
-    phiGrf = recadc[0, 1].item()
-    phiBrf = recadc[0, 2].item()
-    phiRbf = recadc[1, 0].item()
-    phiGbf = recadc[1, 1].item()
-    phiBbf = recadc[1, 2].item()
-
-    # Rational approximation
-
-    # Define models
-    rratfmodel = Model(iratf)
-    gratfmodel = Model(iratf)
-    bratfmodel = Model(iratf)
-
-    # Initialize parameters
-    rratparams = rratfmodel.make_params(
-        a = 0.1,
-        b = 0.1,
-        c = 0.1
-    )
+    Attributes
+    ----------
+    filename : str or Path
+        The file name
 
-    gratparams = gratfmodel.make_params(
-        a = 0.1,
-        b = 0.1,
-        c = 0.1
-    )
+    Returns
+    -------
+    stamp : tuple
+        The file name, size and modification time in nanoseconds, or only the name if the file does not exist
+    """
 
-    bratparams = bratfmodel.make_params(
-        a = 0.1,
-        b = 0.1,
-        c = 0.1
-    )
+    try:
+        st_ = os.stat(filename)
+    except OSError:
+        return (str(filename),)
+    return (str(filename), st_.st_size, st_.st_mtime_ns)
 
+# On-disk cache: the format version is part of every key, it changes with the layout of the cached values
+CACHEVERSION = 2
 
-    # Generate calibration points
+def cacheKey(*parts):
+    """
+    A function to calculate the content address of a cache entry, for the current CACHEVERSION
 
-    vDrat = np.array([0.5, 0.75, 1., 1.25, 1.5, 2., 3., 4., 5., 7., 9.])
+    ...
 
-    vdrrat =  calf(vDrat, *rcalps)
-    vdgrat =  calf(vDrat, *gcalps)
-    vdbrat =  calf(vDrat, *bcalps)
+    Attributes
+    ----------
+    parts :
+        The inputs identifying the entry: numpy arrays (hashed by dtype, shape and bytes), strings, numbers or tuples of them
 
-    # Fit
-    rratfit = rratfmodel.fit(data=vDrat, params=rratparams, d=vdrrat)
-    gratfit = gratfmodel.fit(data=vDrat, params=gratparams, d=vdgrat)
-    bratfit = bratfmodel.fit(data=vDrat, params=bratparams, d=vdbrat)
+    Returns
+    -------
+    key : str
+        The SHA-256 hex digest of the parts
+    """
 
-    # Rational calibration paramters
-    rratps = np.array([k.value for k in rratfit.params.values()])
-    gratps = np.array([k.value for k in gratfit.params.values()])
-    bratps = np.array([k.value for k in bratfit.params.values()])
+    h = hashlib.sha256()
+    h.update(repr(('CACHEVERSION', CACHEVERSION)).encode() + b'\0')
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            h.update(repr((part.dtype.str, part.shape)).encode())
+            h.update(part.data if part.dtype != object else repr(part.tolist()).encode())
+        else:
+            h.update(repr(part).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+def cachePath(config=None, key=None):
+    """
+    A function to get the file of a cache entry
 
-    DimcolsList = []
-    dimcols = [dim[:, y, :] for y in np.arange(dim.shape[1])]
-    xc = np.abs(ccdf.o - ccdf.c) * ccdf.s / 25.4
+    ...
 
-    Dim = np.array(
-        list(
-            tqdm(
-                map(wrapped_colDoseCalculationMphspcnlmprocf,
-                    [
-                        [col, dimcol, ccdf, xc, rcalps, gcalps, bcalps,
-                        phiRrf, phiRbf, phiGrf, phiGbf, phiBrf, phiBbf,
-                        rratps, gratps, bratps] for col, dimcol in enumerate(dimcols)
-                    ]
-                ), total=len(dimcols)
-            )
-        )
-    )
-    return Dim
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
 
-def mphspcnlmprocf_multiprocessing(imfile=None, config=None, caldf=None, ccdf=None):
+    key : str
+        The cache key
+
+    Returns
+    -------
+    path : Path
+        The cache entry file, in the [Cache] path directory
     """
-    A function to preprocess the dose distribution image using nonlocal means denoising and the multiphase calibration model with spatial correction
+
+    return Path(config['Cache']['path']) / (key + '.pkl')
+
+def cacheLoad(config=None, key=None):
+    """
+    A function to read a cache entry. A hit refreshes its access time for the LRU eviction
 
     ...
 
     Attributes
     ----------
-    imfile : str
-        The name of the image file, the file containing the scanned image of the dose distribution, the calibration strip and the base strip in TIFF format.
+    config : ConfigParser
+        An object with the functionalities of the configparser module
+
+    key : str
+        The cache key
+
+    Returns
+    -------
+    value : object or None
+        The cached value, or None if the cache is disabled or the entry is missing or unreadable. An entry that cannot
+        be unpickled, for instance a value of a class changed since it was stored, is removed
+    """
+
+    if not config.getboolean('Cache', 'enabled'):
+        return None
+    path = cachePath(config=config, key=key)
+    try:
+        with open(path, 'rb') as f:
+            value = pickle.load(f)
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        path.unlink(missing_ok=True)
+        return None
+    return value
+
+def cacheStore(config=None, key=None, value=None):
+    """
+    A function to write a cache entry and evict the least recently used entries over the [Cache] quota
 
+    ...
+
+    Attributes
+    ----------
     config : ConfigParser
         An object with the functionalities of the configparser module
 
-    caldf : pandas DataFrame
-        The current scan calibration parameters
+    key : str
+        The cache key
 
-    ccdf : pandas DataFrame
-        A data structure containing the relevant geometric parameters for the spatial correction
+    value : object
+        The value to be cached, it must be picklable
 
     Returns
     -------
-    mphspcnlmprocim : 2D numpy arrray
-        The dose distribution
+    No value returned
     """
-    dosefilename = Path(imfile)
-    dosefilename = dosefilename.with_suffix('.Film.tif')
 
-    # Denoise
-    udim = nlmf(dosefilename, config)
+    if not config.getboolean('Cache', 'enabled'):
+        return
+    path = cachePath(config=config, key=key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first so that concurrent readers never see a partial entry. Its name is unique, the
+    # background jobs of the app store from threads of the same process
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.stem + '.', suffix='.tmp', delete=False) as f:
+        tmppath = Path(f.name)
+        try:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except BaseException:
+            f.close()
+            tmppath.unlink(missing_ok=True)
+            raise
+    os.replace(tmppath, path)
+    cacheEvict(config=config)
+
+def cacheEvict(config=None):
+    """
+    A function to remove the least recently used cache entries until the cache fits in the [Cache] quota (MB)
 
-    # Optical density image
-    dim = np.log10(2**16/(udim+0.0000001))
+    ...
 
-    # Current multiphase calibration parameters
-    rcalps = caldf.iloc[0].values
-    gcalps = caldf.iloc[1].values
-    bcalps = caldf.iloc[2].values
+    Attributes
+    ----------
+    config : ConfigParser
+        An object with the functionalities of the configparser module
 
-    # Spatial correction functions
-    scfile = config['DEFAULT']['configpath']+config['Models']['oadcFile']
-    recadc = np.load(scfile, allow_pickle=True)
-    phiRrf = recadc[0, 0].item()
-    phiGrf = recadc[0, 1].item()
-    phiBrf = recadc[0, 2].item()
-    phiRbf = recadc[1, 0].item()
-    phiGbf = recadc[1, 1].item()
-    phiBbf = recadc[1, 2].item()
-
-    # Rational approximation
-
-    # Define models
-    rratfmodel = Model(iratf)
-    gratfmodel = Model(iratf)
-    bratfmodel = Model(iratf)
-
-    # Initialize parameters
-    rratparams = rratfmodel.make_params(
-        a = 0.1,
-        b = 0.1,
-        c = 0.1
-    )
+    Returns
+    -------
+    No value returned
+    """
 
-    gratparams = gratfmodel.make_params(
-        a = 0.1,
-        b = 0.1,
-        c = 0.1
-    )
+    quota = float(config['Cache']['quota']) * 2**20
+    entries = []
+    for path in Path(config['Cache']['path']).glob('*.pkl'):
+        try:
+            st_ = path.stat()
+        except OSError:
+            continue
+        entries.append((st_.st_mtime, st_.st_size, path))
+    total = sum(size for _mtime, size, _path in entries)
+    for _mtime, size, path in sorted(entries, key=lambda e: e[0]):
+        if total <= quota:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+
+# The Workspace objects alive in the process, held by the Streamlit sessions, the jobs and the batch tool
+_workspaces = weakref.WeakSet()
+
+class Workspace:
+    """
+    A class to represent the working directory of a session or a batch job
 
-    bratparams = bratfmodel.make_params(
-        a = 0.1,
-        b = 0.1,
-        c = 0.1
-    )
+    Every intermediate file of a scan (the copy of the upload, its preview, the annotations, the bounding box file and
+    the region files) is written in the workspace instead of the shared img_dir and tmp directories, so concurrent
+    sessions never overwrite each other. The workspaces are removed by workspaceClean, except those of the Workspace
+    objects still alive: an open session keeps its own in its state, however long it stays idle.
 
+    ...
 
-    # Generate calibration points
+    Attributes
+    ----------
+    name : str
+        The workspace name, a random hex string unless given
 
-    vDrat = np.array([0.5, 0.75, 1., 1.25, 1.5, 2., 3., 4., 5., 7., 9.])
+    path : Path
+        The workspace directory, in the [Workspace] path directory
+    """
 
-    vdrrat =  calf(vDrat, *rcalps)
-    vdgrat =  calf(vDrat, *gcalps)
-    vdbrat =  calf(vDrat, *bcalps)
+    # The marker file touched on every access. The directory modification time does not change when a file inside is
+    # rewritten in place, so it cannot tell an active workspace
+    MARKER = '.used'
 
-    # Fit
-    rratfit = rratfmodel.fit(data=vDrat, params=rratparams, d=vdrrat)
-    gratfit = gratfmodel.fit(data=vDrat, params=gratparams, d=vdgrat)
-    bratfit = bratfmodel.fit(data=vDrat, params=bratparams, d=vdbrat)
+    def __init__(self, config=None, name=None):
+        self.name = uuid4().hex if name is None else name
+        self.path = Path(config['Workspace']['path']) / self.name
+        self.touch()
+        with _poolLock:
+            _workspaces.add(self)
 
-    # Rational calibration paramters
-    rratps = np.array([k.value for k in rratfit.params.values()])
-    gratps = np.array([k.value for k in gratfit.params.values()])
-    bratps = np.array([k.value for k in bratfit.params.values()])
+    def touch(self):
+        """
+        A method to create the directory if needed and mark it as used, so that it is not removed by workspaceClean
 
+        ...
 
-    DimcolsList = []
-    dimcols = [dim[:, y, :] for y in np.arange(dim.shape[1])]
-    xc = np.abs(ccdf.o - ccdf.c) * ccdf.s / 25.4
-    xl = [np.abs(ccdf.o - (ccdf.p0 + col)) * ccdf.s / 25.4 for col, dimcol in enumerate(dimcols)]
-    colsrcalps = np.array([rcalps * np.array([1, phiRrf(x)/phiRrf(xc), 1, phiRbf(x)/phiRbf(xc), 1]) for x in xl], dtype=object)
-    colsgcalps = np.array([gcalps * np.array([1, phiGrf(x)/phiGrf(xc), 1, phiGbf(x)/phiGbf(xc), 1]) for x in xl], dtype=object)
-    colsbcalps = np.array([bcalps * np.array([1, phiBrf(x)/phiBrf(xc), 1, phiBbf(x)/phiBbf(xc), 1]) for x in xl], dtype=object)
-
-    with Pool(None) as p:
-        Dim = np.array(
-            list(
-                stqdm(
-                     p.imap(wrapped_colDoseCalculationMphspcnlmprocf,
-                              [[dimcol,
-                                colsrcalps[col], colsgcalps[col], colsbcalps[col],
-                                rratps, gratps, bratps] for col, dimcol in enumerate(dimcols)]
-                     ), total=len(dimcols), st_container=st.sidebar, desc='Procecesando la película:'
-                )
-            )
-        )
-    return Dim
+        Returns
+        -------
+        No value returned
+        """
 
-def colDoseCalculationMphspcnlmprocf(parl):
+        self.path.mkdir(parents=True, exist_ok=True)
+        (self.path / self.MARKER).touch()
+
+    def file(self, name=None):
+        """
+        A method to get a file of the workspace
+
+        ...
+
+        Attributes
+        ----------
+        name : str
+            The file name
+
+        Returns
+        -------
+        path : Path
+            The file in the workspace directory
+        """
+
+        self.touch()
+        return self.path / name
+
+    def remove(self):
+        """
+        A method to remove the workspace directory and all its files
+
+        ...
+
+        Returns
+        -------
+        No value returned
+        """
+
+        shutil.rmtree(self.path, ignore_errors=True)
+
+def workspaceFile(workspace=None, name=None, default=None):
     """
-    A function to calculate the dose for every color channel in every pixel of a given colummn from the optical density image
-    It is an accessory function for multiprocessing. It should not be call outside the premphspcnlmprocf function.
+    A function to get a file in a workspace or its shared default
 
     ...
 
     Attributes
     ----------
+    workspace : Workspace or None
+        The workspace
+
+    name : str
+        The file name in the workspace
+
+    default : str or Path
+        The file used without a workspace
 
     Returns
     -------
-    Dimcol : 2D numpy arrray
-        The column dose distribution for the three color channels
+    path : Path
+        The file
     """
 
-    dimcol = parl[0]
-    colrcalps = parl[1]
-    colgcalps = parl[2]
-    colbcalps = parl[3]
-    rratps = parl[4]
-    gratps = parl[5]
-    bratps = parl[6]
+    return Path(default) if workspace is None else workspace.file(name)
 
-    Dimcol  = np.empty_like(dimcol)
+def workspaceSnapshot(workspace=None, imfile=None, tag=None):
+    """
+    A function to freeze a file of a workspace under a name of its own, so a queued job keeps reading it when a new
+    upload with the same name replaces the original. The snapshot is a hard link, a copy where links are not supported
 
-    for i in np.arange(len(dimcol)):
-        # Red channel
-        Dimcol[i, 0] = Ricalf(dimcol[i, 0], colrcalps, rratps)
+    ...
 
-        # Green channel
-        Dimcol[i, 1] = Gicalf(dimcol[i, 1], colgcalps, gratps)
+    Attributes
+    ----------
+    workspace : Workspace
+        The workspace
 
-        # Blue channel
-        Dimcol[i, 2] = Bicalf(dimcol[i, 2], colbcalps, bratps)
+    imfile : str or Path
+        The file to be frozen, in the workspace
 
-    return Dimcol
+    tag : str or None
+        The prefix of the snapshot name. If None a random hex string
 
-def wrapped_colDoseCalculationMphspcnlmprocf(parl):
-    return colDoseCalculationMphspcnlmprocf(parl)
+    Returns
+    -------
+    snapshot : Path
+        The snapshot, <tag>.<file name> in the workspace
+    """
 
-def postmphspcnlmprocf(Dim=None, config=None):
+    imfile = Path(imfile)
+    snapshot = workspace.file('%s.%s' % (uuid4().hex if tag is None else tag, imfile.name))
+    try:
+        os.link(imfile, snapshot)
+    except OSError:
+        shutil.copyfile(imfile, snapshot)
+    return snapshot
+
+def workspaceClean(config=None, keep=()):
     """
-    Postprocessing the dose distribution image
+    A function to remove the workspaces unused for more than [Workspace] maxage (hours) and then the least recently
+    used ones until all of them fit in the [Workspace] quota (MB)
+
+    The last use is the time of the Workspace marker file. The workspaces still in use are never removed: those of
+    the live Workspace objects of the process (the open sessions, however long idle, and the jobs) and those of the
+    queued and running background jobs.
 
     ...
 
     Attributes
     ----------
-    Dim : 3D numpy array
-        A numpy array with the image dose from every color channel
-
     config : ConfigParser
         An object with the functionalities of the configparser module
 
+    keep : list
+        The names of other workspaces in use, never removed
+
     Returns
     -------
-    mphspcnlmprocim : 2D numpy arrray
-        The dose distribution
-
+    removed : list
+        The names of the removed workspaces
     """
-    Dmax = float(config['DosePlane']['Dmax'])
-    if 'Dmax' in st.session_state:
-        Dmax = st.session_state.Dmax
-
-    wr, wg, wb = float(config['NonLocalMeans']['wRed']), float(config['NonLocalMeans']['wGreen']), float(config['NonLocalMeans']['wBlue'])
-    wT = wr + wg + wb
-
-    mphspcnlmprocim = (wr*Dim[..., 0] + wg*Dim[..., 1] + wb*Dim[..., 2])/wT
 
-    mphspcnlmprocim = np.nan_to_num(mphspcnlmprocim, posinf=1e10, neginf=-1e10)
-
-    mphspcnlmprocim[mphspcnlmprocim < 0] = 0
-
-    mphspcnlmprocim[mphspcnlmprocim > Dmax] = Dmax
-
-    # Return the dose image
-    return mphspcnlmprocim
+    maxage = float(config['Workspace']['maxage']) * 3600
+    quota = float(config['Workspace']['quota']) * 2**20
+    with _poolLock:
+        keep = set(keep) | {workspace.name for workspace in list(_workspaces)} | jobWorkspaces()
+    now = time.time()
+    entries = []
+    for path in Path(config['Workspace']['path']).glob('*'):
+        try:
+            marker = path / Workspace.MARKER
+            mtime = (marker if marker.exists() else path).stat().st_mtime
+            size = sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+        except OSError:
+            continue
+        if path.is_dir():
+            entries.append((mtime, size, path))
+    total = sum(size for _mtime, size, _path in entries)
+    entries = [entry for entry in entries if entry[2].name not in keep]
+    removed = []
+    for mtime, size, path in sorted(entries, key=lambda e: e[0]):
+        if now - mtime <= maxage and total <= quota:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        removed.append(path.name)
+        total -= size
+    return removed
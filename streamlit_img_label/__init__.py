@@ -1,7 +1,7 @@
 import os
+import json
 import streamlit.components.v1 as components
-import numpy as np
-from .manage import ImageManager, ImageDirManager
+from .manage import ImageManager, ImageDirManager, encode_img
 
 _RELEASE = True
 
@@ -13,10 +13,25 @@ if not _RELEASE:
 else:
     parent_dir = os.path.dirname(os.path.abspath(__file__))
     build_dir = os.path.join(parent_dir, "frontend/build")
+    # The build is not in the repository. It must be made from the current
+    # frontend sources, whose version the build step writes to build/VERSION
+    with open(os.path.join(parent_dir, "frontend/package.json")) as f:
+        version = json.load(f)["version"]
+    try:
+        with open(os.path.join(build_dir, "VERSION")) as f:
+            build_version = f.read().strip()
+    except OSError:
+        build_version = None
+    if build_version != version:
+        raise RuntimeError(
+            "The st_img_label frontend build is missing or out of date "
+            "(build %s, sources %s). Build it with npm install and npm run "
+            "build in %s" % (build_version, version, os.path.join(parent_dir, "frontend"))
+        )
     _component_func = components.declare_component("st_img_label", path=build_dir)
 
 
-def st_img_label(resized_img, box_color="blue", rects=[], key=None):
+def st_img_label(resized_img, box_color="blue", rects=[], key=None, image_uri=None):
     """Create a new instance of "st_img_label".
 
     Parameters
@@ -31,6 +46,9 @@ def st_img_label(resized_img, box_color="blue", rects=[], key=None):
         An optional key that uniquely identifies this component. If this is
         None, and the component's arguments are changed, the component will
         be re-mounted in the Streamlit frontend and lose its current state.
+    image_uri: str or None
+        The image already encoded as a data URI, as returned by
+        ImageManager.encoded_img. If None resized_img is encoded as JPEG.
 
     Returns
     -------
@@ -41,8 +59,8 @@ def st_img_label(resized_img, box_color="blue", rects=[], key=None):
     canvasWidth = resized_img.width
     canvasHeight = resized_img.height
 
-    # Translates image to a list for passing to Javascript
-    imageData = np.array(resized_img.convert("RGBA")).flatten().tolist()
+    # Encoded image for passing to Javascript, instead of a list of RGBA values
+    imageUri = encode_img(resized_img) if image_uri is None else image_uri
 
     # Call through to our private component function. Arguments we pass here
     # will be sent to the frontend, where they'll be available in an "args"
@@ -56,7 +74,7 @@ def st_img_label(resized_img, box_color="blue", rects=[], key=None):
         canvasHeight=canvasHeight,
         rects=rects,
         boxColor=box_color,
-        imageData=imageData,
+        imageUri=imageUri,
         key=key,
     )
     # Return a cropped image using the box from the frontend
@@ -148,7 +166,7 @@ if not _RELEASE:
     img = im.get_img()
     resized_img = im.resizing_img()
     resized_rects = im.get_resized_rects()
-    rects = st_img_label(resized_img, box_color="red", rects=resized_rects)
+    rects = st_img_label(resized_img, box_color="red", rects=resized_rects, image_uri=im.encoded_img())
 
     def annotate():
         im.save_annotation()
@@ -20,39 +20,18 @@ interface PythonArgs {
     canvasHeight: number
     rects: RectProps[]
     boxColor: string
-    imageData: Uint8ClampedArray
+    imageUri: string
 }
 
 const StreamlitImgLabel = (props: ComponentProps) => {
     const [mode, setMode] = useState<string>("light")
     const [labels, setLabels] = useState<string[]>([])
     const [canvas, setCanvas] = useState(new fabric.Canvas(""))
-    const { canvasWidth, canvasHeight, imageData }: PythonArgs = props.args
+    const { canvasWidth, canvasHeight, imageUri }: PythonArgs = props.args
     const [newBBoxIndex, setNewBBoxIndex] = useState<number>(0)
 
-    /*
-     * Translate Python image data to a JavaScript Image
-     */
-    var invisCanvas = document.createElement("canvas")
-    var ctx = invisCanvas.getContext("2d")
-
-    invisCanvas.width = canvasWidth
-    invisCanvas.height = canvasHeight
-
-    // create imageData object
-    let dataUri: any
-    if (ctx) {
-        var idata = ctx.createImageData(canvasWidth, canvasHeight)
-
-        // set our buffer as source
-        idata.data.set(imageData)
-
-        // update canvas with new data
-        ctx.putImageData(idata, 0, 0)
-        dataUri = invisCanvas.toDataURL()
-    } else {
-        dataUri = ""
-    }
+    // The image arrives encoded as a data URI, the canvas background as is
+    const dataUri = imageUri
 
     // Initialize canvas on mount and add a rectangle
     useEffect(() => {
@@ -1,5 +1,8 @@
 import os
 import re
+import base64
+import io
+from functools import lru_cache
 import numpy as np
 from PIL import Image
 from .annotation import output_xml, read_xml
@@ -10,6 +13,106 @@ from .annotation import output_xml, read_xml
 .. moduleauthor:: Tianning Li <ltianningli@gmail.com>
 """
 
+PYRAMID_SIZES = (2048, 1024, 512)
+
+
+@lru_cache(maxsize=4)
+def _load_pyramid(filename, mtime, sizes=PYRAMID_SIZES):
+    """load the image and its reduced levels, once per file version.
+
+    Args:
+        filename(str): the image file.
+        mtime(int): the modification time of the file, it identifies its version.
+        sizes(tuple): the maximum width and height of every level.
+    Returns:
+        pyramid(list): the image and its levels (PIL.Image), from the largest to the smallest.
+    """
+    img = Image.open(filename)
+    img.load()
+    pyramid = [img]
+    for size in sorted(sizes, reverse=True):
+        level = pyramid[-1]
+        if max(level.size) > size:
+            ratio = size / max(level.size)
+            pyramid.append(
+                level.resize(
+                    (max(1, int(level.width * ratio)), max(1, int(level.height * ratio))),
+                    Image.BOX,
+                )
+            )
+    return pyramid
+
+
+@lru_cache(maxsize=4)
+def _level_array(filename, mtime, index):
+    """convert a pyramid level to an uint8 array, once per file version.
+
+    Args:
+        filename(str): the image file.
+        mtime(int): the modification time of the file.
+        index(int): the pyramid level, 0 for the image itself.
+    Returns:
+        array(numpy.ndarray): the level pixels, read only.
+    """
+    array = np.asarray(_load_pyramid(filename, mtime)[index]).astype("uint8", copy=False)
+    array.flags.writeable = False
+    return array
+
+
+@lru_cache(maxsize=16)
+def _resize_level(filename, mtime, width, height):
+    """resize the image from the smallest pyramid level not smaller than the target.
+
+    Args:
+        filename(str): the image file.
+        mtime(int): the modification time of the file.
+        width(int): the target width.
+        height(int): the target height.
+    Returns:
+        resized_img(PIL.Image): the resized image.
+    """
+    pyramid = _load_pyramid(filename, mtime)
+    level = [img for img in pyramid if img.width >= width and img.height >= height][-1]
+    if level.size == (width, height):
+        return level
+    return level.resize((width, height))
+
+
+@lru_cache(maxsize=16)
+def _encode_level(filename, mtime, width, height, image_format, quality):
+    """encode the resized image as a data URI.
+
+    Args:
+        filename(str): the image file.
+        mtime(int): the modification time of the file.
+        width(int): the target width.
+        height(int): the target height.
+        image_format(str): the encoding, JPEG or PNG.
+        quality(int): the JPEG quality.
+    Returns:
+        image_uri(str): the encoded image.
+    """
+    return encode_img(_resize_level(filename, mtime, width, height), image_format, quality)
+
+
+def encode_img(img, image_format="JPEG", quality=90):
+    """encode an image as a data URI.
+
+    Args:
+        img(PIL.Image): the image.
+        image_format(str): the encoding, JPEG or PNG.
+        quality(int): the JPEG quality.
+    Returns:
+        image_uri(str): the encoded image.
+    """
+    buffer = io.BytesIO()
+    if image_format.upper() == "JPEG":
+        img.convert("RGB").save(buffer, format="JPEG", quality=quality)
+    else:
+        img.save(buffer, format=image_format)
+    data = base64.b64encode(buffer.getvalue()).decode("ascii")
+    return f"data:image/{image_format.lower()};base64,{data}"
+
 
 class ImageManager:
     """ImageManager
@@ -22,7 +125,8 @@ class ImageManager:
     def __init__(self, filename):
         """initiate module"""
         self._filename = filename
-        self._img = Image.open(filename)
+        self._mtime = os.stat(filename).st_mtime_ns
+        self._img = _load_pyramid(filename, self._mtime)[0]
         self._rects = []
         self._load_rects()
         self._resized_ratio_w = 1
@@ -52,28 +156,46 @@ class ImageManager:
     def resizing_img(self, max_height=700, max_width=700):
         """resizing the image by max_height and max_width.
 
+        The image is resized from the smallest level of its cached preview
+        pyramid that is not smaller than the frame.
+
         Args:
             max_height(int): the max_height of the frame.
             max_width(int): the max_width of the frame.
         Returns:
             resized_img(PIL.Image): the resized image.
         """
-        resized_img = self._img.copy()
-        if resized_img.height > max_height:
-            ratio = max_height / resized_img.height
-            resized_img = resized_img.resize(
-                (int(resized_img.width * ratio), int(resized_img.height * ratio))
-            )
-        if resized_img.width > max_width:
-            ratio = max_width / resized_img.width
-            resized_img = resized_img.resize(
-                (int(resized_img.width * ratio), int(resized_img.height * ratio))
-            )
+        width, height = self._resized_size(max_height, max_width)
+        resized_img = _resize_level(self._filename, self._mtime, width, height)
 
         self._resized_ratio_w = self._img.width / resized_img.width
         self._resized_ratio_h = self._img.height / resized_img.height
         return resized_img
 
+    def _resized_size(self, max_height, max_width):
+        width, height = self._img.width, self._img.height
+        if height > max_height:
+            ratio = max_height / height
+            width, height = int(width * ratio), int(height * ratio)
+        if width > max_width:
+            ratio = max_width / width
+            width, height = int(width * ratio), int(height * ratio)
+        return width, height
+
+    def encoded_img(self, max_height=700, max_width=700, image_format="JPEG", quality=90):
+        """get the resized image encoded as a data URI, for the component.
+
+        Args:
+            max_height(int): the max_height of the frame.
+            max_width(int): the max_width of the frame.
+            image_format(str): the encoding, JPEG or PNG.
+            quality(int): the JPEG quality.
+        Returns:
+            image_uri(str): the encoded image.
+        """
+        width, height = self._resized_size(max_height, max_width)
+        return _encode_level(self._filename, self._mtime, width, height, image_format, quality)
+
     def _resize_rect(self, rect):
         resized_rect = {}
         resized_rect["left"] = rect["left"] / self._resized_ratio_w
@@ -92,7 +214,7 @@ class ImageManager:
         """
         return [self._resize_rect(rect) for rect in self._rects]
 
-    def _chop_box_img(self, rect):
+    def _chop_box_img(self, rect, thumbnail_size=(200, 200)):
         rect["left"] = int(rect["left"] * self._resized_ratio_w)
         rect["width"] = int(rect["width"] * self._resized_ratio_w)
         rect["top"] = int(rect["top"] * self._resized_ratio_h)
@@ -104,16 +226,28 @@ class ImageManager:
             rect["height"],
         )
 
-        raw_image = np.asarray(self._img).astype("uint8")
-        prev_img = np.zeros(raw_image.shape, dtype="uint8")
-        prev_img[top : top + height, left : left + width] = raw_image[
-            top : top + height, left : left + width
+        # Crop from the smallest pyramid level that still fills the thumbnail
+        pyramid = _load_pyramid(self._filename, self._mtime)
+        scale = min(
+            1,
+            thumbnail_size[0] / max(1, width),
+            thumbnail_size[1] / max(1, height),
+        )
+        index = max(
+            i for i, level in enumerate(pyramid) if level.width / self._img.width >= scale
+        )
+        level_scale = pyramid[index].width / self._img.width
+        raw_image = _level_array(self._filename, self._mtime, index)
+        prev_img = raw_image[
+            int(top * level_scale) : int(np.ceil((top + height) * level_scale)),
+            int(left * level_scale) : int(np.ceil((left + width) * level_scale)),
         ]
-        prev_img = prev_img[top : top + height, left : left + width]
+        prev_img = Image.fromarray(np.ascontiguousarray(prev_img))
+        prev_img.thumbnail(thumbnail_size)
         label = ""
         if "label" in rect:
             label = rect["label"]
-        return (Image.fromarray(prev_img), label)
+        return (prev_img, label)
 
     def init_annotation(self, rects):
         """init annotation for current rects.
@@ -147,8 +281,8 @@ class ImageDirManager:
         self._annotations_files = []
 
     def get_all_files(self, allow_types=["png"]): # ["png", "jpg", "jpeg"] en el código original
-        allow_types += [i.upper() for i in allow_types]
-        mask = ".*\.[" + "|".join(allow_types) + "]"
+        allow_types = allow_types + [i.upper() for i in allow_types]
+        mask = ".*\.(" + "|".join(allow_types) + ")$"
         self._files = [
             file for file in os.listdir(self._dir_name) if re.match(mask, file)
         ]
@@ -156,7 +290,7 @@ class ImageDirManager:
 
     def get_exist_annotation_files(self):
         self._annotations_files = [
-            file for file in os.listdir(self._dir_name) if re.match(".*.xml", file)
+            file for file in os.listdir(self._dir_name) if re.match(".*\.xml$", file)
         ]
         return self._annotations_files
 
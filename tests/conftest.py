@@ -0,0 +1,76 @@
+import configparser
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import pyfilmqa as fqa
+
+
+@pytest.fixture
+def config(tmp_path):
+    """The app configuration, with every directory it writes in the test directory"""
+    config = configparser.ConfigParser()
+    config.read(ROOT / 'config' / 'filmQAp.config')
+    config['Processing']['checkpointpath'] = str(tmp_path / 'checkpoints') + '/'
+    config['Cache']['path'] = str(tmp_path / 'cache') + '/'
+    config['Workspace']['path'] = str(tmp_path / 'workspaces') + '/'
+    config['Segmentation']['layoutpath'] = str(tmp_path / 'layouts') + '/'
+    config['Models']['storepath'] = str(tmp_path / 'store') + '/'
+    return config
+
+
+@pytest.fixture(scope='module')
+def pool():
+    """The persistent worker pool, shut down after the module tests"""
+    config = configparser.ConfigParser()
+    config.read(ROOT / 'config' / 'filmQAp.config')
+    yield fqa.getPool(config)
+    fqa.shutdownPool()
+
+
+# Calibration of the sample film img_dir/Film.tif: multiphase parameters (f, phir, kr, phib, kb) and rational seeds
+# (a, b, c) of the red, green and blue channels
+CALPS = np.array([[0.14803397413414895, 0.5647352982874287, 0.06050403741512456, 0.09827037410715911, 0.3996150911020535],
+                  [0.15704471455123303, 0.8713994562132357, 0.03632512256515224, 0.05824647214604739, 0.3996150911020535],
+                  [0.23411376942298898, 0.5972235820795386, 0.03632512256515224, 0.00793313558933373, 0.3996150911020535]])
+RATPS = np.array([[3.6851682461064788, 0.11290531873617557, 5.211736554320502],
+                  [5.656800414574926, 0.03914088118658677, 8.18147624829451],
+                  [10.098368457809238, 0.02055888313278824, 17.329963199282872]])
+
+
+@pytest.fixture
+def colscalps():
+    """The multiphase parameters of a 24 column film with a smooth lateral response, with shape (3, columns, 5)"""
+    x = np.linspace(-1, 1, 24)
+    scale = 1 - 0.05*x**2
+    ones = np.ones_like(x)
+    return CALPS[:, np.newaxis, :] * np.column_stack([ones, scale, ones, scale, ones])
+
+
+@pytest.fixture
+def doses():
+    """The reference doses in Gy, with shape (rows, columns, channels)"""
+    return np.random.default_rng(0).uniform(0.2, 9., size=(20, 24, 3))
+
+
+@pytest.fixture
+def dim(doses, colscalps):
+    """The optical densities of the reference doses, with shape (rows, columns, channels)"""
+    return np.stack([fqa.calf(doses[..., ch], *colscalps[ch].T) for ch in range(3)], axis=-1)
+
+
+@pytest.fixture
+def calps():
+    """The multiphase parameters of the red, green and blue channels, with shape (3, 5)"""
+    return CALPS
+
+
+@pytest.fixture
+def ratps():
+    """The rational approximation parameters of the red, green and blue channels, with shape (3, 3)"""
+    return RATPS
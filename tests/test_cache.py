@@ -0,0 +1,19 @@
+import numpy as np
+
+import pyfilmqa as fqa
+
+
+def test_cache_round_trip(config):
+    key = fqa.cacheKey('film', np.arange(6.).reshape(2, 3), 0.5)
+    assert key != fqa.cacheKey('film', np.arange(6.).reshape(3, 2), 0.5)
+    assert fqa.cacheLoad(config=config, key=key) is None
+    fqa.cacheStore(config=config, key=key, value={'Dim' : np.ones(3)})
+    np.testing.assert_array_equal(fqa.cacheLoad(config=config, key=key)['Dim'], np.ones(3))
+
+
+def test_cache_drops_unreadable_entries(config):
+    key = fqa.cacheKey('film')
+    fqa.cacheStore(config=config, key=key, value=1)
+    fqa.cachePath(config=config, key=key).write_bytes(b'not a pickle')
+    assert fqa.cacheLoad(config=config, key=key) is None
+    assert not fqa.cachePath(config=config, key=key).exists()
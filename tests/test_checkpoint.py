@@ -0,0 +1,38 @@
+import numpy as np
+
+import pyfilmqa as fqa
+
+
+def test_resume_computes_only_missing_tiles(config, pool, dim, colscalps, ratps):
+    config['Processing']['tilecols'] = '8'
+    shape = (dim.shape[1], dim.shape[0], dim.shape[2])
+    checkpoint = fqa.doseCheckpoint(config, key='film', shape=shape)
+    sentinel = np.full((8,) + shape[1:], -1.)
+    checkpoint.add(8, 16, sentinel)
+    checkpoint.save()
+    checkpoint.close()
+
+    checkpoint = fqa.doseCheckpoint(config, key='film', shape=shape)
+    assert checkpoint.tiles == {(8, 16)}
+    D = fqa.shmDoseCalculationMphspcnlmprocf(dim, *colscalps, *ratps, pool=pool, tilecols=8, method='newton',
+                                             checkpoint=checkpoint)
+    assert checkpoint.tiles == {(0, 8), (8, 16), (16, 24)}
+    checkpoint.close()
+
+    # The saved tile is taken as it is, the others are calculated
+    np.testing.assert_array_equal(D[8:16], sentinel)
+    exact = fqa.imDoseCalculationMphspcnlmprocf(dim, *colscalps, *ratps, method='newton')
+    np.testing.assert_array_equal(D[:8], exact[:8])
+    np.testing.assert_array_equal(D[16:], exact[16:])
+
+
+def test_checkpoint_of_other_settings_is_not_resumed(config):
+    shape = (24, 20, 3)
+    checkpoint = fqa.doseCheckpoint(config, key='film', shape=shape)
+    checkpoint.add(0, 16, np.zeros((16,) + shape[1:]))
+    checkpoint.save()
+    checkpoint.close()
+    config['Processing']['tilecols'] = '8'
+    checkpoint = fqa.doseCheckpoint(config, key='film', shape=shape)
+    assert checkpoint.tiles == set()
+    checkpoint.close()
@@ -0,0 +1,61 @@
+import gzip
+from io import BytesIO, StringIO
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import pyfilmqa as fqa
+
+HEADER = {'AcqType' : 'Acquired Portal', 'PatientId1' : 'Film', 'PatientId2' : 'Film', 'LastName' : 'Doe', 'FirstName' : 'Jane',
+          'pxsp' : [0.3528, 0.3528], 'DataOriginDateTime' : '2024-01-01 12:00:00'}
+
+
+def referenceDxf(Data, imsz):
+    """The dxf file as written with the header and pandas to_csv"""
+    out = StringIO()
+    for line in fqa.HeaderCreator(imsz=imsz, **HEADER):
+        out.write(line)
+    pd.DataFrame(Data).to_csv(out, sep='\t', header=False, index=False, float_format='%.2f')
+    return out.getvalue().encode()
+
+
+@pytest.fixture(params=[(40, 30), (7, 1), (1, 5)], ids=['film', 'column', 'row'])
+def Data(request):
+    Data = np.random.default_rng(1).uniform(0, 12, size=request.param)
+    Data.flat[::4] = np.nan
+    Data.flat[1] = 0.004
+    Data.flat[-1] = -0.004
+    return Data
+
+
+@pytest.mark.parametrize('blockbytes', [64, 2**16])
+def test_writer_matches_to_csv(Data, blockbytes):
+    out = BytesIO()
+    fqa.dxfWriter(Data=Data, dxfFileName=out, imsz=list(Data.shape[::-1]), blockbytes=blockbytes, **HEADER)
+    assert out.getvalue() == referenceDxf(Data, list(Data.shape[::-1]))
+
+
+def test_orientations_swap_the_axes(tmp_path, Data):
+    paths = {orientation : tmp_path / (orientation + '.dxf') for orientation in ['original', 'rot90']}
+    fqa.dxfWriter(Data=Data, orientations=paths, imsz=list(Data.shape[::-1]), **HEADER)
+    assert paths['original'].read_bytes() == referenceDxf(Data, list(Data.shape[::-1]))
+    assert paths['rot90'].read_bytes() == referenceDxf(np.rot90(Data), list(Data.shape))
+
+
+@pytest.mark.parametrize('compress', [None, 'gzip'])
+@pytest.mark.parametrize('chunkbytes', [16, 2**24])
+def test_reader_round_trip(tmp_path, Data, compress, chunkbytes):
+    dxffile = tmp_path / 'Film.dxf'
+    fqa.dxfWriter(Data=Data, dxfFileName=dxffile, imsz=list(Data.shape[::-1]), compress=compress, spool=True, **HEADER)
+    header, read = fqa.dxfReader(dxffile, chunkbytes=chunkbytes)
+    np.testing.assert_array_equal(read, np.round(Data, 2) + 0.)
+    assert header['Patient']['LastName'] == 'Doe'
+
+
+def test_reader_accepts_streams(Data):
+    out = BytesIO()
+    fqa.dxfWriter(Data=Data, dxfFileName=out, imsz=list(Data.shape[::-1]), compress='gzip', **HEADER)
+    assert gzip.decompress(out.getvalue()) == referenceDxf(Data, list(Data.shape[::-1]))
+    _header, read = fqa.dxfReader(BytesIO(out.getvalue()))
+    np.testing.assert_array_equal(read, np.round(Data, 2) + 0.)
@@ -0,0 +1,71 @@
+import threading
+import time
+
+import pyfilmqa as fqa
+
+
+def waitFor(condition, timeout=10.):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        assert time.perf_counter() < deadline, 'Timed out'
+        time.sleep(0.01)
+
+
+def test_scheduler_admits_by_priority():
+    scheduler = fqa.JobScheduler(maxjobs=1)
+    first = scheduler.enqueue(name='first')
+    scheduler.admit(first)
+    order = []
+
+    def run(ticket):
+        scheduler.admit(ticket)
+        order.append(ticket[2])
+        scheduler.release(ticket)
+
+    tickets = [scheduler.enqueue(name=name, priority=priority) for name, priority in [('b', 1), ('c', 0), ('d', 1)]]
+    assert [scheduler.queued(ticket)[0] for ticket in tickets] == [2, 1, 3]
+    threads = [threading.Thread(target=run, args=(ticket,)) for ticket in tickets]
+    for thread in threads:
+        thread.start()
+    scheduler.release(first)
+    for thread in threads:
+        thread.join(10.)
+    assert order == ['c', 'b', 'd']
+    assert scheduler.queued(tickets[0]) == (0, 0.)
+    assert len(scheduler.durations) == 4
+
+
+def test_submitted_jobs_run_by_priority_and_are_pruned(config):
+    config['Processing']['maxjobs'] = '1'
+    config['Processing']['maxfinishedjobs'] = '2'
+    release = threading.Event()
+    order = []
+
+    def target(job=None, config=None, wait=False):
+        if wait:
+            release.wait(10.)
+        order.append(job.name)
+
+    blocker = fqa.submitJob(target, config=config, name='blocker', wait=True)
+    waitFor(lambda: fqa.getJob(blocker).state == 'running')
+    jobids = [fqa.submitJob(target, config=config, name=name, priority=priority) for name, priority in [('low', 2), ('urgent', 0), ('normal', 1)]]
+    assert [fqa.getJob(jobid).position for jobid in jobids] == [3, 1, 2]
+    assert all(fqa.getJob(jobid).state == 'queued' for jobid in jobids)
+
+    release.set()
+    waitFor(lambda: len(order) == 4 and fqa.getJob(jobids[0]).finished is not None)
+    assert order == ['blocker', 'urgent', 'normal', 'low']
+    # Only the last two finished jobs are kept
+    assert fqa.getJob(blocker) is None and fqa.getJob(jobids[1]) is None
+    assert fqa.getJob(jobids[2]).state == fqa.getJob(jobids[0]).state == 'done'
+
+
+def test_failed_job_records_the_error(config):
+    def target(job=None, config=None):
+        raise ValueError('no film')
+
+    jobid = fqa.submitJob(target, config=config, name='failing')
+    waitFor(lambda: fqa.getJob(jobid).finished is not None)
+    job = fqa.getJob(jobid)
+    assert job.state == 'failed'
+    assert job.error == 'ValueError: no film'
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from tifffile import imwrite
+
+import pyfilmqa as fqa
+
+DPI = 50
+PXSP = 25.4/DPI
+
+
+def syntheticScan(shift=(0, 0), mark=True):
+    """A 50 dpi RGB scan with the scanner ruler on the left, a film, a calibration strip and a background strip, the
+    films shifted by (rows, columns) pixels"""
+    im = np.full((300, 400, 3), 60000, dtype=np.uint16)
+    im[:, :15] = 0
+    if mark:
+        im[140:150, 4:11] = 60000
+    dy, dx = shift
+    im[40+dy:160+dy, 60+dx:200+dx] = 25000
+    im[70+dy:110+dy, 100+dx:150+dx] = 21000
+    im[200+dy:225+dy, 60+dx:360+dx] = 19000
+    im[250+dy:275+dy, 60+dx:360+dx] = 40000
+    return im
+
+
+@pytest.fixture
+def scans(tmp_path):
+    paths = []
+    for name, shift in [('reference', (0, 0)), ('shifted', (6, 12))]:
+        path = tmp_path / (name + '.tif')
+        imwrite(path, syntheticScan(shift), photometric='rgb', resolution=(DPI, DPI), resolutionunit='INCH')
+        paths.append(path)
+    return paths
+
+
+def test_pixel_spacing(scans):
+    assert fqa.TIFFPixelSpacing(scans[0]) == pytest.approx([PXSP, PXSP])
+
+
+def test_detect_regions(config):
+    bbdf = fqa.detectRegions(preview=syntheticScan(), config=config).set_index('label')
+    assert list(bbdf.index) == ['Film', 'Calibration', 'Background', 'Center']
+    assert list(bbdf.loc['Film']) == [60, 140, 40, 120]
+    assert list(bbdf.loc['Calibration']) == [60, 300, 200, 25]
+    # The central part of the background strip, [Segmentation] bkgfraction of its size
+    assert list(bbdf.loc['Background']) == [135, 150, 256, 12]
+    assert list(bbdf.loc['Center']) == [4, 7, 140, 10]
+
+
+def test_detect_regions_without_center_mark(config):
+    bbdf = fqa.detectRegions(preview=syntheticScan(mark=False), config=config, bkgfraction=1.)
+    assert 'Center' not in bbdf.label.values
+    assert list(bbdf.set_index('label').loc['Background']) == [60, 300, 250, 25]
+
+
+def test_layout_follows_the_scan_offset(config, scans):
+    reference, shifted = scans
+    bbdf = fqa.detectRegions(preview=syntheticScan(), config=config)
+    fqa.saveLayout('bench', imfile=reference, bbdf=bbdf, config=config)
+    layout = fqa.loadLayout('bench', config=config)
+    assert layout['scan'] == 'reference.tif'
+
+    moved, offset = fqa.applyLayout(layout='bench', imfile=shifted, config=config)
+    assert offset == pytest.approx([12*PXSP, 6*PXSP], abs=0.6)
+    moved, bbdf = moved.set_index('label'), bbdf.set_index('label')
+    for label in ['Film', 'Calibration', 'Background']:
+        assert abs(moved.loc[label, 'left'] - bbdf.loc[label, 'left'] - 12) <= 1
+        assert abs(moved.loc[label, 'top'] - bbdf.loc[label, 'top'] - 6) <= 1
+    # The center mark stays with the ruler
+    assert list(moved.loc['Center']) == list(bbdf.loc['Center'])
+
+
+def test_layout_rejects_large_offsets(config, scans):
+    config['Segmentation']['layoutmaxshift'] = '2'
+    fqa.saveLayout('bench', imfile=scans[0], bbdf=fqa.detectRegions(preview=syntheticScan(), config=config), config=config)
+    with pytest.raises(ValueError, match='beyond 2 mm'):
+        fqa.applyLayout(layout='bench', imfile=scans[1], config=config)
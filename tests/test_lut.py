@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+import pyfilmqa as fqa
+
+
+@pytest.fixture
+def udim(dim):
+    """The scanner codes of the reference optical densities"""
+    return np.clip(np.round(2**16 / 10**dim), 1, 2**16 - 1).astype(np.uint16)
+
+
+def exactDose(udim, colscalps, ratps):
+    return fqa.imDoseCalculationMphspcnlmprocf(np.log10(2**16/(udim+0.0000001)), *colscalps, *ratps)
+
+
+def test_refined_lut_matches_solver(udim, colscalps, ratps):
+    D = fqa.lutDoseCalculationMphspcnlmprocf(udim, *colscalps, *ratps, nknots=4, refine=1)
+    assert D.shape == (udim.shape[1], udim.shape[0], udim.shape[2])
+    assert np.abs(D - exactDose(udim, colscalps, ratps)).max() < 1e-3
+
+
+def test_lut_at_every_column_is_exact(udim, colscalps, ratps):
+    D = fqa.lutDoseCalculationMphspcnlmprocf(udim, *colscalps, *ratps, nknots=udim.shape[1], refine=0)
+    np.testing.assert_allclose(D, exactDose(udim, colscalps, ratps), rtol=0, atol=1e-10)
+
+
+def test_refine_reduces_error(udim, colscalps, ratps):
+    err0 = fqa.lutErrorf(udim, *colscalps, *ratps, nknots=4, refine=0)
+    err1 = fqa.lutErrorf(udim, *colscalps, *ratps, nknots=4, refine=1)
+    assert err0.shape == (3,)
+    assert np.all(err1 <= err0)
+    assert err1.max() < 1e-3
@@ -0,0 +1,26 @@
+import numpy as np
+
+import pyfilmqa as fqa
+
+
+class Interrupt(fqa.NullProgress):
+    """A progress reporter that interrupts the calculation after the first finished tile"""
+
+    def update(self, n=1):
+        raise KeyboardInterrupt
+
+
+def test_shared_memory_matches_vectorized(pool, dim, colscalps, ratps):
+    D = fqa.shmDoseCalculationMphspcnlmprocf(dim, *colscalps, *ratps, pool=pool, tilecols=5, method='newton')
+    np.testing.assert_array_equal(D, fqa.imDoseCalculationMphspcnlmprocf(dim, *colscalps, *ratps, method='newton'))
+
+
+def test_interrupted_calculation_leaves_no_tasks(pool, dim, colscalps, ratps):
+    try:
+        fqa.shmDoseCalculationMphspcnlmprocf(dim, *colscalps, *ratps, pool=pool, tilecols=1, method='newton',
+                                             progress=Interrupt(), maxinflight=4)
+    except KeyboardInterrupt:
+        pass
+    else:
+        raise AssertionError('KeyboardInterrupt not propagated')
+    assert not pool._cache
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+import pyfilmqa as fqa
+
+
+def fsolveDose(dim, colscalps, ratps):
+    """The dose of every column with the fsolve reference path, with shape (columns, rows, channels)"""
+    return np.stack([fqa.colDoseCalculationMphspcnlmprocf([dim[:, col, :], *colscalps[:, col], *ratps])
+                     for col in range(dim.shape[1])])
+
+
+def test_fsolve_recovers_doses(dim, doses, colscalps, ratps):
+    D = fsolveDose(dim, colscalps, ratps)
+    np.testing.assert_allclose(D, doses.transpose(1, 0, 2), rtol=0, atol=1e-8)
+
+
+@pytest.mark.parametrize('method', ['newton', 'halley'])
+def test_icalfnewton_matches_icalf(calps, method):
+    D = np.linspace(0.1, 10., 50)
+    for chcalps in calps:
+        d = fqa.calf(D, *chcalps)
+        ref = np.array([fqa.icalf(di, Di, *chcalps) for di, Di in zip(d, D + 0.3)])
+        new = fqa.icalfnewton(d, D + 0.3, *chcalps, method=method)
+        np.testing.assert_allclose(new, ref, rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize('method', ['newton', 'halley'])
+def test_vectorized_matches_fsolve(dim, colscalps, ratps, method):
+    D = fqa.imDoseCalculationMphspcnlmprocf(dim, *colscalps, *ratps, method=method)
+    assert D.shape == (dim.shape[1], dim.shape[0], dim.shape[2])
+    np.testing.assert_allclose(D, fsolveDose(dim, colscalps, ratps), rtol=0, atol=1e-10)
+
+
+def test_float32_precision(dim, colscalps, ratps):
+    D64 = fqa.imDoseCalculationMphspcnlmprocf(dim, *colscalps, *ratps)
+    D32 = fqa.imDoseCalculationMphspcnlmprocf(dim.astype(np.float32), *colscalps, *ratps)
+    assert D32.dtype == np.float32
+    assert np.abs(D32 - D64).max() < 1e-3
@@ -0,0 +1,33 @@
+import gc
+import os
+import time
+
+import pyfilmqa as fqa
+
+
+def age(workspace, hours):
+    then = time.time() - hours*3600
+    os.utime(workspace.path / fqa.Workspace.MARKER, (then, then))
+
+
+def test_clean_keeps_live_workspaces(config):
+    live = fqa.Workspace(config=config)
+    dead = fqa.Workspace(config=config)
+    deadname = dead.name
+    age(live, 48)
+    age(dead, 48)
+    del dead
+    gc.collect()
+    assert fqa.workspaceClean(config=config) == [deadname]
+    assert live.path.exists()
+
+
+def test_clean_keeps_named_workspaces_over_quota(config):
+    config['Workspace']['quota'] = '0'
+    workspace = fqa.Workspace(config=config, name='session')
+    workspace.file('Film.tif').write_bytes(b'0' * 1024)
+    name = workspace.name
+    del workspace
+    gc.collect()
+    assert fqa.workspaceClean(config=config, keep=[name]) == []
+    assert fqa.workspaceClean(config=config) == [name]